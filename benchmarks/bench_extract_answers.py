@@ -0,0 +1,114 @@
+"""
+答案提取的基准测试：旧的逐行多次正则 vs iter_answers 的单次组合正则
+
+用法：
+    python benchmarks/bench_extract_answers.py                    # 生成 20 万行的简化报告
+    python benchmarks/bench_extract_answers.py --lines 1000000
+    python benchmarks/bench_extract_answers.py --file xxx_simplified_copy.txt
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessing.html_html import extract_answers_from_simplified_html
+
+
+def legacy_extract(path):
+    """改动前的实现：readlines() 读入整个文件，每行最多三次 re.search"""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        lines = f.readlines()
+    answers_dict = {}
+    for line in lines:
+        if '<!-- 绝对编码：3473 -->' in line:
+            pass
+        if '<!-- 绝对编码：' in line:
+            row_match = re.search(r'<!-- 绝对编码：(\d+) -->', line)
+            if row_match:
+                row_num = int(row_match.group(1))
+                answer = None
+                for pattern in [r'<p>(.*?)<o:p>', r'<o:p>(.*?)</o:p>']:
+                    match = re.search(pattern, line)
+                    if match:
+                        answer = match.group(1).strip()
+                        if answer and answer != '&nbsp;' and answer != '':
+                            break
+                if answer:
+                    answers_dict[row_num] = answer
+    return answers_dict
+
+
+def write_report(path, n_lines, seed=0):
+    """生成与 _simplified_copy.txt 结构相同的文本：正文、已填写/未填写的问题行和表格单元格"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        for line_number in range(1, n_lines + 1):
+            kind = rng.random()
+            if kind < 0.6:
+                f.write(f"<p>第{line_number}段正文，说明管理人的基本情况与业务流程。<o:p></o:p></p>\n")
+            elif kind < 0.8:
+                f.write(f"<p>管理人填写的答案{line_number}<o:p></o:p></p> <!-- 绝对编码：{line_number} -->\n")
+            elif kind < 0.9:
+                f.write(f"<td><p><o:p>单元格{line_number}</o:p></p></td> <!-- 绝对编码：{line_number} -->\n")
+            else:
+                f.write(f"<p><o:p>&nbsp;</o:p></p> <!-- 绝对编码：{line_number} -->\n")
+
+
+def measure(func, path, repeat):
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func(path)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        func(path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='答案提取基准测试')
+    parser.add_argument('--file', help='已有的简化报告（utf-8）；不指定时生成一个')
+    parser.add_argument('--lines', type=int, default=200000, help='生成报告的行数')
+    parser.add_argument('--repeat', type=int, default=3, help='每种实现运行的次数（取最快一次）')
+    args = parser.parse_args()
+
+    path = args.file
+    tmp_dir = None
+    if path is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp_dir.name, 'report_simplified_copy.txt')
+        write_report(path, args.lines)
+    print(f"报告: {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+    try:
+        old_answers, old_time, old_peak = measure(legacy_extract, path, args.repeat)
+        new_answers, new_time, new_peak = measure(extract_answers_from_simplified_html, path, args.repeat)
+    finally:
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    if old_answers != new_answers:
+        print("✗ 两种实现的结果不一致")
+        sys.exit(1)
+    print(f"答案数: {len(new_answers)}（两种实现一致）")
+    print(f"旧实现:   {old_time * 1000:8.1f} ms   峰值内存 {old_peak / 1e6:6.1f} MB")
+    print(f"单次扫描: {new_time * 1000:8.1f} ms   峰值内存 {new_peak / 1e6:6.1f} MB")
+    print(f"加速: {old_time / new_time:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
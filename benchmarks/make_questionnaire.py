@@ -0,0 +1,163 @@
+"""
+生成合成的 Word 导出 HTML 尽调问卷（gb2312 编码，结构与真实报告相同）
+
+包含：带 mso 样式的标题和正文段落、问题及其下方的空白答案行（<o:p>&nbsp;</o:p>）、
+□ 勾选项、两列的填写表格和一个多行的股东表格（真实报告中最容易拖慢整体的那种大表）。
+
+用法：
+    python benchmarks/make_questionnaire.py out_dir --sizes small medium large --copies 2
+"""
+
+import argparse
+import os
+import random
+
+# 规模：(问题数, 两列表格数, 每个表格的行数, 股东表格行数)
+SIZES = {
+    'small': (20, 2, 4, 10),
+    'medium': (80, 8, 6, 30),
+    'large': (300, 25, 8, 80),
+    'xlarge': (1000, 80, 10, 200),
+}
+
+HEAD = """<html xmlns:v="urn:schemas-microsoft-com:vml"
+xmlns:o="urn:schemas-microsoft-com:office:office"
+xmlns:w="urn:schemas-microsoft-com:office:word"
+xmlns="http://www.w3.org/TR/REC-html40">
+
+<head>
+<meta http-equiv=Content-Type content="text/html; charset=gb2312">
+<meta name=ProgId content=Word.Document>
+<meta name=Generator content="Microsoft Word 15">
+<style>
+<!--
+p.MsoNormal, li.MsoNormal, div.MsoNormal
+	{margin:0cm;
+	text-align:justify;
+	font-size:10.5pt;
+	font-family:等线;}
+-->
+</style>
+</head>
+
+<body lang=ZH-CN style='tab-interval:21.0pt;text-justify-trim:punctuation'>
+
+<div class=WordSection1 style='layout-grid:15.6pt'>
+
+<h1><span style='font-family:宋体'>私募类资产管理机构尽职调查报告<span lang=EN-US><o:p></o:p></span></span></h1>
+
+"""
+
+TAIL = """
+</div>
+
+</body>
+
+</html>
+"""
+
+TOPICS = ['公司基本情况', '股权结构', '治理结构', '投资决策流程', '风险控制', '合规管理', '信息披露', '人员情况',
+          '产品运作', '估值核算', '交易执行', '信息技术系统']
+
+
+def paragraph(text, lang_en=False):
+    lang = " lang=EN-US" if lang_en else ""
+    return (f"<p class=MsoNormal style='line-height:150%'><span{lang} style='font-size:10.5pt;\n"
+            f"line-height:150%;font-family:宋体'>{text}<o:p></o:p></span></p>\n\n")
+
+
+def blank_answer():
+    return ("<p class=MsoNormal style='line-height:150%'><span lang=EN-US style='font-size:10.5pt;\n"
+            "line-height:150%'><o:p>&nbsp;</o:p></span></p>\n\n")
+
+
+def checkbox_question(index, rng):
+    options = rng.sample(['是', '否', '不适用', '部分适用'], 3)
+    boxes = '&nbsp;&nbsp;'.join(f"□{option}" for option in options)
+    return (f"<p class=MsoNormal><span style='font-family:宋体'>{index}. 是否已建立相关制度：{boxes}"
+            f"<span lang=EN-US><o:p></o:p></span></span></p>\n\n")
+
+
+def cell(text, width=284):
+    return (f"  <td width={width} valign=top style='width:213.05pt;border:solid windowtext 1.0pt;\n"
+            f"  padding:0cm 5.4pt 0cm 5.4pt'>\n"
+            f"  <p class=MsoNormal><span style='font-family:宋体'>{text}<span lang=EN-US><o:p></o:p></span></span></p>\n"
+            f"  </td>\n")
+
+
+def blank_cell(width=284):
+    return (f"  <td width={width} valign=top style='width:213.05pt;border:solid windowtext 1.0pt;\n"
+            f"  border-left:none;padding:0cm 5.4pt 0cm 5.4pt'>\n"
+            f"  <p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span></p>\n"
+            f"  </td>\n")
+
+
+def table(rows):
+    parts = ["<table class=MsoTableGrid border=1 cellspacing=0 cellpadding=0\n"
+             " style='border-collapse:collapse;border:none'>\n"]
+    for row in rows:
+        parts.append(" <tr>\n")
+        parts.extend(row)
+        parts.append(" </tr>\n")
+    parts.append("</table>\n\n")
+    return ''.join(parts)
+
+
+def form_table(index, n_rows, topic):
+    return table([[cell(f"{topic}事项{index}-{r}"), blank_cell()] for r in range(n_rows)])
+
+
+def shareholder_table(n_rows):
+    header = [cell(name, 142) for name in ('股东名称', '出资额（万元）', '持股比例', '是否实际控制人')]
+    return table([header] + [[cell(f"股东{r + 1}", 142)] + [blank_cell(142) for _ in range(3)]
+                             for r in range(n_rows)])
+
+
+def build_questionnaire(n_questions, n_tables, table_rows, shareholder_rows, seed=0):
+    """返回问卷的 HTML 文本；问题均匀分布在各个章节中，表格插在问题之后"""
+    rng = random.Random(seed)
+    parts = [HEAD]
+    table_every = max(1, n_questions // max(1, n_tables))
+    tables_written = 0
+    for index in range(1, n_questions + 1):
+        topic = TOPICS[(index - 1) * len(TOPICS) // n_questions]
+        if index == 1 or topic != TOPICS[(index - 2) * len(TOPICS) // n_questions]:
+            parts.append(f"<h2><span style='font-family:宋体'>{topic}<span lang=EN-US><o:p></o:p></span></span></h2>\n\n")
+        if rng.random() < 0.15:
+            parts.append(checkbox_question(index, rng))
+        else:
+            parts.append(paragraph(f"{index}. 请说明贵公司在{topic}方面的具体安排（问题{index}）"))
+            parts.append(blank_answer())
+        if index == n_questions // 3 and shareholder_rows:
+            parts.append(paragraph("请填写全部股东的出资情况："))
+            parts.append(shareholder_table(shareholder_rows))
+        if tables_written < n_tables and index % table_every == 0:
+            tables_written += 1
+            parts.append(form_table(tables_written, table_rows, topic))
+    parts.append(TAIL)
+    return ''.join(parts)
+
+
+def write_questionnaire(path, size='medium', seed=0):
+    """按 SIZES 中的规模写出一份问卷，返回路径"""
+    html = build_questionnaire(*SIZES[size], seed=seed)
+    with open(path, 'w', encoding='gb2312') as f:
+        f.write(html)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成的 Word-HTML 尽调问卷')
+    parser.add_argument('out_dir', help='输出目录')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium', 'large'])
+    parser.add_argument('--copies', type=int, default=1, help='每种规模生成的份数（种子不同）')
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    for size in args.sizes:
+        for copy in range(args.copies):
+            path = write_questionnaire(os.path.join(args.out_dir, f"questionnaire_{size}_{copy + 1}.htm"), size, seed=copy)
+            print(f"✓ {path} ({os.path.getsize(path) / 1024:.0f} KB)")
+
+
+if __name__ == '__main__':
+    main()
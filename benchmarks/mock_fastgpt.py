@@ -0,0 +1,199 @@
+"""
+本地 FastGPT 模拟服务（只用标准库）
+
+实现 /api/v1/chat/completions 的请求与回答格式（任意路径的 POST 都按它处理），用于在没有线上 FastGPT 时测量流水线性能：
+- 问题批次（输入是 {行号: '问题', ...}）：按 ||| 分隔返回每个问题的答案
+- 表格（输入含 <tr>）：原样返回每一行，&nbsp; 替换为答案，保留绝对编码和表格分隔行
+- 答案由问题文本的哈希决定，同样的提示词总是得到同样的回答
+- 支持 stream=true 的 SSE 分段返回
+- 延迟分布和错误率可配置：
+    fixed:0.2            固定 0.2 秒
+    uniform:0.1:0.5      0.1~0.5 秒均匀分布
+    lognormal:0.5:0.8    中位数 0.5 秒、sigma 0.8 的对数正态分布（有长尾）
+
+用法：
+    python benchmarks/mock_fastgpt.py --port 8766 --latency lognormal:0.5:0.8 --error-rate 0.02
+    FASTGPT_URL=http://127.0.0.1:8766/api/v1/chat/completions FASTGPT_API_KEY=x python run.py report.htm
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INPUT_MARKER = '真正输入：'
+ROW_PATTERN = re.compile(r'<tr>.*?</tr>', re.DOTALL | re.IGNORECASE)
+PACK_SEPARATOR_PATTERN = re.compile(r'(==== 表格 \d+ (?:开始|结束) ====)')
+STREAM_CHUNK_CHARS = 16
+
+
+def parse_latency(spec: str):
+    """把 'fixed:0.2' / 'uniform:a:b' / 'lognormal:median:sigma' 解析为 f(rng) -> 秒"""
+    name, *params = spec.split(':')
+    values = [float(p) for p in params]
+    if name == 'fixed' and len(values) == 1:
+        return lambda rng: values[0]
+    if name == 'uniform' and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == 'lognormal' and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise ValueError(f"无法解析的延迟分布: {spec}")
+
+
+def fake_answer(text: str) -> str:
+    """由问题（或表格行）文本决定的答案"""
+    digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+    return f"模拟答案{digest[:8]}"
+
+
+def answer_prompt(prompt: str) -> str:
+    """按 agent_call 发送的提示词格式生成回答"""
+    _, _, user_input = prompt.rpartition(INPUT_MARKER)
+    try:
+        questions = ast.literal_eval(user_input.strip())
+    except (ValueError, SyntaxError):
+        questions = None
+    if isinstance(questions, dict):
+        return '|||'.join(fake_answer(str(question)) for question in questions.values())
+    # 表格：每一行的 &nbsp; 换成答案；多个表格合并的请求保留“==== 表格 k 开始/结束 ====”分隔行
+    output = []
+    for section in PACK_SEPARATOR_PATTERN.split(user_input):
+        if PACK_SEPARATOR_PATTERN.fullmatch(section):
+            output.append(section)
+        else:
+            output.extend(row.replace('&nbsp;', fake_answer(row)) for row in ROW_PATTERN.findall(section))
+    return '\n'.join(output)
+
+
+class MockState:
+    """所有请求线程共享的随机数和计数"""
+
+    def __init__(self, latency='fixed:0.2', error_rate=0.0, error_status=500, seed=0):
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def draw(self):
+        """返回 (延迟秒数, 是否返回错误)"""
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.latency(self.rng))
+            failed = self.rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return delay, failed
+
+    def enter(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'errors': self.errors, 'max_in_flight': self.max_in_flight}
+
+
+class MockFastGPTHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        state = self.server.state
+        state.enter()
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            delay, failed = state.draw()
+            time.sleep(delay)
+            if failed:
+                self._send_json(state.error_status, {'error': 'mock failure'})
+                return
+            prompt = body['messages'][-1]['content']
+            content = answer_prompt(prompt)
+            if body.get('stream'):
+                self._send_stream(content)
+            else:
+                self._send_json(200, {'choices': [{'message': {'role': 'assistant', 'content': content}}]})
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端已取消请求（例如对冲请求中落后的一方）
+            self.close_connection = True
+        finally:
+            state.leave()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        events = [
+            {'choices': [{'delta': {'content': content[i:i + STREAM_CHUNK_CHARS]}}]}
+            for i in range(0, len(content), STREAM_CHUNK_CHARS)
+        ]
+        for event in events:
+            self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+        self._write_chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host='127.0.0.1', port=0, **state_options):
+    """在后台线程中启动模拟服务，返回 server（server.url 为接口地址，server.state 为统计）"""
+    server = ThreadingHTTPServer((host, port), MockFastGPTHandler)
+    server.daemon_threads = True
+    server.state = MockState(**state_options)
+    server.url = f"http://{host}:{server.server_address[1]}/api/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 FastGPT 模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--latency', default='fixed:0.2', help='延迟分布：fixed:s / uniform:a:b / lognormal:median:sigma')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回错误的请求比例（0~1）')
+    parser.add_argument('--error-status', type=int, default=500, help='错误时返回的 HTTP 状态码（如 429、500）')
+    parser.add_argument('--seed', type=int, default=0, help='延迟和错误的随机种子')
+    args = parser.parse_args()
+    server = start_server(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                          error_status=args.error_status, seed=args.seed)
+    print(f"模拟 FastGPT 服务已启动: {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(f"\n统计: {server.state.stats()}")
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
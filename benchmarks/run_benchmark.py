@@ -0,0 +1,184 @@
+"""
+端到端吞吐基准测试
+
+启动本地 FastGPT 模拟服务（mock_fastgpt.py），为每种规模生成若干份合成问卷（make_questionnaire.py），
+再以子进程运行 run.py 处理它们，报告：
+- 吞吐：文档/分钟
+- 每个文档各阶段（preprocess / answer / fill / total）耗时的 p50、p99（来自 run.py --timings）
+- run.py 进程的峰值 RSS（批量模式下为进程树中最大的单个进程）
+- 模拟服务收到的请求数、错误数和最大并发
+
+用法：
+    python benchmarks/run_benchmark.py --sizes small medium --docs 4
+    python benchmarks/run_benchmark.py --sizes large --docs 8 --batch --latency lognormal:0.5:0.8 --error-rate 0.02
+    python benchmarks/run_benchmark.py --output bench.json                       # 保存结果
+    python benchmarks/run_benchmark.py --baseline bench.json --tolerance 0.2     # 与之前的结果比较，退化时退出码为 1
+    python benchmarks/run_benchmark.py --run-arg=--max-concurrent --run-arg=20   # 额外传给 run.py 的参数
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from make_questionnaire import SIZES, write_questionnaire
+from mock_fastgpt import start_server
+
+STAGES = ['preprocess', 'answer', 'fill', 'total']
+
+
+def percentile(values, q):
+    """最近秩百分位数（q 取 0~100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def run_pipeline(files, url, work_dir, batch=False, extra_args=()):
+    """
+    以子进程运行 run.py 处理 files。
+    Returns: (墙钟秒数, 峰值 RSS 字节数, 退出码, 每个文档的耗时记录)
+    """
+    timings_file = os.path.join(work_dir, 'timings.jsonl')
+    if os.path.exists(timings_file):
+        os.remove(timings_file)
+    command = [sys.executable, os.path.join(REPO_DIR, 'run.py'), *files,
+               '--no-cache', '--no-template-cache', '--timings', timings_file, *extra_args]
+    if batch:
+        command.append('--batch')
+    env = dict(os.environ, FASTGPT_URL=url, FASTGPT_API_KEY=os.environ.get('FASTGPT_API_KEY') or 'benchmark',
+               USE_CONFIG_MODE='false', JOB_JOURNAL_ENABLED='false')
+    log_path = os.path.join(work_dir, 'run.log')
+    start = time.perf_counter()
+    with open(log_path, 'w', encoding='utf-8') as log:
+        process = subprocess.Popen(command, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 返回子进程（包括它等待过的子进程）的资源使用，ru_maxrss 在 Linux 上以 KB 为单位
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    records = []
+    if os.path.exists(timings_file):
+        with open(timings_file, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    return elapsed, peak_rss, process.returncode, records
+
+
+def summarize(size, n_docs, elapsed, peak_rss, returncode, records, server_stats):
+    failed = sum(1 for record in records if record['error']) + max(0, n_docs - len(records))
+    stages = {}
+    for stage in STAGES:
+        values = [record['stages'][stage] for record in records if stage in record['stages']]
+        stages[stage] = {'p50': percentile(values, 50), 'p99': percentile(values, 99)}
+    return {
+        'size': size,
+        'documents': n_docs,
+        'failed': failed,
+        'returncode': returncode,
+        'elapsed_seconds': elapsed,
+        'documents_per_minute': n_docs / elapsed * 60 if elapsed else None,
+        'peak_rss_mb': peak_rss / 1e6,
+        'stages': stages,
+        'server': server_stats,
+    }
+
+
+def print_result(result):
+    print(f"\n=== {result['size']}: {result['documents']} 个文档，失败 {result['failed']} ===")
+    print(f"耗时 {result['elapsed_seconds']:.1f}s  吞吐 {result['documents_per_minute']:.1f} 文档/分钟  "
+          f"峰值 RSS {result['peak_rss_mb']:.0f} MB")
+    server = result['server']
+    print(f"模拟服务: 请求 {server['requests']}  错误 {server['errors']}  最大并发 {server['max_in_flight']}")
+    print(f"{'阶段':<12}{'p50 (s)':>10}{'p99 (s)':>10}")
+    for stage, values in result['stages'].items():
+        if values['p50'] is not None:
+            print(f"{stage:<12}{values['p50']:>10.2f}{values['p99']:>10.2f}")
+
+
+def compare(results, baseline, tolerance):
+    """吞吐下降或 p99 总耗时上升超过 tolerance 时返回退化项"""
+    previous = {result['size']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        before = previous.get(result['size'])
+        if before is None:
+            continue
+        if result['documents_per_minute'] < before['documents_per_minute'] * (1 - tolerance):
+            regressions.append(f"{result['size']}: 吞吐 {before['documents_per_minute']:.1f} → "
+                               f"{result['documents_per_minute']:.1f} 文档/分钟")
+        old_p99 = before['stages']['total']['p99']
+        new_p99 = result['stages']['total']['p99']
+        if old_p99 and new_p99 and new_p99 > old_p99 * (1 + tolerance):
+            regressions.append(f"{result['size']}: p99 总耗时 {old_p99:.2f}s → {new_p99:.2f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='端到端吞吐基准测试（本地模拟 FastGPT）')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'])
+    parser.add_argument('--docs', type=int, default=4, help='每种规模处理的文档数')
+    parser.add_argument('--batch', action='store_true', help='使用 run.py --batch 并发处理')
+    parser.add_argument('--latency', default='lognormal:0.3:0.5', help='模拟服务的延迟分布（见 mock_fastgpt.py）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='模拟服务返回错误的比例')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', default=None, help='使用已经启动的服务而不是内置的模拟服务')
+    parser.add_argument('--run-arg', action='append', default=[], help='额外传给 run.py 的参数（可重复）')
+    parser.add_argument('--output', default=None, help='把结果保存为 JSON')
+    parser.add_argument('--baseline', default=None, help='与之前保存的 JSON 结果比较')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='比较时允许的退化比例')
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        server = None
+        url = args.url
+        if url is None:
+            server = start_server(latency=args.latency, error_rate=args.error_rate,
+                                  error_status=args.error_status, seed=args.seed)
+            url = server.url
+        with tempfile.TemporaryDirectory() as work_dir:
+            files = [write_questionnaire(os.path.join(work_dir, f"questionnaire_{size}_{i + 1}.htm"), size, seed=i)
+                     for i in range(args.docs)]
+            elapsed, peak_rss, returncode, records = run_pipeline(files, url, work_dir, args.batch, args.run_arg)
+            if returncode != 0:
+                with open(os.path.join(work_dir, 'run.log'), 'r', encoding='utf-8', errors='replace') as f:
+                    print(f.read()[-2000:])
+        stats = server.state.stats() if server else {'requests': None, 'errors': None, 'max_in_flight': None}
+        if server:
+            server.shutdown()
+        result = summarize(size, args.docs, elapsed, peak_rss, returncode, records, stats)
+        print_result(result)
+        results.append(result)
+
+    report = {
+        'time': time.time(),
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\n✗ 性能退化：")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\n✓ 与基线相比没有退化")
+
+
+if __name__ == '__main__':
+    main()
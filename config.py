@@ -17,8 +17,94 @@ class Settings(BaseSettings):
     PROCESS_BOTH_STEPS: bool = True
     USE_CONFIG_MODE: bool = True
     QUESTION_NUMBER: int = 10
+    # 问题分批：每批的 token 预算（提示词 + 问题 + 预留的答案长度）和每批最多问题数
+    QUESTION_TOKEN_BUDGET: int = 6000
+    ANSWER_TOKENS_PER_QUESTION: int = 200
+    QUESTION_MAX_PER_BATCH: int = 30
+    # 小表格合并：每个请求中表格内容的 token 上限和最多表格（块）数
+    TABLE_PACK_TOKEN_BUDGET: int = 2000
+    TABLE_PACK_MAX_TABLES: int = 8
+    # 文档内的流水线：待发送任务队列的长度和工作协程数（0 表示取 FASTGPT_MAX_CONCURRENT 或全局并发上限）
+    PIPELINE_QUEUE_SIZE: int = 16
+    PIPELINE_WORKERS: int = 0
+    # 批次调度："longest_first" 在最近规划的 PIPELINE_SCHEDULE_WINDOW 个批次中先发送估算耗时最长的，
+    # 全局限流器也按估算耗时分配名额（多文档批量处理时相当于一个跨文档的优先队列）；"fifo" 按文档顺序发送。
+    # 两种方式都边扫描边发送；窗口为 0 时先规划整个文档再发送（排序最彻底，但扫描与调用不再重叠）
+    PIPELINE_SCHEDULE: str = "longest_first"
+    PIPELINE_SCHEDULE_WINDOW: int = 32
+    # 估算批次耗时：生成回答远比读入提示词慢，提示词 token 按该权重折算；表格每行另加预留的回答 token
+    SCHEDULE_PROMPT_TOKEN_WEIGHT: float = 0.1
+    SCHEDULE_TOKENS_PER_ROW: int = 10
+
+    # 在输出文件旁记录每个 FastGPT 批次的任务日志，供 --resume 断点续跑
+    JOB_JOURNAL_ENABLED: bool = True
+
+    # FastGPT HTTP 连接池与超时（秒）
+    FASTGPT_MAX_CONNECTIONS: int = 20
+    FASTGPT_MAX_KEEPALIVE: int = 20
+    FASTGPT_CONNECT_TIMEOUT: float = 10.0
+    # 单次请求（每次重试）的超时
+    FASTGPT_READ_TIMEOUT: float = 120.0
+    # 重试：最多尝试次数、指数退避的初始值和上限（秒）
+    FASTGPT_MAX_RETRIES: int = 3
+    FASTGPT_BACKOFF_BASE: float = 1.0
+    FASTGPT_BACKOFF_MAX: float = 30.0
+    # 单个文档所有 FastGPT 调用的总时限（秒），0 表示不限制
+    FASTGPT_DOCUMENT_DEADLINE: float = 0
+    # 流式模式：按 SSE 增量接收回答，边生成边解析并回填
+    FASTGPT_STREAM: bool = False
+    # 单个文档同时发出的 AI 请求数上限，0 表示只受全局限流器控制
+    FASTGPT_MAX_CONCURRENT: int = 0
+    # 全局限流器（所有文档共享）：自适应并发的上限、下限和初始值
+    FASTGPT_GLOBAL_CONCURRENCY: int = 20
+    FASTGPT_MIN_CONCURRENCY: int = 2
+    FASTGPT_INITIAL_CONCURRENCY: int = 10
+    # 延迟超过该值（秒）时不再增加并发，0 表示不看延迟
+    FASTGPT_LATENCY_TARGET: float = 60.0
+    # 每秒请求数和每分钟 token 数上限，0 表示不限制
+    FASTGPT_REQUESTS_PER_SECOND: float = 0
+    FASTGPT_TOKENS_PER_MINUTE: float = 0
+    # 对冲请求：请求发出后超过近期延迟的 FASTGPT_HEDGE_PERCENTILE 分位数仍未返回时再发一次，先返回的为准；
+    # 至少有 FASTGPT_HEDGE_MIN_SAMPLES 个延迟样本后才启用，对冲请求数不超过请求数的 FASTGPT_HEDGE_BUDGET 比例
+    FASTGPT_HEDGE_ENABLED: bool = False
+    FASTGPT_HEDGE_PERCENTILE: float = 95
+    FASTGPT_HEDGE_MIN_SAMPLES: int = 20
+    FASTGPT_HEDGE_MIN_DELAY: float = 1.0
+    FASTGPT_HEDGE_BUDGET: float = 0.1
+    # 合并进行中的相同请求：提示词相同的并发调用（同一文档内或批量处理的多个文档之间）共用一次请求
+    FASTGPT_COALESCE_ENABLED: bool = True
+    # FastGPT 应用标识（同一个 URL 下区分不同应用/模型，参与缓存键计算）
+    FASTGPT_APP_ID: str = ""
+
+    # FastGPT 答案缓存（SQLite），TTL 单位为秒，0 表示永不过期
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_PATH: Path = BASE_DIR / ".cache" / "fastgpt_answers.sqlite3"
+    ANSWER_CACHE_TTL: float = 7 * 24 * 3600
+    ANSWER_CACHE_MAX_ENTRIES: int = 20000
+
+    # 模板结构缓存：同一模板的预处理结果、问题、表格范围和表格块只计算一次
+    TEMPLATE_CACHE_ENABLED: bool = True
+    TEMPLATE_CACHE_DIR: Path = BASE_DIR / ".cache" / "templates"
+
+    # 批量模式下预处理进程池的大小，0 表示使用 CPU 核数
+    BATCH_WORKERS: int = 0
+    # 批量模式下同时处理的文档数
+    BATCH_MAX_DOCUMENTS: int = 8
+
+    # 编码检测最多采样的非 ASCII 字节数
+    ENCODING_SAMPLE_BYTES: int = 256 * 1024
+
+    # token 计数缓存的最大条目数（表格行、表头、空行大量重复）
+    TOKEN_COUNT_CACHE_SIZE: int = 50000
+
+    # 运行指标：每次运行结束时在 METRICS_REPORT_DIR 写出 run_report.json 和 metrics.prom
+    METRICS_ENABLED: bool = True
+    METRICS_REPORT_DIR: Path = BASE_DIR / "reports"
+    # 每 1K token 的价格，用于在报告中估算费用（0 表示不估算）
+    FASTGPT_PROMPT_PRICE: float = 0
+    FASTGPT_COMPLETION_PRICE: float = 0
 
     class Config:
         env_file = ".env"
 
-settings = Settings()
\ No newline at end of file
+settings = Settings()
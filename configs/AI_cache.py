@@ -0,0 +1,127 @@
+"""
+FastGPT 答案缓存
+
+以 (FastGPT URL, 应用标识, 提示词全文) 的哈希为键，把答案保存在本地 SQLite 中。
+同一模板、同一公司重复运行时，相同的提示词直接返回缓存的答案，不再调用 API。
+支持 TTL 过期和按最近访问时间的 LRU 容量淘汰。
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+from config import settings
+from configs import metrics
+
+logger = logging.getLogger(__name__)
+
+_enabled = settings.ANSWER_CACHE_ENABLED
+_cache = None
+
+
+def app_identity() -> str:
+    """FastGPT 应用标识：配置的 APP_ID 加上 API key 的哈希（不保存明文 key）"""
+    key_hash = hashlib.sha256(settings.FASTGPT_API_KEY.encode('utf-8')).hexdigest()[:16]
+    return f"{settings.FASTGPT_APP_ID}:{key_hash}"
+
+
+def prompt_hash(prompt: str, url: str = None) -> str:
+    """计算缓存键：提示词全文 + FastGPT URL + 应用标识"""
+    payload = json.dumps(
+        [url if url is not None else settings.FASTGPT_URL, app_identity(), prompt],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnswerCache:
+    def __init__(self, path, ttl: float = 0, max_entries: int = 0):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, answer TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_accessed ON answers (accessed)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, created FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            answer, created = row
+            if self.ttl and now - created > self.ttl:
+                self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute("UPDATE answers SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return answer
+
+    def put(self, key: str, answer: str):
+        now = time.time()
+        with metrics.span('answer_cache_write', category='io'), self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, answer, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, answer, now, now),
+            )
+            if self.max_entries:
+                # LRU：只保留最近访问的 max_entries 条
+                self._conn.execute(
+                    "DELETE FROM answers WHERE key IN ("
+                    "SELECT key FROM answers ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def set_enabled(enabled: bool):
+    """运行时开关缓存（run.py 的 --no-cache）"""
+    global _enabled
+    _enabled = enabled
+
+
+def get_answer_cache() -> Optional[AnswerCache]:
+    """返回进程内共享的缓存实例；缓存被关闭时返回 None"""
+    global _cache
+    if not _enabled:
+        return None
+    if _cache is None:
+        _cache = AnswerCache(
+            settings.ANSWER_CACHE_PATH,
+            ttl=settings.ANSWER_CACHE_TTL,
+            max_entries=settings.ANSWER_CACHE_MAX_ENTRIES,
+        )
+    return _cache
+
+
+def clear_answer_cache():
+    """清空磁盘上的答案缓存（即使当前运行关闭了缓存）"""
+    cache = _cache if _cache is not None else AnswerCache(settings.ANSWER_CACHE_PATH)
+    cache.clear()
+    logger.info(f"Cleared FastGPT answer cache at {cache.path}")
@@ -3,8 +3,19 @@ from config import settings
 import logging
 from typing import Optional
 import json
-import requests
+import httpx
+import random
 import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from configs.AI_cache import get_answer_cache, prompt_hash
+from configs import metrics
+from configs.rate_limiter import (
+    FastGPTLimiter, HedgePolicy, estimate_tokens, OUTCOME_OK, OUTCOME_THROTTLED,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +27,77 @@ logging.basicConfig(
 FASTGPT_API_KEY = settings.FASTGPT_API_KEY
 url = settings.FASTGPT_URL
 
+# 共享的连接池客户端（与创建它的事件循环绑定）
+_client: Optional[httpx.AsyncClient] = None
+_client_loop = None
+# 进程级的并发预算：所有文档的 AI 请求共用一个自适应限流器
+_global_concurrency = settings.FASTGPT_GLOBAL_CONCURRENCY
+_limiter: Optional[FastGPTLimiter] = None
+# 进行中的请求：缓存键 -> _Flight（只在内存中，请求完成即移除）
+_flights = {}
+
+
+def set_global_concurrency(limit: int):
+    """设置进程级并发上限，在下一次创建客户端时生效"""
+    global _global_concurrency
+    _global_concurrency = limit
+
+
+def get_limiter() -> FastGPTLimiter:
+    get_client()
+    return _limiter
+
+
+def init_client(transport=None) -> httpx.AsyncClient:
+    """
+    为当前事件循环创建共享的 keep-alive 客户端。
+    所有 call_fastgpt 调用复用同一个连接池，因此并发的批次会真正同时发出。
+    """
+    global _client, _client_loop, _limiter
+    limits = httpx.Limits(
+        max_connections=settings.FASTGPT_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.FASTGPT_MAX_KEEPALIVE,
+    )
+    # pool=None: 连接池满时排队等待，而不是抛出 PoolTimeout
+    timeout = httpx.Timeout(
+        settings.FASTGPT_READ_TIMEOUT,
+        connect=settings.FASTGPT_CONNECT_TIMEOUT,
+        pool=None,
+    )
+    _client = httpx.AsyncClient(limits=limits, timeout=timeout, transport=transport)
+    _client_loop = asyncio.get_running_loop()
+    _limiter = FastGPTLimiter(
+        requests_per_second=settings.FASTGPT_REQUESTS_PER_SECOND,
+        tokens_per_minute=settings.FASTGPT_TOKENS_PER_MINUTE,
+        initial_concurrency=min(settings.FASTGPT_INITIAL_CONCURRENCY, _global_concurrency),
+        min_concurrency=settings.FASTGPT_MIN_CONCURRENCY,
+        max_concurrency=_global_concurrency,
+        latency_target=settings.FASTGPT_LATENCY_TARGET,
+        hedge=HedgePolicy(
+            percentile=settings.FASTGPT_HEDGE_PERCENTILE,
+            budget=settings.FASTGPT_HEDGE_BUDGET,
+            min_samples=settings.FASTGPT_HEDGE_MIN_SAMPLES,
+            min_delay=settings.FASTGPT_HEDGE_MIN_DELAY,
+        ) if settings.FASTGPT_HEDGE_ENABLED else None,
+    )
+    return _client
+
+
+def get_client() -> httpx.AsyncClient:
+    """返回当前事件循环的共享客户端，必要时重新创建（每次 asyncio.run 都是新的循环）"""
+    if _client is None or _client.is_closed or _client_loop is not asyncio.get_running_loop():
+        return init_client()
+    return _client
+
+
+async def close_client():
+    """关闭共享客户端，释放连接池；应在事件循环结束前调用"""
+    global _client, _client_loop
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.aclose()
+    _client = None
+    _client_loop = None
+
 
 async def extract_answer(response_json):
     content = response_json.get('choices', [{}])[0].get('message', {}).get('content', '')
@@ -30,27 +112,401 @@ async def extract_answer(response_json):
         return data_rows[0]  # Return the first real answer
     return content
 
-async def call_fastgpt(messages, retries=3, **kwargs):
+class FastGPTError(Exception):
+    """一次 FastGPT 请求失败；retryable 表示可以重试（超时、429、5xx、网络错误）"""
+
+    def __init__(self, message, retryable=False, retry_after: Optional[float] = None, status_code=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After（秒数或 HTTP 日期）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """带随机抖动的指数退避（full jitter）；服务端给出 Retry-After 时以其为下限"""
+    cap = min(settings.FASTGPT_BACKOFF_MAX, settings.FASTGPT_BACKOFF_BASE * (2 ** attempt))
+    delay = random.uniform(0, cap)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, settings.FASTGPT_BACKOFF_MAX))
+    return delay
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar("fastgpt_deadline", default=None)
+
+
+@contextmanager
+def document_deadline(seconds: Optional[float]):
+    """
+    为当前文档的所有 FastGPT 调用设置总截止时间（秒）。
+    在 with 块中创建的任务（asyncio.gather / create_task）会继承该截止时间。
+    """
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def deadline_remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def _headers():
+    return {
+        "Authorization": f"Bearer {FASTGPT_API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+
+def _check_status(response, slot):
+    """按 HTTP 状态码分类错误（流式响应需先读取 body）"""
+    status = response.status_code
+    if status == 429 or status >= 500:
+        slot.record(OUTCOME_THROTTLED)
+        raise FastGPTError(
+            f"HTTP {status}", retryable=True, status_code=status,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+    if status == 408:
+        raise FastGPTError(f"HTTP {status}", retryable=True, status_code=status)
+    if not response.is_success:
+        # 401/403/400 等：鉴权或请求内容有误，重试没有意义
+        raise FastGPTError(f"HTTP {status}: {response.text[:200]}", retryable=False, status_code=status)
+
+
+def parse_sse_delta(line: str):
+    """
+    解析一行 SSE：返回增量文本；遇到 [DONE] 返回 None；其它行（空行、event:、注释）返回 ''。
+    """
+    if not line.startswith('data:'):
+        return ''
+    payload = line[5:].strip()
+    if payload == '[DONE]':
+        return None
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logger.warning(f"Skipping malformed SSE line: {line[:200]}")
+        return ''
+    choices = event.get('choices') or [{}]
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+
+def _clip_to_deadline(attempt_timeout: float) -> float:
+    """把一次请求的超时截断到文档截止时间；已经超过截止时间时抛出不可重试的 FastGPTError"""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return attempt_timeout
+    if remaining <= 0:
+        raise FastGPTError("document deadline exceeded", retryable=False)
+    return min(attempt_timeout, remaining)
+
+
+def _attempt_timeout(attempt_timeout: float) -> httpx.Timeout:
+    return httpx.Timeout(attempt_timeout, connect=min(settings.FASTGPT_CONNECT_TIMEOUT, attempt_timeout), pool=None)
+
+
+async def _stream_once(client, limiter, data, prompt_tokens, attempt_timeout, on_delta=None, acquired=None):
+    """以 SSE 流式发送一次请求，每收到一段增量就交给 on_delta；返回完整文本"""
+    parts = []
+
+    async def read_stream(slot, timeout):
+        async with client.stream("POST", url, headers=_headers(), json=data, timeout=timeout) as response:
+            if not response.is_success:
+                await response.aread()
+            _check_status(response, slot)
+            async for line in response.aiter_lines():
+                delta = parse_sse_delta(line)
+                if delta is None:
+                    break
+                if delta:
+                    parts.append(delta)
+                    if on_delta is not None:
+                        on_delta(delta)
+
+    try:
+        # 在限流器中排队的时间也计入文档截止时间
+        async with limiter.slot(prompt_tokens, acquired, timeout=deadline_remaining()) as slot:
+            # 排队之后剩余的时间可能已经不足 attempt_timeout
+            attempt_timeout = _clip_to_deadline(attempt_timeout)
+            try:
+                # 与非流式请求一致，attempt_timeout 限制整个回答的时间
+                await asyncio.wait_for(read_stream(slot, _attempt_timeout(attempt_timeout)), attempt_timeout)
+            except (httpx.TimeoutException, asyncio.TimeoutError) as e:
+                slot.record(OUTCOME_THROTTLED)
+                raise FastGPTError(f"timeout after {attempt_timeout:.1f}s: {e!r}", retryable=True) from e
+            except httpx.TransportError as e:
+                raise FastGPTError(f"transport error: {e!r}", retryable=True) from e
+            slot.record(OUTCOME_OK)
+    except asyncio.TimeoutError as e:
+        raise FastGPTError("document deadline exceeded while waiting for a FastGPT slot") from e
+    return ''.join(parts)
+
+
+async def _post_once(client, limiter, data, prompt_tokens, attempt_timeout, acquired=None):
+    """发送一次请求并分类错误；成功时返回响应 JSON"""
+    headers = _headers()
+    try:
+        # 在限流器中排队的时间也计入文档截止时间
+        async with limiter.slot(prompt_tokens, acquired, timeout=deadline_remaining()) as slot:
+            attempt_timeout = _clip_to_deadline(attempt_timeout)
+            try:
+                # httpx 的超时只限制单次读写，attempt_timeout 限制整个请求
+                response = await asyncio.wait_for(
+                    client.post(url, headers=headers, json=data, timeout=_attempt_timeout(attempt_timeout)),
+                    attempt_timeout)
+            except (httpx.TimeoutException, asyncio.TimeoutError) as e:
+                slot.record(OUTCOME_THROTTLED)
+                raise FastGPTError(f"timeout after {attempt_timeout:.1f}s: {e!r}", retryable=True) from e
+            except httpx.TransportError as e:
+                raise FastGPTError(f"transport error: {e!r}", retryable=True) from e
+            _check_status(response, slot)
+            try:
+                payload = response.json()
+            except ValueError as e:
+                raise FastGPTError(f"invalid JSON response: {response.text[:200]}", retryable=True) from e
+            slot.record(OUTCOME_OK)
+    except asyncio.TimeoutError as e:
+        raise FastGPTError("document deadline exceeded while waiting for a FastGPT slot") from e
+    return payload
+
+
+async def _send(client, limiter, data, prompt_tokens, attempt_timeout, on_delta=None, acquired=None):
+    """发送一次请求；流式回答拼成与非流式相同的响应结构"""
+    if data["stream"]:
+        content = await _stream_once(client, limiter, data, prompt_tokens, attempt_timeout, on_delta, acquired)
+        return {"choices": [{"message": {"content": content}}]}
+    return await _post_once(client, limiter, data, prompt_tokens, attempt_timeout, acquired)
+
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _send_hedged(client, limiter, data, prompt_tokens, attempt_timeout, on_delta=None):
+    """
+    对冲请求（FASTGPT_HEDGE_ENABLED）：主请求发出后超过近期延迟的分位数仍未返回，且预算允许时，
+    再发一次同样的请求，先成功返回的为准，另一个被取消。
+    流式模式下对冲请求不转发增量；它胜出时先 on_delta(None) 作废主请求的增量，再交出完整答案。
+    """
+    hedge = limiter.hedge
+    delay = hedge.delay() if hedge is not None else None
+    if delay is None:
+        if hedge is not None:
+            hedge.record_request()
+        return await _send(client, limiter, data, prompt_tokens, attempt_timeout, on_delta)
+    hedge.record_request()
+    acquired = asyncio.Event()
+    primary = asyncio.create_task(_send(client, limiter, data, prompt_tokens, attempt_timeout, on_delta, acquired))
+    tasks = [primary]
+    try:
+        # 在限流器中排队的时间不算延迟：从主请求取得名额开始计时
+        waiter = asyncio.create_task(acquired.wait())
+        tasks.append(waiter)
+        await asyncio.wait([primary, waiter], return_when=asyncio.FIRST_COMPLETED)
+        if not primary.done():
+            await asyncio.wait([primary], timeout=delay)
+        if primary.done() or not hedge.try_acquire():
+            return await primary
+        logger.info(f"FastGPT request still pending after {delay:.1f}s; sending hedge request.")
+        metrics.inc('fastgpt_hedges_total')
+        backup = asyncio.create_task(_send(client, limiter, data, prompt_tokens, attempt_timeout))
+        tasks.append(backup)
+        pending = {primary, backup}
+        errors = {}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    errors[task] = task.exception()
+                    continue
+                payload = task.result()
+                if task is backup:
+                    metrics.inc('fastgpt_hedge_wins_total')
+                    if data["stream"] and on_delta is not None:
+                        on_delta(None)
+                        on_delta(payload["choices"][0]["message"]["content"])
+                return payload
+        # 两个请求都失败：按主请求的错误处理（是否重试）
+        raise errors.get(primary) or errors[backup]
+    finally:
+        await _cancel([task for task in tasks if not task.done()])
+
+
+async def call_fastgpt(messages, retries: Optional[int] = None, timeout: Optional[float] = None,
+                       on_delta=None, **kwargs):
+    """
+    调用 FastGPT 并返回答案文本。
+    可重试的错误（超时、429、5xx、网络错误）按指数退避重试，遵守 Retry-After；
+    不可重试的错误（401、400 等）或超过文档截止时间时立即放弃并返回 None。
+    on_delta: 接收回答文本。流式模式（FASTGPT_STREAM）下每收到一段增量调用一次，
+        重试前调用 on_delta(None) 表示之前的增量作废；非流式或命中缓存时以完整答案调用一次。
+        成功时最后一次 on_delta(None) 之后的增量拼起来就是返回的答案。
+    """
+    cache = get_answer_cache()
+    cache_key = prompt_hash(f"{messages}", url)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        metrics.inc('answer_cache_requests_total', result='hit' if cached is not None else 'miss')
+        if cached is not None:
+            logger.info("FastGPT answer served from cache.")
+            metrics.inc('fastgpt_calls_total', result='cache_hit')
+            if on_delta is not None:
+                on_delta(cached)
+            return cached
+    if not settings.FASTGPT_COALESCE_ENABLED:
+        return await _fetch(messages, cache, cache_key, retries, timeout, on_delta)
+    return await _coalesce(cache_key, lambda: _fetch(messages, cache, cache_key, retries, timeout, on_delta), on_delta)
+
+
+class _Flight:
+    """一个进行中的请求和等待它的调用方数量"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+async def _coalesce(key: str, fetch, on_delta=None):
+    """
+    single-flight：同一事件循环中键相同的并发调用共用一个请求任务。
+    第一个调用方发起请求（流式增量只交给它）；之后的调用方等待同一个任务，
+    完成后以完整答案调用一次 on_delta（与命中缓存相同）。
+    请求在单独的任务中运行，某个调用方被取消不影响其他调用方；所有调用方都取消时请求才被取消。
+    请求任务复制的是第一个调用方的上下文：截止时间、限流优先级（call_priority）和指标所属的文档都取自它。
+    之后的调用方只按自己的截止时间等待，超时后放弃等待并返回 None（请求本身继续为其他调用方运行）。
+    """
+    flight = _flights.get(key)
+    if flight is not None and flight.task.get_loop() is not asyncio.get_running_loop():
+        flight = None
+    leader = flight is None
+    if leader:
+        flight = _Flight(asyncio.create_task(fetch()))
+        _flights[key] = flight
+        flight.task.add_done_callback(lambda _: _flights.pop(key, None) if _flights.get(key) is flight else None)
+    else:
+        logger.info("Identical FastGPT request already in flight; waiting for its answer.")
+        metrics.inc('fastgpt_calls_total', result='coalesced')
+    remaining = None if leader else deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        logger.error("FastGPT call abandoned: document deadline exceeded.")
+        return None
+    flight.waiters += 1
+    try:
+        result = await asyncio.wait_for(asyncio.shield(flight.task), remaining)
+    except asyncio.TimeoutError:
+        logger.error("FastGPT call abandoned: document deadline exceeded while waiting for an identical request.")
+        return None
+    finally:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+    if not leader and on_delta is not None and result:
+        on_delta(result)
+    return result
+
+
+async def _fetch(messages, cache, cache_key, retries, timeout, on_delta=None):
+    """实际发送请求（带重试），成功时写入答案缓存"""
+    stream = settings.FASTGPT_STREAM
+    data = {
+        "chatId": "000",
+        "stream": stream,
+        "detail": False,
+        "messages": [
+            {
+                "role": "user",
+                "content": f"{messages}"
+            }
+        ]
+    }
+    with metrics.span('fastgpt_call', category='call'):
+        result = await _call_with_retries(data, retries or settings.FASTGPT_MAX_RETRIES, timeout, on_delta)
+    metrics.inc('fastgpt_calls_total', result='ok' if result else 'failed')
+    if cache is not None and result:
+        cache.put(cache_key, result)
+    if not stream and on_delta is not None and result:
+        on_delta(result)
+    return result
+
+
+async def _call_with_retries(data, retries: int, timeout: Optional[float], on_delta=None):
+    """按 call_fastgpt 的重试规则发送请求，返回答案文本或 None"""
+    client = get_client()
+    limiter = _limiter
+    prompt = data["messages"][0]["content"]
+    prompt_tokens = estimate_tokens(prompt)
+    stream = data["stream"]
     for attempt in range(retries):
+        attempt_timeout = timeout or settings.FASTGPT_READ_TIMEOUT
+        remaining = deadline_remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                logger.error("FastGPT call abandoned: document deadline exceeded.")
+                return None
+            attempt_timeout = min(attempt_timeout, remaining)
         try:
-            headers = {
-                "Authorization": f"Bearer {FASTGPT_API_KEY}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "chatId": "000",
-                "stream": False,
-                "detail": False,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": f"{messages}"
-                    }
-                ]
-            }
-            response = requests.post(url, headers=headers, json=data)
-            result = await extract_answer(response.json())
-            return result
-        except Exception as e:
-            logger.error(f"Error calling FastGPT: {e}")
+            with metrics.span('fastgpt_attempt', category='http', attempt=attempt + 1):
+                if stream and attempt and on_delta is not None:
+                    on_delta(None)
+                payload = await _send_hedged(client, limiter, data, prompt_tokens, attempt_timeout, on_delta)
+            try:
+                result = await extract_answer(payload)
+            except (AttributeError, IndexError, TypeError) as e:
+                raise FastGPTError(f"unexpected response payload: {str(payload)[:200]}", retryable=True) from e
+            if stream and on_delta is not None and result != payload["choices"][0]["message"]["content"]:
+                # extract_answer 改写了回答（Markdown 表格）：增量作废，以最终答案为准
+                on_delta(None)
+                on_delta(result)
+        except FastGPTError as e:
+            metrics.inc('fastgpt_requests_total', outcome='retryable_error' if e.retryable else 'error')
+            if not e.retryable:
+                logger.error(f"Error calling FastGPT (not retryable): {e}")
+                return None
+            if attempt + 1 >= retries:
+                logger.error(f"Error calling FastGPT, giving up after {retries} attempts: {e}")
+                return None
+            delay = backoff_delay(attempt, e.retry_after)
+            remaining = deadline_remaining()
+            if remaining is not None and delay >= remaining:
+                logger.error(f"Error calling FastGPT, no time left before document deadline: {e}")
+                return None
+            logger.warning(f"Error calling FastGPT (attempt {attempt + 1}/{retries}): {e}; retrying in {delay:.1f}s")
+            metrics.inc('fastgpt_retries_total')
+            await asyncio.sleep(delay)
+            continue
+        metrics.inc('fastgpt_requests_total', outcome='ok')
+        record_usage(payload, prompt, result)
+        return result
     return None
+
+
+def record_usage(payload, prompt: str, result: Optional[str]):
+    """记录一次成功请求的 token 数：优先使用响应中的 usage，流式或没有 usage 时估算"""
+    usage = payload.get('usage') if isinstance(payload, dict) else None
+    if isinstance(usage, dict) and 'prompt_tokens' in usage:
+        metrics.record_tokens(usage.get('prompt_tokens') or 0, usage.get('completion_tokens') or 0)
+    else:
+        metrics.record_tokens(estimate_tokens(prompt), estimate_tokens(result or ''))
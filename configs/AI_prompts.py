@@ -2,14 +2,15 @@ from config import settings
 
 QUESTION_NUMBER = settings.QUESTION_NUMBER
 
-FASTGPT_PROMPT = f"""
+# {question_number} 为本批问题的数量，由 build_fastgpt_prompt 填入
+FASTGPT_PROMPT_TEMPLATE = """
 任务目标：填写海南盖亚青柯私募基金管理有限公司的尽职调查问卷，按章节顺序逐步完成所有空白字段的填写  
 
 你必须区分以下两种情况：
 
 1. 我给你一个提问列表，比如：
 {{238: '表格  SEQ 表格 \* ARABIC 2:联系方式', 270: '2.   请说明公司整体的优势和劣势分别是什么，以及维持优势的关键因素。', 273: '3.   请说明公司近三年的基本财务状况（万元）。', 378: '4.   请填写下表的股权结构（须穿透至实际控制人）。'}}
-前面的数字是行数，后面的文字是问题（我会给你{QUESTION_NUMBER}个问题）。
+前面的数字是行数，后面的文字是问题（我会给你{question_number}个问题）。
 
 
 2. 我给你一个简化过的需要填写的表格（通过 <tr>...</tr> 标签表示）。
@@ -21,7 +22,7 @@ e.g. 输入
 2. 如果问题是开放性的、或者没有提供原始数据，或者没有足够信息已回答，请基于常见私募基金管理公司的情况自动生成合理答案，不要留下空白或填“=”。然后，在答案的最后面加一个括号：“（请根据实际情况填写）”
 3. 如果问题中包含很多子问题，你必须细致回答每一个能回答的问题。
 4. 最后按照以下格式分隔然后输出，使用符号 ||| 分隔答案（中间不加空格）：
-"答案1|||答案2|||答案3|||...|||答案{QUESTION_NUMBER}"
+"答案1|||答案2|||答案3|||...|||答案{question_number}"
 
 不要用1. 2. 3. 等序号。严格按照我给你的格式回答
 
@@ -46,6 +47,24 @@ e.g. 输出
 真正输入：
 """
 
+
+def build_fastgpt_prompt(question_number=QUESTION_NUMBER):
+    """生成提示词，其中声明的问题数量与本批实际问题数一致"""
+    return FASTGPT_PROMPT_TEMPLATE.format(question_number=question_number)
+
+
+FASTGPT_PROMPT = build_fastgpt_prompt(QUESTION_NUMBER)
+
+# 多个小表格合并到一个请求时，附加在 FASTGPT_PROMPT 之后
+TABLE_PACK_NOTE_TEMPLATE = """
+本次输入包含{table_count}个相互独立的表格，每个表格以“==== 表格 k 开始 ====”开头、以“==== 表格 k 结束 ====”结尾。
+请按第二种情况分别填写每个表格，按原顺序输出，并保留分隔行和每一行的绝对编码。
+"""
+
+
+def build_table_pack_note(table_count):
+    return TABLE_PACK_NOTE_TEMPLATE.format(table_count=table_count)
+
 ERROR_PROMPT = f"""
 按以下规则填写表格, 识别表格中的问题格式, 识别表格的格式, 按照表格格式填写内容。
 
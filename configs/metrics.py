@@ -0,0 +1,362 @@
+"""
+运行指标：阶段耗时、计数器和运行报告
+
+- span(stage) / @timed(stage)：记录一个阶段的耗时到 stage_seconds 直方图（预处理、简化、表格切块、
+  每次 FastGPT 调用和 HTTP 尝试、回填等）
+- inc(name, value, **labels)：计数器（token 数、请求数、重试次数、缓存命中等）
+- use_document(name)：在 with 块中（包括其中创建的任务）记录的指标同时计入该文档，报告中按文档列出
+- 运行结束时 write_reports() 写出 JSON 报告和 Prometheus 文本格式文件
+
+批量模式下预处理和回填在进程池中运行：用 call_in_worker 包装，子进程中的指标（和时间线事件）随结果一起带回主进程合并。
+"""
+
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from config import settings
+from configs import trace
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'fileprocessing_'
+
+# 耗时直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = 'stage_seconds'
+DOCUMENT_SECONDS = 'document_seconds'
+
+# Prometheus 的 # HELP 说明
+DESCRIPTIONS = {
+    STAGE_SECONDS: 'Duration of pipeline stages in seconds',
+    DOCUMENT_SECONDS: 'Per-document duration of run.py stages in seconds',
+    'documents_total': 'Documents processed, by status',
+    'fastgpt_calls_total': 'call_fastgpt invocations, by result',
+    'fastgpt_requests_total': 'FastGPT HTTP attempts, by outcome',
+    'fastgpt_retries_total': 'FastGPT attempts that were retried',
+    'fastgpt_prompt_tokens_total': 'Prompt tokens of successful FastGPT requests',
+    'fastgpt_completion_tokens_total': 'Completion tokens of successful FastGPT requests',
+    'fastgpt_cost_total': 'Estimated FastGPT cost (FASTGPT_PROMPT_PRICE / FASTGPT_COMPLETION_PRICE per 1K tokens)',
+    'answer_cache_requests_total': 'FastGPT answer cache lookups, by result',
+    'template_cache_requests_total': 'Template cache lookups, by kind and result',
+    'journal_replays_total': 'FastGPT batches replayed from the job journal',
+}
+
+_enabled = settings.METRICS_ENABLED
+_document: ContextVar[Optional[str]] = ContextVar("metrics_document", default=None)
+
+
+def set_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def percentile(values, q):
+    """最近秩百分位数（q 取 0~100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.counters = {}
+            # 直方图保存全部样本（一次运行最多几万个），报告时计算分位数和分桶
+            self.samples = {}
+            self.documents = {}
+
+    def _document_entry(self, document):
+        return self.documents.setdefault(document, {'stages': {}, 'counters': {}})
+
+    def inc(self, name, value=1, document=None, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if document is not None:
+                counters = self._document_entry(document)['counters']
+                doc_key = ':'.join([name, *(str(v) for _, v in key[1])])
+                counters[doc_key] = counters.get(doc_key, 0) + value
+
+    def observe(self, name, value, document=None, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.samples.setdefault(key, []).append(value)
+            if document is not None and 'stage' in labels:
+                stages = self._document_entry(document)['stages']
+                stages[labels['stage']] = stages.get(labels['stage'], 0) + value
+
+    def snapshot(self) -> dict:
+        """可 pickle 的副本（供子进程带回主进程）"""
+        with self._lock:
+            return {
+                'counters': list(self.counters.items()),
+                'samples': [(key, list(values)) for key, values in self.samples.items()],
+                'documents': json.loads(json.dumps(self.documents)),
+            }
+
+    def merge(self, snapshot: dict):
+        with self._lock:
+            for key, value in snapshot['counters']:
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in snapshot['samples']:
+                self.samples.setdefault(key, []).extend(values)
+            for document, entry in snapshot['documents'].items():
+                target = self._document_entry(document)
+                for section in ('stages', 'counters'):
+                    for name, value in entry[section].items():
+                        target[section][name] = target[section].get(name, 0) + value
+
+    def counter(self, name, **labels) -> float:
+        """某个计数器的值；不给 labels 时对所有 labels 求和"""
+        with self._lock:
+            if labels:
+                return self.counters.get(_key(name, labels), 0)
+            return sum(value for (n, _), value in self.counters.items() if n == name)
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    return _metrics
+
+
+def current_document() -> Optional[str]:
+    return _document.get()
+
+
+@contextmanager
+def use_document(name: Optional[str]):
+    """with 块中记录的指标同时计入文档 name"""
+    token = _document.set(name)
+    try:
+        yield
+    finally:
+        _document.reset(token)
+
+
+def inc(name, value=1, **labels):
+    if _enabled:
+        _metrics.inc(name, value, document=_document.get(), **labels)
+
+
+def observe(name, value, **labels):
+    if _enabled:
+        _metrics.observe(name, value, document=_document.get(), **labels)
+
+
+@contextmanager
+def span(stage, name=STAGE_SECONDS, category='stage', **tags):
+    """记录 with 块的耗时（出错时也记录）；开启 --trace 时同时记录为时间线事件，tags 为事件的标记"""
+    start = time.perf_counter()
+    with trace.event(stage, category, _document.get(), **tags):
+        try:
+            yield
+        finally:
+            observe(name, time.perf_counter() - start, stage=stage)
+
+
+def timed(stage, category='stage'):
+    """装饰器：把函数（同步或 async）的每次调用记录为一个阶段"""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage, category=category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, category=category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_tokens(prompt_tokens, completion_tokens):
+    inc('fastgpt_prompt_tokens_total', prompt_tokens)
+    inc('fastgpt_completion_tokens_total', completion_tokens)
+    cost = (prompt_tokens * settings.FASTGPT_PROMPT_PRICE + completion_tokens * settings.FASTGPT_COMPLETION_PRICE) / 1000
+    if cost:
+        inc('fastgpt_cost_total', cost)
+
+
+def worker_context(document):
+    """在主进程中取得进程池任务的上下文（spawn 启动的子进程不会继承运行时的开关）"""
+    return document, _enabled, trace.is_enabled()
+
+
+def call_in_worker(context, func, *args):
+    """
+    进程池入口：在子进程中以 use_document(document) 运行 func，
+    返回 (func 的结果, 本次调用记录的指标和时间线事件)；主进程用 merge() 合并。
+    """
+    document, enabled, tracing = context
+    set_enabled(enabled)
+    trace.set_enabled(tracing)
+    _metrics.reset()
+    trace.reset()
+    with use_document(document):
+        result = func(*args)
+    snapshot = _metrics.snapshot()
+    snapshot['trace'] = trace.drain()
+    return result, snapshot
+
+
+def merge(snapshot: dict):
+    _metrics.merge(snapshot)
+    trace.merge(snapshot.get('trace'))
+
+
+def reset():
+    _metrics.reset()
+
+
+def _summarize(values):
+    return {
+        'count': len(values),
+        'sum': sum(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def _hit_rate(hits, misses):
+    total = hits + misses
+    return hits / total if total else None
+
+
+def _ratio(part, total):
+    return part / total if total else None
+
+
+def build_report() -> dict:
+    """JSON 运行报告"""
+    snapshot = _metrics.snapshot()
+    histograms = {}
+    for (name, labels), values in snapshot['samples']:
+        label = ','.join(str(v) for _, v in labels) or name
+        histograms.setdefault(name, {})[label] = _summarize(values)
+    counters = {f"{name}{_format_labels(labels)}": value for (name, labels), value in snapshot['counters']}
+    template_rates = {}
+    for kind in ('preprocess', 'structure'):
+        rate = _hit_rate(_metrics.counter('template_cache_requests_total', kind=kind, result='hit'),
+                         _metrics.counter('template_cache_requests_total', kind=kind, result='miss'))
+        if rate is not None:
+            template_rates[kind] = rate
+    return {
+        'started': _metrics.started,
+        'finished': time.time(),
+        'wall_seconds': time.time() - _metrics.started,
+        'stages': histograms.get(STAGE_SECONDS, {}),
+        'document_stages': histograms.get(DOCUMENT_SECONDS, {}),
+        'tokens': {
+            'prompt': _metrics.counter('fastgpt_prompt_tokens_total'),
+            'completion': _metrics.counter('fastgpt_completion_tokens_total'),
+            'cost': _metrics.counter('fastgpt_cost_total'),
+        },
+        'fastgpt': {
+            'calls': _metrics.counter('fastgpt_calls_total'),
+            'requests': _metrics.counter('fastgpt_requests_total'),
+            'retries': _metrics.counter('fastgpt_retries_total'),
+            'failed_calls': _metrics.counter('fastgpt_calls_total', result='failed'),
+        },
+        # 与进行中的相同请求合并、没有单独发送的调用
+        'coalescing': {
+            'coalesced_calls': _metrics.counter('fastgpt_calls_total', result='coalesced'),
+            'rate': _ratio(_metrics.counter('fastgpt_calls_total', result='coalesced'),
+                           _metrics.counter('fastgpt_calls_total')),
+        },
+        'hedging': {
+            'hedges': _metrics.counter('fastgpt_hedges_total'),
+            'wins': _metrics.counter('fastgpt_hedge_wins_total'),
+            # 对冲请求占请求数的比例、对冲请求先返回的比例
+            'hedge_rate': _ratio(_metrics.counter('fastgpt_hedges_total'), _metrics.counter('fastgpt_requests_total')),
+            'win_rate': _ratio(_metrics.counter('fastgpt_hedge_wins_total'), _metrics.counter('fastgpt_hedges_total')),
+        },
+        'cache_hit_rates': {
+            'answer_cache': _hit_rate(_metrics.counter('answer_cache_requests_total', result='hit'),
+                                      _metrics.counter('answer_cache_requests_total', result='miss')),
+            'template_cache': template_rates,
+        },
+        'counters': counters,
+        'documents': snapshot['documents'],
+    }
+
+
+def to_prometheus() -> str:
+    """Prometheus 文本格式（可由 node_exporter 的 textfile collector 读取）"""
+    snapshot = _metrics.snapshot()
+    by_name = {}
+    for (name, labels), value in snapshot['counters']:
+        by_name.setdefault(name, ('counter', []))[1].append((labels, value))
+    for (name, labels), values in snapshot['samples']:
+        by_name.setdefault(name, ('histogram', []))[1].append((labels, values))
+    lines = []
+    for name in sorted(by_name):
+        kind, series = by_name[name]
+        full_name = METRIC_PREFIX + name
+        if name in DESCRIPTIONS:
+            lines.append(f"# HELP {full_name} {DESCRIPTIONS[name]}")
+        lines.append(f"# TYPE {full_name} {kind}")
+        for labels, value in sorted(series, key=lambda item: item[0]):
+            if kind == 'counter':
+                lines.append(f"{full_name}{_format_labels(labels)} {value:g}")
+                continue
+            for bound in LATENCY_BUCKETS:
+                count = sum(1 for v in value if v <= bound)
+                lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', f'{bound:g}')])} {count}")
+            lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', '+Inf')])} {len(value)}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {sum(value):g}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {len(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def write_reports(report_dir=None):
+    """写出 run_report.json 和 metrics.prom，返回两个路径"""
+    report_dir = str(report_dir or settings.METRICS_REPORT_DIR)
+    os.makedirs(report_dir, exist_ok=True)
+    json_path = os.path.join(report_dir, 'run_report.json')
+    prom_path = os.path.join(report_dir, 'metrics.prom')
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(build_report(), f, ensure_ascii=False, indent=2)
+    # 先写临时文件再替换，避免采集器读到半个文件
+    tmp_path = prom_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(to_prometheus())
+    os.replace(tmp_path, prom_path)
+    logger.info(f"Wrote run report to {json_path} and {prom_path}")
+    return json_path, prom_path
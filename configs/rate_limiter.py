@@ -0,0 +1,228 @@
+"""
+进程级 FastGPT 限流器
+
+- 令牌桶：限制每秒请求数和每分钟（估算的）token 数
+- AIMD 自适应并发：延迟和错误率正常时缓慢增加并发上限，遇到 429/5xx/超时时减半（每个窗口最多一次）
+- 对冲请求（HedgePolicy）：根据近期延迟分布决定何时再发一次同样的请求，并用预算限制额外负载
+- 优先级：并发名额按调用方声明的优先级（call_priority，估算耗时越长越优先）分配，同优先级先到先得
+
+所有文档的 call_fastgpt 共用同一个限流器（与事件循环绑定，由 AI_calls 创建）。
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+from configs import metrics, trace
+
+logger = logging.getLogger(__name__)
+
+# 调用结果分类
+OUTCOME_OK = "ok"
+OUTCOME_THROTTLED = "throttled"  # 429 / 5xx / 超时：需要降低并发
+OUTCOME_ERROR = "error"  # 其他错误：不调整并发
+
+# 当前任务发出的请求的优先级（数值越大越先获得并发名额）
+_priority = contextvars.ContextVar('fastgpt_priority', default=0.0)
+
+
+@contextmanager
+def call_priority(priority: float):
+    """with 块内（当前任务及其创建的任务）的 FastGPT 请求以 priority 排队"""
+    token = _priority.set(priority or 0.0)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中文约 1 字 1 token，ASCII 约 4 个字符 1 token"""
+    ascii_chars = sum(1 for ch in text if ch.isascii())
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+class TokenBucket:
+    """令牌桶；rate 为每秒补充的令牌数，rate <= 0 表示不限制"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        if self.rate <= 0:
+            return
+        # 单次请求超过桶容量时只要求桶满，避免永远等待
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD 并发控制：成功且延迟低于目标时加性增长，被限流时乘性减小。
+    同一窗口内的多次限流只减小一次：在上一次减小之前就已发出的请求再被限流时不再减小
+    （它们反映的是减小之前的并发），否则一批并发的 429 会把上限直接降到 minimum。
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float,
+                 increase: float = 1.0, decrease: float = 0.5):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        # 上一次减小并发上限的时间（time.monotonic()）
+        self._last_decrease = float('-inf')
+        self._condition = asyncio.Condition()
+        # 等待者的堆：(-priority, 到达顺序)，只有堆顶可以取得名额
+        self._waiting = []
+        self._order = itertools.count()
+
+    async def acquire(self, priority: float = 0.0, timeout: Optional[float] = None):
+        """timeout: 最多等待的秒数，超时抛出 asyncio.TimeoutError（不占用名额）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        async with self._condition:
+            entry = (-priority, next(self._order))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while self.in_flight >= int(self.limit) or self._waiting[0] != entry:
+                    if deadline is None:
+                        await self._condition.wait()
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    await asyncio.wait_for(self._condition.wait(), remaining)
+            except BaseException:
+                # 被取消或超时：让出排队位置，下一个等待者可能因此成为堆顶
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self.in_flight += 1
+            if self._waiting:
+                self._condition.notify_all()
+
+    async def release(self, outcome: str, latency: float):
+        async with self._condition:
+            self.in_flight -= 1
+            if outcome == OUTCOME_THROTTLED:
+                now = time.monotonic()
+                if now - latency >= self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+                    logger.warning(f"FastGPT throttled, concurrency limit reduced to {int(self.limit)}")
+            elif outcome == OUTCOME_OK and (not self.latency_target or latency <= self.latency_target):
+                # 每完成一整个窗口的请求大约增加 increase
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+
+class HedgePolicy:
+    """
+    对冲请求的时机和预算：
+    - delay()：最近 window 次成功请求（从取得名额到返回）延迟的 percentile 分位数，不小于 min_delay；
+      样本少于 min_samples 时返回 None，表示不对冲
+    - try_acquire()：对冲请求数不超过主请求数的 budget 比例
+    """
+
+    def __init__(self, percentile: float, budget: float, min_samples: int = 20, min_delay: float = 0.0,
+                 window: int = 200):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = max(1, min_samples)
+        self.min_delay = min_delay
+        self.latencies = deque(maxlen=max(window, self.min_samples))
+        self.requests = 0
+        self.hedges = 0
+
+    def observe(self, latency: float):
+        self.latencies.append(latency)
+
+    def delay(self) -> Optional[float]:
+        if len(self.latencies) < self.min_samples:
+            return None
+        ordered = sorted(self.latencies)
+        # 最近秩分位数
+        rank = max(1, -(-len(ordered) * self.percentile // 100))
+        return max(self.min_delay, ordered[int(rank) - 1])
+
+    def record_request(self):
+        self.requests += 1
+
+    def try_acquire(self) -> bool:
+        if self.hedges + 1 > self.budget * self.requests:
+            return False
+        self.hedges += 1
+        return True
+
+
+class CallSlot:
+    """一次 FastGPT 请求占用的名额；调用方用 record() 报告结果"""
+
+    def __init__(self):
+        self.outcome = OUTCOME_ERROR
+
+    def record(self, outcome: str):
+        self.outcome = outcome
+
+
+class FastGPTLimiter:
+    def __init__(self, requests_per_second: float, tokens_per_minute: float,
+                 initial_concurrency: int, min_concurrency: int, max_concurrency: int,
+                 latency_target: float, hedge: Optional[HedgePolicy] = None):
+        self.hedge = hedge
+        self.requests = TokenBucket(requests_per_second, max(requests_per_second, 1.0))
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute / 6.0)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, min_concurrency, max_concurrency, latency_target)
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int = 0, acquired: Optional[asyncio.Event] = None,
+                   timeout: Optional[float] = None):
+        """
+        取得一个请求名额；acquired 在取得名额（请求即将发出）时被 set。
+        timeout: 排队最多等待的秒数（None 表示不限），超时抛出 asyncio.TimeoutError
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else deadline - time.monotonic()
+
+        with trace.event('limiter_wait', 'wait', metrics.current_document()):
+            await asyncio.wait_for(self.requests.acquire(), remaining())
+            if estimated_tokens:
+                await asyncio.wait_for(self.tokens.acquire(estimated_tokens), remaining())
+            await self.concurrency.acquire(_priority.get(), remaining())
+        if acquired is not None:
+            acquired.set()
+        call_slot = CallSlot()
+        start = time.monotonic()
+        try:
+            yield call_slot
+        finally:
+            latency = time.monotonic() - start
+            if self.hedge is not None and call_slot.outcome == OUTCOME_OK:
+                self.hedge.observe(latency)
+            await self.concurrency.release(call_slot.outcome, latency)
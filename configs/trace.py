@@ -0,0 +1,127 @@
+"""
+Chrome trace / Perfetto 时间线（run.py --trace out.json）
+
+记录文档、阶段、批次、排队和限流器等待、HTTP 尝试和文件写入的开始与结束，输出 Chrome 的 Trace Event 格式，
+可直接在 chrome://tracing 或 https://ui.perfetto.dev 中打开。
+
+每个 asyncio 任务（没有事件循环时为线程）是一条单独的轨道，轨道名为 "文档 · 任务名"。
+同一任务中的事件总是正确嵌套，不同轨道上的事件重叠说明调用确实是并发的。
+事件的 args 中带有文档、行号、表格起始行等标记。
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Optional
+
+_enabled = False
+_lock = threading.Lock()
+_events = []
+# 任务或线程 -> (pid, 轨道号)；fork 出的子进程中沿用的线程对象按 pid 区分
+_lanes = weakref.WeakKeyDictionary()
+_lane_count = 0
+
+
+def set_enabled(enabled: bool):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _now_us() -> float:
+    # perf_counter 在 Linux 上是系统范围的单调时钟，进程池中记录的时间可以直接合并
+    return time.perf_counter_ns() / 1000
+
+
+def _lane(document: Optional[str]) -> int:
+    global _lane_count
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    owner = task if task is not None else threading.current_thread()
+    pid = os.getpid()
+    entry = _lanes.get(owner)
+    if entry is not None and entry[0] == pid:
+        return entry[1]
+    _lane_count += 1
+    _lanes[owner] = (pid, _lane_count)
+    if task is not None:
+        label = f"{os.path.basename(document)} · {task.get_name()}" if document else task.get_name()
+    else:
+        label = f"{owner.name} (pid {pid})"
+    _events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': _lane_count, 'args': {'name': label}})
+    return _lane_count
+
+
+def _append(name: str, category: str, document: Optional[str], start: float, end: float, args: dict):
+    tags = {key: value for key, value in args.items() if value is not None}
+    if document:
+        tags['document'] = document
+    with _lock:
+        _events.append({
+            'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': end - start,
+            'pid': os.getpid(), 'tid': _lane(document), 'args': tags,
+        })
+
+
+@contextmanager
+def event(name: str, category: str = 'stage', document: Optional[str] = None, **args):
+    """记录 with 块为一个完整事件（ph=X）；args 中为 None 的标记不记录"""
+    if not _enabled:
+        yield
+        return
+    start = _now_us()
+    try:
+        yield
+    finally:
+        _append(name, category, document, start, _now_us(), args)
+
+
+def now() -> float:
+    """当前时间戳，作为 record() 的 start"""
+    return _now_us()
+
+
+def record(name: str, start: float, category: str = 'stage', document: Optional[str] = None, **args):
+    """
+    记录从 start（now() 的返回值）到现在的完整事件，画在当前任务的轨道上。
+    用于开始和结束不在同一个任务中的等待，例如批次在任务队列中等待工作协程。
+    """
+    if _enabled:
+        _append(name, category, document, start, _now_us(), args)
+
+
+def drain() -> list:
+    """取出并清空已记录的事件（子进程把事件带回主进程）"""
+    with _lock:
+        events = list(_events)
+        _events.clear()
+    return events
+
+
+def merge(events: list):
+    if not events:
+        return
+    with _lock:
+        _events.extend(events)
+
+
+def reset():
+    drain()
+
+
+def write(path: str) -> int:
+    """写出 Trace Event JSON，返回事件数"""
+    with _lock:
+        events = list(_events)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+    return len(events)
@@ -1,11 +1,20 @@
 import logging
-from configs.AI_calls import call_fastgpt
+from configs.AI_calls import call_fastgpt, document_deadline
+from configs.rate_limiter import call_priority
 from config import settings
 import re
-from configs.AI_prompts import FASTGPT_PROMPT, ERROR_PROMPT
+from configs.AI_prompts import FASTGPT_PROMPT, ERROR_PROMPT, build_fastgpt_prompt, build_table_pack_note
+from preprocessing.answer_patch import CODE_PATTERN, PatchedDocument, split_lines
+from preprocessing.answer_stream import QuestionAnswerStream, TableRowStream, clean_answer
+from preprocessing.job_journal import current_journal
+from preprocessing import template_cache
+from configs.AI_cache import prompt_hash
+from configs import metrics, trace
 import asyncio
+import heapq
+from bisect import bisect_right
 import os
-import tiktoken
+from preprocessing.token_counter import count_tokens, count_tokens_batch
 from typing import Optional
 
 logging.basicConfig(
@@ -16,12 +25,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 QUESTION_NUMBER = settings.QUESTION_NUMBER
+MAX_CONCURRENT = settings.FASTGPT_MAX_CONCURRENT
+# 表格切块的默认参数（也是模板结构缓存键的一部分）
+TABLE_CHUNK_TOKENS = 1000
+TOKEN_MODEL = "gpt-3.5-turbo"
 
-def count_tokens(text, model="gpt-3.5-turbo"):
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(text))
-
-async def process_table_before_call(table_html: str, start_row: int, max_tokens=1000, model="gpt-3.5-turbo"):
+@metrics.timed('table_chunking')
+async def process_table_before_call(table_html: str, start_row: int, max_tokens=TABLE_CHUNK_TOKENS, model=TOKEN_MODEL):
 
     tr_blocks = re.findall(r'(<tr[\s\S]*?</tr>)', table_html, re.IGNORECASE)
     preserved_rows = []
@@ -82,14 +92,15 @@ async def process_table_before_call(table_html: str, start_row: int, max_tokens=
     current_chunk = []
     current_tokens = 0
     current_start_row = start_row
-    for i, row in enumerate(preserved_rows):
-        row_tokens = count_tokens(row, model=model)
+    row_token_counts = count_tokens_batch(preserved_rows, model=model)
+    for i, (row, row_tokens) in enumerate(zip(preserved_rows, row_token_counts)):
         if current_tokens + row_tokens > max_tokens and current_chunk:
             # Start a new chunk
             chunks.append(('\n'.join(current_chunk), current_start_row))
             current_chunk = []
             current_tokens = 0
-            current_start_row = i + 1  # Next chunk starts at this row (1-based)
+            # 每一块都从表格起始行开始回填（按绝对编码匹配），而不是行下标
+            current_start_row = start_row
         current_chunk.append(row)
         current_tokens += row_tokens
 
@@ -99,60 +110,18 @@ async def process_table_before_call(table_html: str, start_row: int, max_tokens=
     return chunks
 
 async def process_table_after_call(original_file_path: str, line_num: int, ai_table: str):
-    # Build a mapping from code to answer from the ai_table
-    ai_rows = re.findall(r'<tr>([\s\S]*?)</tr>', ai_table, re.IGNORECASE)
-    code_to_answer = {}
-
-    for row in ai_rows:
-        for code_match in re.finditer(r'<!--\s*绝对编码：(\d+)\s*-->', row):
-            code = code_match.group(1)
-            before_code = row[:code_match.start()]
-# Remove comments
-            before_code = re.sub(r'<!--.*?-->', '', before_code)
-            # Remove tags
-            before_code = re.sub(r'<[^>]+>', '', before_code)
-            # Split by newlines and get the last non-empty, stripped line
-            lines_before = before_code.split('\n')
-            answer = ''
-            for line in reversed(lines_before):
-                stripped = line.strip()
-                if stripped:
-                    answer = stripped
-                    break
-            answer = answer.replace('&nbsp;', '').strip()
-            if answer:
-                code_to_answer[code] = answer
-            else:
-                print(f"No answer extracted for code {code} in row: {row}")
-
-    # 2. Read the original file
-    with open(original_file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    # 3. Loop from line_num to the next </table>
-    idx = line_num - 1  # line_num is 1-based
-    while idx < len(lines):
-        line = lines[idx]
-        if '</table>' in line:
-            break
-        code_match = re.search(r'<!--\s*绝对编码：(\d+)\s*-->', line)
-        if code_match in line:
-            code = code_match.group(1)
-            answer = code_to_answer.get(code)
-            if answer:
-                print(f"Replacing in line {idx}: {line.strip()} with answer: {answer}")
-                lines[idx] = line.replace('&nbsp;', answer, 1)
-            else:
-                print(f"No answer found in ai_table for code {code}")
-        idx += 1
-
-    with open(original_file_path, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
+    """把单个表格的答案写回文件；批量处理请使用 PatchedDocument"""
+    document = PatchedDocument.load(original_file_path)
+    document.apply_table_answer(line_num, ai_table)
+    document.write(original_file_path)
+    return document.lines
 
-    return lines
-
-async def process_answers(questions: dict, answer: str, start_row: Optional[int] = None):
+async def process_answers(questions: dict, answer: Optional[str], start_row: Optional[int] = None):
     final_answers = {}
+    if not answer:
+        # call_fastgpt 重试失败后返回 None：跳过这一批，其余批次照常处理
+        logger.error(f"No answer from FastGPT for lines {list(questions.keys())}; batch skipped.")
+        return final_answers
     if not answer.strip().startswith("<tr>"):
         message_chunks = [chunk.strip() for chunk in answer.split('|||')]
         keys = list(questions.keys())
@@ -177,66 +146,505 @@ async def process_answers(questions: dict, answer: str, start_row: Optional[int]
         return {start_row: answer}
 
 
-async def get_answers(questions: dict) -> dict:
+async def ask_fastgpt(prompt: str, kind: str, lines, on_delta=None):
+    """
+    调用 FastGPT 并记录到当前文档的任务日志；续跑时已完成的批次直接回放日志中的回答。
+    """
+    journal = current_journal()
+    if journal is None:
+        return await call_fastgpt(prompt, on_delta=on_delta)
+    key = prompt_hash(prompt)
+    answer = journal.completed(key)
+    if answer is not None:
+        logger.info(f"Replaying {kind} batch for lines {list(lines)} from journal.")
+        metrics.inc('journal_replays_total')
+        if on_delta is not None:
+            on_delta(answer)
+        return answer
+    answer = await call_fastgpt(prompt, on_delta=on_delta)
+    journal.record(key, kind, lines, answer)
+    return answer
+
+async def get_answers(questions: dict, on_answer=None, on_discard=None) -> dict:
+    """
+    on_answer(line_number, answer): 每解析出一个答案就回调（流式模式下边生成边回调）
+    on_discard(): 之前回调的答案作废（重试、对冲请求胜出或请求最终失败）
+    Returns: 整批的答案 {line_number: answer}
+    """
     logger.info(f"Calling get_answers for {len(questions)} questions.")
-    final_answers = {}
-    # If questions is a dict with a single value that starts with <table>, preprocess it
-    if isinstance(questions, dict) and len(questions) == 1:
-        only_value = next(iter(questions.values()))
-        if isinstance(only_value, str) and only_value.strip().startswith('<table>'):
-            start_row = next(iter(questions.keys()))
-            questions_modified = await process_table_before_call(only_value, start_row)
-            for chunk, start_row in questions_modified:
-                prompt = f"{FASTGPT_PROMPT}\n{chunk}"
-                answer = await call_fastgpt(prompt)
-                logger.info(f"Received answer from FastGPT: {answer}")
-                final_answers.update(await process_answers(questions, answer, start_row))
-        else:
-            prompt = f"{FASTGPT_PROMPT}\n{questions}"
-            answer = await call_fastgpt(prompt)
-            logger.info(f"Received answer from FastGPT: {answer}")
-            final_answers = await process_answers(questions, answer)
-    else:
-        prompt = f"{FASTGPT_PROMPT}\n{questions}"
-        answer = await call_fastgpt(prompt)
-        logger.info(f"Received answer from FastGPT: {answer}")
-        final_answers = await process_answers(questions, answer)
-    return final_answers
+    prompt = f"{build_fastgpt_prompt(len(questions))}\n{questions}"
+    stream = QuestionAnswerStream(questions.keys(), on_answer, on_discard)
+    answer = await ask_fastgpt(prompt, ITEM_QUESTION, questions.keys(), on_delta=stream.feed)
+    logger.info(f"Received answer from FastGPT: {answer}")
+    if not answer:
+        # call_fastgpt 重试失败后返回 None：撤销已回调的答案，跳过这一批，其余批次照常处理
+        stream.feed(None)
+        logger.error(f"No answer from FastGPT for lines {list(questions.keys())}; batch skipped.")
+        return {}
+    stream.close()
+    return stream.answers
 
+@metrics.timed('detect_next_line')
 async def detect_next_line(file_path: str, line_num: int, answer: str):
     """
     Finds the next line after line_num that contains <!-- 绝对编码：, and replaces the content before <o:p> with the answer.
-    Modifies the file in place.
+    Modifies the file in place. 批量处理请使用 PatchedDocument，避免每个答案都读写一次文件。
     """
     logger.info(f"Detecting next line with <!-- 绝对编码： after line {line_num} in {file_path}.")
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        lines = f.readlines()
-    for idx in range(line_num - 1, len(lines)):
-        line = lines[idx]
-        if '<!-- 绝对编码：' in line:
-            # Replace the content inside <o:p>...</o:p> with the answer
-            new_line = re.sub(r'<p>.*?</o:p>', f'<p>{answer}</o:p>', line)
-            lines[idx] = new_line
-            logger.info(f"Replaced content in line {idx} with answer.")
-            break
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
+    document = PatchedDocument.load(file_path)
+    document.apply_question_answer(line_num, answer)
+    document.write(file_path)
     logger.info(f"File {file_path} updated with answer.")
-    return lines
+    return document.lines
+
+TABLE_PACK_BEGIN = "==== 表格 {index} 开始 ===="
+TABLE_PACK_END = "==== 表格 {index} 结束 ===="
+
+class BatchPacker:
+    """
+    按文档顺序依次装箱（next-fit）：当前批次加入下一项会超过 token_budget 或 max_items 时先交出当前批次。
+    超过预算的单项单独成批。base_tokens 是每批固定的开销（例如提示词）。
+    """
 
-async def get_answers_concurrent(batches, max_concurrent=10):
+    def __init__(self, token_budget: int, max_items: int, base_tokens: int = 0):
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self.base_tokens = base_tokens
+        self._items = []
+        self._used = base_tokens
+
+    def add(self, item, tokens: int):
+        """加入一项；如果因此交出了一个已满的批次，返回该批次（list），否则返回 None"""
+        full = None
+        if self._items and (self._used + tokens > self.token_budget or len(self._items) >= self.max_items):
+            full = self.flush()
+        self._items.append(item)
+        self._used += tokens
+        return full
+
+    def flush(self):
+        """交出当前批次（可能为 None）"""
+        items = self._items or None
+        self._items = []
+        self._used = self.base_tokens
+        return items
+
+def table_packer(token_budget=None, max_tables=None) -> BatchPacker:
+    return BatchPacker(token_budget or settings.TABLE_PACK_TOKEN_BUDGET, max_tables or settings.TABLE_PACK_MAX_TABLES)
+
+async def pack_table(packer: BatchPacker, line_num: int, table_html: str, model="gpt-3.5-turbo",
+                     table_chunks: Optional[dict] = None) -> list:
     """
-    batches: list of dicts, each dict is a batch of questions {line_number: question}
-    max_concurrent: max number of concurrent AI calls
-    Returns: list of dicts (answers for each batch)
+    把一个表格简化成块加入 packer，返回因此装满的表格请求。
+    table_chunks: {start_line: [(chunk, start_row)]}，已有的块直接使用，新切分的块写入其中（模板结构缓存）
     """
-    semaphore = asyncio.Semaphore(max_concurrent)
-    async def sem_task(batch):
-        async with semaphore:
-            logger.info(f"Starting AI call for batch of size {len(batch)}")
-            return await get_answers(batch)
-    tasks = [asyncio.create_task(sem_task(batch)) for batch in batches]
-    return await asyncio.gather(*tasks)
+    chunks = table_chunks.get(line_num) if table_chunks is not None else None
+    if chunks is None:
+        chunks = await process_table_before_call(table_html, line_num, model=model)
+        if table_chunks is not None:
+            table_chunks[line_num] = chunks
+    packs = []
+    for chunk, start_row in chunks:
+        pack = packer.add((start_row, chunk), count_tokens(chunk, model=model))
+        if pack:
+            packs.append(pack)
+    return packs
+
+def build_table_prompt(pack) -> str:
+    """单个表格块沿用原来的提示词；多个表格块用编号分隔行隔开"""
+    if len(pack) == 1:
+        return f"{FASTGPT_PROMPT}\n{pack[0][1]}"
+    sections = [
+        f"{TABLE_PACK_BEGIN.format(index=index)}\n{chunk}\n{TABLE_PACK_END.format(index=index)}"
+        for index, (_, chunk) in enumerate(pack, 1)
+    ]
+    return f"{FASTGPT_PROMPT}\n{build_table_pack_note(len(pack))}\n" + '\n'.join(sections)
+
+async def get_table_answers(pack, on_answer=None, on_discard=None) -> dict:
+    """
+    发送一个表格请求，并按绝对编码把回答拆回各个表格。
+    on_answer(table_start_line, rows): 每收到一个完整的 <tr> 行就回调
+    on_discard(): 之前回调的行作废（重试、对冲请求胜出或请求最终失败）
+    Returns: {table_start_line: ai_table}
+    """
+    code_owner = {}
+    for line_num, chunk in pack:
+        for code in CODE_PATTERN.findall(chunk):
+            code_owner.setdefault(code, line_num)
+    stream = TableRowStream(code_owner, on_answer, on_discard)
+    answer = await ask_fastgpt(build_table_prompt(pack), ITEM_TABLE, sorted(set(code_owner.values())),
+                               on_delta=stream.feed)
+    logger.info(f"Received answer from FastGPT: {answer}")
+    if not answer:
+        stream.feed(None)
+        logger.error(f"No answer from FastGPT for tables at lines {sorted({line for line, _ in pack})}; pack skipped.")
+        return {}
+    stream.close()
+    return stream.tables()
+
+def merge_table_answers(table_answers: dict, new_answers: dict):
+    """同一表格被拆成多块时，按顺序拼接各块的回答"""
+    for line_num, ai_table in new_answers.items():
+        if line_num in table_answers:
+            table_answers[line_num] = f"{table_answers[line_num]}\n{ai_table}"
+        else:
+            table_answers[line_num] = ai_table
+
+def question_packer(token_budget=None, max_questions=None, model="gpt-3.5-turbo") -> BatchPacker:
+    max_questions = max_questions or settings.QUESTION_MAX_PER_BATCH
+    # 提示词的长度与问题数量基本无关
+    prompt_tokens = count_tokens(build_fastgpt_prompt(max_questions), model=model)
+    return BatchPacker(token_budget or settings.QUESTION_TOKEN_BUDGET, max_questions, base_tokens=prompt_tokens)
+
+def question_tokens(line_num: int, question: str, answer_tokens=None, model="gpt-3.5-turbo") -> int:
+    """一个问题在提示词中（dict 的 repr 形式）的 token 数，加上预留的答案长度"""
+    answer_tokens = settings.ANSWER_TOKENS_PER_QUESTION if answer_tokens is None else answer_tokens
+    return count_tokens(f"{line_num}: {question!r}, ", model=model) + answer_tokens
+
+class BatchPlanner:
+    """
+    按文档顺序把表格和问题规划成请求（answer_pipeline 与 plan_question_batches / pack_tables 共用）：
+    表格简化成块后由 table_packer 合并成表格请求（pack_table），问题由 question_packer 按 token 预算分批。
+    add_table / add_question 返回因此装满的请求，flush() 交出剩余的请求；
+    每个请求是 (ITEM_TABLE, [(table_start_line, chunk)]) 或 (ITEM_QUESTION, {line_number: question})。
+    """
+
+    def __init__(self, model="gpt-3.5-turbo", table_chunks: Optional[dict] = None,
+                 question_budget=None, answer_tokens=None, max_questions=None,
+                 table_budget=None, max_tables=None):
+        self.model = model
+        self.table_chunks = table_chunks
+        self.answer_tokens = answer_tokens
+        self.tables = table_packer(table_budget, max_tables)
+        self.questions = question_packer(question_budget, max_questions, model=model)
+
+    async def add_table(self, line_num: int, table_html: str) -> list:
+        packs = await pack_table(self.tables, line_num, table_html, model=self.model, table_chunks=self.table_chunks)
+        return [(ITEM_TABLE, pack) for pack in packs]
+
+    def add_question(self, line_num: int, question: str) -> list:
+        tokens = question_tokens(line_num, question, self.answer_tokens, model=self.model)
+        batch = self.questions.add((line_num, question), tokens)
+        return [(ITEM_QUESTION, dict(batch))] if batch else []
+
+    def flush(self) -> list:
+        planned = []
+        last = self.tables.flush()
+        if last:
+            planned.append((ITEM_TABLE, last))
+        last = self.questions.flush()
+        if last:
+            planned.append((ITEM_QUESTION, dict(last)))
+        return planned
+
+    async def plan(self, items):
+        """items 为 iter_document 的输出；边读取边产出装满的请求，最后产出剩余的请求"""
+        for kind, line_num, value, _ in items:
+            if kind == ITEM_TABLE:
+                planned = await self.add_table(line_num, value)
+            else:
+                planned = self.add_question(line_num, value)
+            for request in planned:
+                yield request
+        for request in self.flush():
+            yield request
+
+def plan_question_batches(questions_dict: dict, token_budget=None, answer_tokens=None,
+                          max_questions=None, model="gpt-3.5-turbo"):
+    """
+    按 token 预算把问题分批：每批的 提示词 + 问题 + 每题预留答案 不超过 token_budget，
+    且不超过 max_questions 个问题。问题保持文档顺序，依次装满每一批（对连续分组而言批数最少）。
+    超过预算的单个问题单独成批。
+    Returns: list of dicts {line_number: question}
+    """
+    planner = BatchPlanner(model=model, question_budget=token_budget, answer_tokens=answer_tokens,
+                           max_questions=max_questions)
+    planned = [request for line_num, question in questions_dict.items()
+               for request in planner.add_question(line_num, question)]
+    batches = [batch for _, batch in planned + planner.flush()]
+    logger.info(f"Planned {len(batches)} question batches for {len(questions_dict)} questions.")
+    return batches
+
+async def pack_tables(tables_dict: dict, token_budget=None, max_tables=None, model="gpt-3.5-turbo"):
+    """
+    把表格简化成块（process_table_before_call），再按文档顺序把块合并成请求：
+    每个请求的表格内容不超过 token_budget 且最多 max_tables 块。超过预算的块单独成为一个请求。
+    Returns: list of packs, each pack is a list of (table_start_line, chunk)
+    """
+    planner = BatchPlanner(model=model, table_budget=token_budget, max_tables=max_tables)
+    planned = []
+    for line_num, table_html in tables_dict.items():
+        planned.extend(await planner.add_table(line_num, table_html))
+    packs = [pack for _, pack in planned + planner.flush()]
+    logger.info(f"Packed {len(tables_dict)} tables into {len(packs)} requests.")
+    return packs
+
+QUESTION_PATTERN = re.compile(r'<p>\s*(?!&nbsp;)(.*?)<o:p>', re.UNICODE)
+TABLE_PATTERN = re.compile(r'<table[\s\S]*?</table>', re.IGNORECASE)
+
+def build_line_starts(content: str) -> list:
+    """每一行起始字符的位置（有序），用于把字符位置二分映射到行号"""
+    return [0] + [match.end() for match in re.finditer('\n', content)]
+
+def line_at(line_starts: list, pos: int) -> int:
+    """字符位置 pos 所在的行号（1-based），等价于 content[:pos].count('\n') + 1"""
+    return bisect_right(line_starts, pos)
+
+ITEM_TABLE = 'table'
+ITEM_QUESTION = 'question'
+
+def iter_document(content: str):
+    """
+    按文档顺序逐个产出表格和表格外的问题：(ITEM_TABLE, start_line, table_html, end_line)
+    或 (ITEM_QUESTION, line_number, question_text, line_number)。
+    """
+    line_starts = build_line_starts(content)
+    tables = TABLE_PATTERN.finditer(content)
+    next_table = next(tables, None)
+    # 已产出的表格中最靠后的结束行；行号不超过它的行都在表格内
+    table_end = 0
+    for idx, line in enumerate(split_lines(content), 1):
+        while next_table is not None and line_at(line_starts, next_table.start()) <= idx:
+            start_line = line_at(line_starts, next_table.start())
+            end_line = line_at(line_starts, next_table.end())
+            table_end = max(table_end, end_line)
+            yield ITEM_TABLE, start_line, next_table.group(0), end_line
+            next_table = next(tables, None)
+        # Skip lines that are inside any table
+        if idx <= table_end:
+            continue
+        elif '<!-- 绝对编码：' in line:
+            continue
+        match = QUESTION_PATTERN.search(line)
+        if match:
+            question = match.group(1).strip()
+            if question == "":
+                continue
+            logger.info(f"Detected question at line {idx}: {question}")
+            yield ITEM_QUESTION, idx, question, idx
+
+SCHEDULE_LONGEST_FIRST = 'longest_first'
+SCHEDULE_FIFO = 'fifo'
+ROW_PATTERN = re.compile(r'<tr[\s>]', re.IGNORECASE)
+
+def estimate_batch_cost(kind: str, work_item, model="gpt-3.5-turbo") -> float:
+    """
+    估算一个批次的耗时，单位是“回答 token”：提示词 token 按 SCHEDULE_PROMPT_TOKEN_WEIGHT 折算，
+    表格的回答要重写每一行（约为表格内容的 token 数，每行另加 SCHEDULE_TOKENS_PER_ROW），
+    问题批次每题预留 ANSWER_TOKENS_PER_QUESTION。
+    """
+    if kind == ITEM_TABLE:
+        prompt = build_table_prompt(work_item)
+        table_tokens = sum(count_tokens(chunk, model=model) for _, chunk in work_item)
+        rows = sum(len(ROW_PATTERN.findall(chunk)) for _, chunk in work_item)
+        completion_tokens = table_tokens + rows * settings.SCHEDULE_TOKENS_PER_ROW
+    else:
+        prompt = f"{build_fastgpt_prompt(len(work_item))}\n{work_item}"
+        completion_tokens = len(work_item) * settings.ANSWER_TOKENS_PER_QUESTION
+    return count_tokens(prompt, model=model) * settings.SCHEDULE_PROMPT_TOKEN_WEIGHT + completion_tokens
+
+_DONE = object()
+_DISCARD = 'discard'
+_COMMIT = 'commit'
+
+async def answer_pipeline(items, on_question_answer=None, on_table_answer=None,
+                          workers=None, queue_size=None, model="gpt-3.5-turbo", table_chunks=None,
+                          schedule=None, window=None, on_discard=None, on_commit=None):
+    """
+    生产者/消费者流水线：
+    - 生产者按顺序读取 items（iter_document 的输出），由 BatchPlanner 把表格装成表格请求、把问题装成问题批次，
+      放入有界的任务队列（队列满时生产者等待，形成背压）
+    - workers 个工作协程从队列取任务调用 FastGPT，不区分表格和问题，因此问题批次不必等最慢的表格
+    - 写入协程按到达顺序把每个答案交给 on_question_answer / on_table_answer（唯一修改文档的地方）
+    on_question_answer(line_number, answer, attempt) / on_table_answer(table_start_line, rows, attempt):
+        答案一解析出来就回调；attempt 标识所属的批次
+    on_discard(attempt): 该批次之前回调的答案作废（重试、对冲请求胜出或请求失败），应撤销已写入的内容
+    on_commit(attempt): 该批次已结束，之后不会再作废
+    schedule: SCHEDULE_LONGEST_FIRST 把规划好的批次放入一个最多 window 个批次的前瞻窗口，
+        窗口满时先入队其中 estimate_batch_cost 最大的，扫描结束后按从长到短清空窗口，
+        避免大表格排在一串小批次之后、拖长整个文档的耗时；SCHEDULE_FIFO 每装满一批就按文档顺序入队。
+        默认取 PIPELINE_SCHEDULE
+    window: 前瞻窗口的批次数，默认取 PIPELINE_SCHEDULE_WINDOW；0 表示先规划整个文档
+        （扫描完成前不会发出任何请求）
+    table_chunks: 见 pack_table
+    Returns: (table_answers {start_line: ai_table}, all_answers {line_number: answer})，按文档顺序
+    """
+    schedule = schedule or settings.PIPELINE_SCHEDULE
+    if schedule not in (SCHEDULE_LONGEST_FIRST, SCHEDULE_FIFO):
+        raise ValueError(f"Unknown pipeline schedule: {schedule}")
+    longest_first = schedule == SCHEDULE_LONGEST_FIRST
+    window = settings.PIPELINE_SCHEDULE_WINDOW if window is None else window
+    workers = workers or settings.PIPELINE_WORKERS or MAX_CONCURRENT or settings.FASTGPT_GLOBAL_CONCURRENCY
+    tasks_queue = asyncio.Queue(maxsize=queue_size or settings.PIPELINE_QUEUE_SIZE)
+    # 写入阶段只做内存中的回填，比网络调用快得多，所以答案队列不设上限（流式回调不能等待）
+    answers_queue = asyncio.Queue()
+    table_results = {}
+    question_results = {}
+
+    async def produce():
+        seq = 0
+        # longest_first 的前瞻窗口：(-cost, seq, kind, work, queued) 的堆；seq 按文档顺序编号，用于合并答案，
+        # 估算耗时相同的批次也按文档顺序发送；queued 是批次规划好的时间（trace 中的 queue_wait）
+        planned = []
+        async def put(task):
+            await tasks_queue.put(task)
+            # 让工作协程尽早开始发送请求
+            await asyncio.sleep(0)
+        async def release_largest():
+            cost, task_seq, kind, work, queued = heapq.heappop(planned)
+            await put((task_seq, kind, work, -cost, queued))
+        async def submit(kind, work):
+            nonlocal seq
+            queued = trace.now()
+            if longest_first:
+                heapq.heappush(planned, (-estimate_batch_cost(kind, work, model=model), seq, kind, work, queued))
+                seq += 1
+                if window and len(planned) >= window:
+                    await release_largest()
+                return
+            await put((seq, kind, work, 0.0, queued))
+            seq += 1
+        async for kind, work_item in BatchPlanner(model=model, table_chunks=table_chunks).plan(items):
+            await submit(kind, work_item)
+        if longest_first:
+            logger.info(f"Scheduled {seq} batches longest-first (window {window or 'whole document'}).")
+        while planned:
+            await release_largest()
+        for _ in range(workers):
+            await tasks_queue.put(_DONE)
+
+    async def work():
+        def to_writer(kind, attempt):
+            return lambda line_num, answer: answers_queue.put_nowait((kind, line_num, answer, attempt))
+        def discard(attempt):
+            return lambda: answers_queue.put_nowait((_DISCARD, None, None, attempt))
+        while True:
+            task = await tasks_queue.get()
+            if task is _DONE:
+                break
+            seq, kind, work_item, cost, queued = task
+            # 从规划好到被工作协程取走：在前瞻窗口和任务队列中等待的时间
+            trace.record('queue_wait', queued, 'wait', metrics.current_document(), seq=seq, kind=kind)
+            logger.info(f"Starting AI call for {kind} batch of size {len(work_item)}")
+            # 本批次回调的答案都带上 attempt，作废时由写入协程整体撤销
+            attempt = object()
+            # 全局限流器按估算耗时分配并发名额，其他文档的小批次排在后面
+            with call_priority(cost):
+                if kind == ITEM_TABLE:
+                    with trace.event('table batch', 'batch', metrics.current_document(), seq=seq, cost=cost,
+                                     table_start_rows=[line for line, _ in work_item]):
+                        table_results[seq] = await get_table_answers(
+                            work_item, on_answer=to_writer(kind, attempt), on_discard=discard(attempt))
+                else:
+                    with trace.event('question batch', 'batch', metrics.current_document(), seq=seq, cost=cost,
+                                     lines=list(work_item)):
+                        question_results[seq] = await get_answers(
+                            work_item, on_answer=to_writer(kind, attempt), on_discard=discard(attempt))
+            answers_queue.put_nowait((_COMMIT, None, None, attempt))
+        answers_queue.put_nowait(_DONE)
+
+    async def write():
+        finished = 0
+        while finished < workers:
+            answer = await answers_queue.get()
+            if answer is _DONE:
+                finished += 1
+                continue
+            kind, line_num, value, attempt = answer
+            if kind == _DISCARD:
+                if on_discard is not None:
+                    on_discard(attempt)
+                continue
+            if kind == _COMMIT:
+                if on_commit is not None:
+                    on_commit(attempt)
+                continue
+            callback = on_table_answer if kind == ITEM_TABLE else on_question_answer
+            if callback is not None:
+                callback(line_num, value, attempt)
+
+    tasks = [asyncio.create_task(produce()), asyncio.create_task(write())]
+    tasks += [asyncio.create_task(work()) for _ in range(workers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    table_answers = {}
+    for seq in sorted(table_results):
+        merge_table_answers(table_answers, table_results[seq])
+    all_answers = {}
+    for seq in sorted(question_results):
+        for key, value in question_results[seq].items():
+            all_answers[key] = clean_answer(value)
+    logger.info(f"Processed {len(table_results)} table requests and {len(question_results)} question batches.")
+    return table_answers, all_answers
+
+async def answer_document(tables_dict: dict, questions_dict: dict,
+                          on_question_answer=None, on_table_answer=None):
+    """
+    Ask FastGPT for every table and question batch of one document.
+    on_question_answer / on_table_answer: 答案一到达就回调（用于边接收边回填），参数见 answer_pipeline
+    Returns: (table_answers {start_line: ai_table}, all_answers {line_number: answer})
+    """
+    items = [(ITEM_TABLE, line_num, table_html, line_num) for line_num, table_html in tables_dict.items()]
+    items += [(ITEM_QUESTION, line_num, question, line_num) for line_num, question in questions_dict.items()]
+    return await answer_pipeline(items, on_question_answer, on_table_answer)
+
+async def answer_content(content: str):
+    """
+    对内存中的简化文本提问并回填答案，不读写任何文件。
+    Returns: (PatchedDocument 已填写的文档, questions_dict {line_number: question_text},
+              all_answers {line_number: answer})
+    """
+    # 答案一到达就回填到内存中的文档
+    document = PatchedDocument.from_text(content)
+    questions_dict = {}
+    # 同一模板的结构（表格、问题、表格块）只分析一次
+    structure_key = None
+    structure = None
+    if template_cache.is_enabled():
+        structure_key = template_cache.content_hash(content, TABLE_CHUNK_TOKENS, TOKEN_MODEL)
+        structure = template_cache.load(template_cache.KIND_STRUCTURE, structure_key)
+    if structure is not None:
+        items = [tuple(item) for item in structure['items']]
+        table_chunks = {int(line): [tuple(chunk) for chunk in chunks]
+                        for line, chunks in structure['table_chunks'].items()}
+    else:
+        items = []
+        table_chunks = {}
+
+    def scanned_items():
+        # 边扫描边把表格和问题交给流水线
+        for item in (items if structure is not None else iter_document(content)):
+            if structure is None:
+                items.append(item)
+            if item[0] == ITEM_QUESTION:
+                questions_dict[item[1]] = item[2]
+            yield item
+
+    # 整个文档的 FastGPT 调用共享一个截止时间
+    with document_deadline(settings.FASTGPT_DOCUMENT_DEADLINE):
+        table_answers, all_answers = await answer_pipeline(
+            scanned_items(),
+            on_question_answer=document.apply_question_answer,
+            on_table_answer=document.apply_table_answer,
+            on_discard=document.discard,
+            on_commit=document.commit,
+            table_chunks=table_chunks,
+        )
+    if structure_key is not None and structure is None:
+        template_cache.save(template_cache.KIND_STRUCTURE, structure_key,
+                            {'items': items, 'table_chunks': table_chunks})
+
+    # 答案到达的顺序不固定：按文档顺序再应用一次问题答案（幂等），
+    # 结果与“先填所有问题、再填所有表格”一致
+    for line_num, answer in all_answers.items():
+        document.apply_question_answer(line_num, answer)
+    return document, questions_dict, all_answers
 
 async def process_file(file_path: str):
     """
@@ -245,69 +653,11 @@ async def process_file(file_path: str):
     Also returns answers as a dictionary: {line_number: answer}
     """
     logger.info(f"Processing file: {file_path}")
-    question_pattern = re.compile(
-        r'<p>\s*(?!&nbsp;)(.*?)<o:p>', re.UNICODE
-    )
-    table_pattern = re.compile(r'<table[\s\S]*?</table>', re.IGNORECASE)
-    tables_dict = {}
-    questions_dict = {}
-    table_line_ranges = []  # List of (start_line, end_line) tuples
     with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
         content = f.read()
-        # Find all tables and their start and end line numbers
-        for match in table_pattern.finditer(content):
-            table_html = match.group(0)
-            start_pos = match.start()
-            end_pos = match.end()
-            start_line = content[:start_pos].count('\n') + 1
-            end_line = content[:end_pos].count('\n') + 1
-            tables_dict[start_line] = table_html
-            table_line_ranges.append((start_line, end_line))
-    
-    # Now detect questions, skipping lines inside tables
-    with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-        for idx, line in enumerate(f, 1):
-            # Skip lines that are inside any table
-            in_table = any(start <= idx <= end for (start, end) in table_line_ranges)
-            if in_table:
-                continue
-            elif '<!-- 绝对编码：' in line:
-                continue
-            match = question_pattern.search(line)
-            if match:
-                question = match.group(1).strip()
-                if question == "":
-                    continue
-                questions_dict[idx] = question
-                logger.info(f"Detected question at line {idx}: {question}")
-
-    # Batch the tables into single-item dicts and get answers for each batch concurrently
-    table_batches = [{line_num: table_html} for line_num, table_html in tables_dict.items()]
-    table_answers = {}
-    if table_batches:
-        table_answers_list = await get_answers_concurrent(table_batches, max_concurrent=10)
-        for table_answer in table_answers_list:
-            table_answers.update(table_answer)
-        logger.info(f"Processed all table batches concurrently.")
-    
-    all_answers = {}
-    items = list(questions_dict.items())
-    batches = [dict(items[i:i+QUESTION_NUMBER]) for i in range(0, len(items), QUESTION_NUMBER)]
-    if batches:
-        batch_answers_list = await get_answers_concurrent(batches, max_concurrent=10)
-        for batch_answers in batch_answers_list:
-            for key, value in batch_answers.items():
-                if isinstance(value, str) and '\n' in value:
-                    logger.info(f"Removing newlines from answer for line {key}.")
-                    value = value.replace('\n', ' ')
-                all_answers[key] = value
-        logger.info(f"Processed all batches of questions concurrently.")
-    
-    for line_num, answer in all_answers.items():
-        await detect_next_line(file_path, line_num, answer)
-
-    for line_num, answer in table_answers.items():
-        await process_table_after_call(file_path, line_num, answer)
+    document, questions_dict, all_answers = await answer_content(content)
+    # 所有答案在内存中应用后原子写回一次
+    document.write(file_path)
     
     logger.info(f"Finished processing file: {file_path}")
-    return questions_dict, all_answers
\ No newline at end of file
+    return questions_dict, all_answers
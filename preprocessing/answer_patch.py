@@ -0,0 +1,198 @@
+"""
+答案回填（patch）阶段
+
+把整个 _copy 文件读入内存一次，在按行索引的结构上应用所有问题答案和表格答案，
+最后一次性原子写回磁盘（先写临时文件再 os.replace）。
+"""
+
+import logging
+import os
+import re
+import tempfile
+from bisect import bisect_left
+from typing import Dict, List, Optional
+from preprocessing.file_encoding import remember_encoding
+from configs import metrics
+
+logger = logging.getLogger(__name__)
+
+CODE_MARKER = '<!-- 绝对编码：'
+CODE_PATTERN = re.compile(r'<!--\s*绝对编码：(\d+)\s*-->')
+QUESTION_ANSWER_PATTERN = re.compile(r'<p>.*?</o:p>')
+COMMENT_PATTERN = re.compile(r'<!--.*?-->')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+AI_ROW_PATTERN = re.compile(r'<tr>([\s\S]*?)</tr>', re.IGNORECASE)
+
+
+def split_lines(content: str) -> List[str]:
+    """按 '\\n' 切分并保留换行符，与 readlines() 的结果一致"""
+    lines = content.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def parse_table_answer(ai_table: str) -> Dict[str, str]:
+    """从 AI 返回的表格中提取 {绝对编码: 答案}，答案取编码前最后一个非空文本行"""
+    code_to_answer = {}
+    for row in AI_ROW_PATTERN.findall(ai_table):
+        for code_match in CODE_PATTERN.finditer(row):
+            code = code_match.group(1)
+            before_code = row[:code_match.start()]
+            # Remove comments
+            before_code = COMMENT_PATTERN.sub('', before_code)
+            # Remove tags
+            before_code = TAG_PATTERN.sub('', before_code)
+            # Split by newlines and get the last non-empty, stripped line
+            answer = ''
+            for line in reversed(before_code.split('\n')):
+                stripped = line.strip()
+                if stripped:
+                    answer = stripped
+                    break
+            answer = answer.replace('&nbsp;', '').strip()
+            if answer:
+                code_to_answer[code] = answer
+            else:
+                logger.info(f"No answer extracted for code {code} in row: {row}")
+    return code_to_answer
+
+
+def split_table_reply(ai_reply: str, code_owner: Dict[str, int]) -> Dict[int, str]:
+    """
+    把一次请求中多个表格的回答按绝对编码拆回各个表格。
+    code_owner: {绝对编码: 表格起始行}；每个 <tr> 归属于其中第一个已知编码所在的表格。
+    Returns: {表格起始行: 该表格的 <tr> 行（以换行连接）}
+    """
+    parts = {}
+    for row in AI_ROW_PATTERN.finditer(ai_reply):
+        owner = None
+        for code in CODE_PATTERN.findall(row.group(1)):
+            owner = code_owner.get(code)
+            if owner is not None:
+                break
+        if owner is None:
+            logger.info(f"Dropping AI row without a known code: {row.group(0)}")
+            continue
+        parts.setdefault(owner, []).append(row.group(0))
+    return {owner: '\n'.join(rows) for owner, rows in parts.items()}
+
+
+class PatchedDocument:
+    """
+    内存中的简化文档：lines 与 readlines() 相同（1-based 行号 = 下标 + 1），
+    另外维护包含绝对编码的行下标（有序），用于二分查找下一个需要填写的行；
+    以及 {行内第一个绝对编码: [行下标]} 的索引，表格答案按编码直接定位，不必逐行扫描表格。
+
+    apply_* 传入 attempt（任意可哈希的对象，标识一次请求）时记录改写前的行：
+    流式回答边接收边回填，请求作废时 discard(attempt) 撤销它写入的内容，成功后 commit(attempt) 丢弃记录。
+    """
+
+    def __init__(self, lines: List[str]):
+        self.lines = lines
+        self._code_lines = [idx for idx, line in enumerate(lines) if CODE_MARKER in line]
+        self._code_index = {}
+        for idx, line in enumerate(lines):
+            if '绝对编码：' in line:
+                code_match = CODE_PATTERN.search(line)
+                if code_match:
+                    self._code_index.setdefault(code_match.group(1), []).append(idx)
+        # {表格第一行下标: 表格结束行（含 </table> 的行）下标}
+        self._table_ends = {}
+        # {attempt: [(行下标, 改写前, 改写后)]}
+        self._attempts = {}
+
+    @classmethod
+    def from_text(cls, content: str) -> "PatchedDocument":
+        return cls(split_lines(content))
+
+    @classmethod
+    def load(cls, file_path: str) -> "PatchedDocument":
+        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+            return cls(f.readlines())
+
+    def next_code_line(self, line_num: int) -> Optional[int]:
+        """返回行号 line_num（含）之后第一个包含绝对编码的行下标"""
+        pos = bisect_left(self._code_lines, line_num - 1)
+        if pos < len(self._code_lines):
+            return self._code_lines[pos]
+        return None
+
+    def _set_line(self, idx: int, line: str, attempt=None):
+        if attempt is not None:
+            self._attempts.setdefault(attempt, []).append((idx, self.lines[idx], line))
+        self.lines[idx] = line
+
+    def discard(self, attempt):
+        """撤销 attempt 写入的所有内容；之后又被其他答案改写的行保持不变"""
+        for idx, before, after in reversed(self._attempts.pop(attempt, [])):
+            if self.lines[idx] == after:
+                self.lines[idx] = before
+
+    def commit(self, attempt):
+        self._attempts.pop(attempt, None)
+
+    def apply_question_answer(self, line_num: int, answer: str, attempt=None) -> Optional[int]:
+        """把问题的答案写入 line_num 之后第一个包含绝对编码的行"""
+        with metrics.span('apply_answer', line=line_num):
+            idx = self.next_code_line(line_num)
+            if idx is None:
+                logger.warning(f"No line with <!-- 绝对编码： after line {line_num}.")
+                return None
+            # Replace the content inside <p>...</o:p> with the answer
+            self._set_line(idx, QUESTION_ANSWER_PATTERN.sub(lambda m: f'<p>{answer}</o:p>', self.lines[idx]), attempt)
+            logger.info(f"Replaced content in line {idx} with answer.")
+            return idx
+
+    def table_end(self, start: int) -> int:
+        """从行下标 start 开始的表格的结束行下标（第一个包含 </table> 的行，没有则为 len(lines)）"""
+        end = self._table_ends.get(start)
+        if end is None:
+            end = start
+            while end < len(self.lines) and '</table>' not in self.lines[end]:
+                end += 1
+            self._table_ends[start] = end
+        return end
+
+    def apply_table_answer(self, line_num: int, ai_table: str, attempt=None) -> int:
+        """
+        把 AI 返回的表格按绝对编码填入从 line_num 开始的表格（到下一个 </table> 为止），
+        返回填写的格子数。只处理 ai_table 中的编码，流式回答逐行回填时每次的开销与行数无关。
+        """
+        with metrics.span('apply_answer', table_start_row=line_num):
+            code_to_answer = parse_table_answer(ai_table)
+            start = line_num - 1
+            end = self.table_end(start)
+            filled = 0
+            for code, answer in code_to_answer.items():
+                rows = [idx for idx in self._code_index.get(code, ()) if start <= idx < end]
+                if not rows:
+                    logger.debug(f"Code {code} from ai_table not found in table at line {line_num}")
+                for idx in rows:
+                    line = self.lines[idx]
+                    logger.info(f"Replacing in line {idx}: {line.strip()} with answer: {answer}")
+                    self._set_line(idx, line.replace('&nbsp;', answer, 1), attempt)
+                    filled += 1
+            return filled
+
+    def text(self) -> str:
+        return ''.join(self.lines)
+
+    def write(self, file_path: str):
+        """原子写回：写入同目录的临时文件后替换原文件"""
+        directory = os.path.dirname(os.path.abspath(file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.writelines(self.lines)
+            # mkstemp 创建的文件权限为 0600，保持与原文件一致
+            mode = os.stat(file_path).st_mode & 0o777 if os.path.exists(file_path) else 0o644
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, file_path)
+            remember_encoding(file_path, 'utf-8')
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
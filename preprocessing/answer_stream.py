@@ -0,0 +1,131 @@
+"""
+流式回答的增量解析
+
+FastGPT 以 SSE 逐段返回回答时，边接收边切分：
+- 问题批次：按 ||| 切分，映射规则与 process_answers 一致，得到 (行号, 答案)
+- 表格请求：每收到一个完整的 <tr>…</tr> 就按绝对编码找到所属表格，得到 (表格起始行, 行)
+
+每解析出一个结果就回调 on_answer，调用方可以立即回填。
+feed(None) 表示这次请求作废（重试或对冲请求中落后的一方）：解析状态和已解析的结果一起丢弃，
+并回调 on_discard()，由调用方撤销已经回填的内容（见 PatchedDocument.discard）。
+请求成功后 close() 解析剩余部分；answers / tables() 是整个回答的解析结果，调用方不必再解析一遍。
+"""
+
+import logging
+from typing import Callable, Dict, List, Optional
+from preprocessing.answer_patch import AI_ROW_PATTERN, split_table_reply
+
+logger = logging.getLogger(__name__)
+
+ANSWER_SEPARATOR = '|||'
+
+
+def clean_answer(value):
+    """答案中的换行替换为空格（回填时一个答案只占一行）"""
+    if isinstance(value, str) and '\n' in value:
+        return value.replace('\n', ' ')
+    return value
+
+
+class QuestionAnswerStream:
+    """把 '答案1|||答案2|||…' 增量地映射到 keys（本批问题的行号）"""
+
+    def __init__(self, keys: List[int], on_answer: Optional[Callable[[int, str], None]] = None,
+                 on_discard: Optional[Callable[[], None]] = None):
+        self.keys = list(keys)
+        self.on_answer = on_answer
+        self.on_discard = on_discard
+        self.reset()
+
+    def reset(self):
+        # {行号: 答案}
+        self.answers = {}
+        self._buffer = ''
+        self._count = 0
+        # None: 还不确定；回答以 <tr> 开头时按表格处理，这里不回调
+        self._is_table = None
+
+    def feed(self, text: Optional[str]):
+        if text is None:
+            self.reset()
+            if self.on_discard is not None:
+                self.on_discard()
+            return
+        self._buffer += text
+        if self._is_table is None:
+            head = self._buffer.lstrip()
+            if len(head) < len('<tr>'):
+                return
+            self._is_table = head.startswith('<tr>')
+        if self._is_table:
+            return
+        *chunks, self._buffer = self._buffer.split(ANSWER_SEPARATOR)
+        for chunk in chunks:
+            self._handle(chunk)
+
+    def close(self):
+        if self._is_table is None:
+            self._is_table = self._buffer.lstrip().startswith('<tr>')
+        if self._is_table:
+            logger.warning(f"Question batch for lines {self.keys} was answered with a table; ignored.")
+        else:
+            self._handle(self._buffer)
+        self._buffer = ''
+
+    def _handle(self, chunk: str):
+        chunk = chunk.strip()
+        if not chunk:
+            return
+        n = self._count
+        self._count += 1
+        if chunk == "=":
+            return
+        if n >= len(self.keys):
+            if n == len(self.keys):
+                logger.warning(f"More answer chunks than questions: chunk {n} will be ignored.")
+            return
+        key, answer = self.keys[n], clean_answer(chunk)
+        self.answers[key] = answer
+        logger.info(f"Mapped answer to line {key}: {answer}")
+        if self.on_answer is not None:
+            self.on_answer(key, answer)
+
+
+class TableRowStream:
+    """把表格回答中每个完整的 <tr>…</tr> 按绝对编码交给所属的表格"""
+
+    def __init__(self, code_owner: Dict[str, int], on_answer: Optional[Callable[[int, str], None]] = None,
+                 on_discard: Optional[Callable[[], None]] = None):
+        self.code_owner = code_owner
+        self.on_answer = on_answer
+        self.on_discard = on_discard
+        self._buffer = ''
+        # {表格起始行: [<tr> 行]}
+        self._rows = {}
+
+    def feed(self, text: Optional[str]):
+        if text is None:
+            self._buffer = ''
+            self._rows = {}
+            if self.on_discard is not None:
+                self.on_discard()
+            return
+        self._buffer += text
+        last_end = 0
+        for match in AI_ROW_PATTERN.finditer(self._buffer):
+            for owner, row in split_table_reply(match.group(0), self.code_owner).items():
+                self._rows.setdefault(owner, []).append(row)
+                if self.on_answer is not None:
+                    self.on_answer(owner, row)
+            last_end = match.end()
+        rest = self._buffer[last_end:]
+        # 只保留可能成为下一行开头的部分
+        start = rest.lower().find('<tr>')
+        self._buffer = rest[start:] if start >= 0 else rest[-(len('<tr>') - 1):]
+
+    def close(self):
+        self._buffer = ''
+
+    def tables(self) -> Dict[int, str]:
+        """与 split_table_reply(完整回答, code_owner) 相同：{表格起始行: 该表格的 <tr> 行（以换行连接）}"""
+        return {owner: '\n'.join(rows) for owner, rows in self._rows.items()}
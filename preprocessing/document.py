@@ -0,0 +1,115 @@
+"""
+内存中的文档
+
+一个文档以对象的形式经过所有阶段：读取原文 → 添加绝对编码 → 简化 → AI 填写 → 回填模板。
+各阶段之间不落盘，默认只写出最终的 _final_filled.html；
+调试时（--keep-intermediates）再写出 _with_comments、_simplified.txt 和 _simplified_copy.txt。
+"""
+
+import logging
+import os
+from typing import Optional
+from configs import metrics
+from preprocessing.agent_call import answer_content
+from preprocessing.answer_patch import split_lines
+from preprocessing.file_encoding import remember_encoding
+from preprocessing.html_html import extract_answers, fill_template_lines
+from preprocessing.html_preprocessing import preprocess_source, simplified_path
+
+logger = logging.getLogger(__name__)
+
+
+class Document:
+    def __init__(self, input_file: str, process_both_steps: bool = True):
+        self.input_file = input_file
+        self.process_both_steps = process_both_steps
+        self.encoding: Optional[str] = None
+        # 各阶段的结果
+        self.with_comments: Optional[str] = None
+        self.simplified: Optional[str] = None
+        # {绝对编码: with_comments 中的行偏移}，预处理时建立
+        self.code_index = {}
+        self.filled: Optional[str] = None
+        self.output: Optional[str] = None
+        self.questions = {}
+        self.answers = {}
+        self.filled_count = 0
+
+    # 输出路径与原来按文件处理时的命名一致
+    @property
+    def with_comments_path(self) -> str:
+        base_name, extension = os.path.splitext(self.input_file)
+        return f"{base_name}_with_comments{extension}"
+
+    @property
+    def simplified_path(self) -> str:
+        # 只执行第一步时，AI 直接处理加了绝对编码的文件
+        return simplified_path(self.input_file) if self.process_both_steps else self.with_comments_path
+
+    @property
+    def agent_path(self) -> str:
+        base_name, extension = os.path.splitext(self.simplified_path)
+        return f"{base_name}_copy{extension}"
+
+    @property
+    def output_path(self) -> str:
+        base_name, _ = os.path.splitext(self.input_file)
+        return f"{base_name}_final_filled.html"
+
+    def preprocess(self, use_template_cache=None) -> "Document":
+        """添加绝对编码并简化"""
+        if not os.path.exists(self.input_file):
+            raise FileNotFoundError(f"文件不存在 - {self.input_file}")
+        self.with_comments, self.encoding, simplified, self.code_index = preprocess_source(
+            self.input_file, self.process_both_steps, use_template_cache)
+        self.simplified = simplified if simplified is not None else self.with_comments
+        return self
+
+    async def answer(self) -> "Document":
+        """AI 填写简化文本"""
+        patched, self.questions, self.answers = await answer_content(self.simplified)
+        self.filled = patched.text()
+        return self
+
+    def fill_template(self) -> "Document":
+        """从填写后的简化文本中提取答案，按行号填入 with_comments 模板"""
+        answers = extract_answers(split_lines(self.filled))
+        lines = split_lines(self.with_comments)
+        self.filled_count = fill_template_lines(lines, answers, self.code_index)
+        self.output = ''.join(lines)
+        print(f"成功填入 {self.filled_count} 个答案")
+        return self
+
+    @metrics.timed('write_intermediates', category='io')
+    def write_intermediates(self):
+        """调试用：写出各阶段的中间文件"""
+        _write_text(self.with_comments_path, self.with_comments, self.encoding)
+        if self.process_both_steps:
+            _write_text(self.simplified_path, self.simplified, 'utf-8')
+        if self.filled is not None:
+            _write_text(self.agent_path, self.filled, 'utf-8')
+
+    @metrics.timed('write_output', category='io')
+    def write_output(self) -> str:
+        _write_text(self.output_path, self.output, self.encoding)
+        return self.output_path
+
+
+def _write_text(path: str, text: str, encoding: str):
+    with open(path, 'w', encoding=encoding) as f:
+        f.write(text)
+    remember_encoding(path, encoding)
+    logger.info(f"Wrote {path}")
+
+
+def preprocess_document(input_file: str, process_both_steps: bool = True, use_template_cache=None) -> Document:
+    """进程池入口：读取并预处理一个文档"""
+    return Document(input_file, process_both_steps).preprocess(use_template_cache)
+
+
+def finish_document(document: Document, keep_intermediates: bool = False) -> str:
+    """进程池入口：回填模板并写出结果，返回输出文件路径"""
+    document.fill_template()
+    if keep_intermediates:
+        document.write_intermediates()
+    return document.write_output()
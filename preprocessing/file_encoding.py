@@ -0,0 +1,88 @@
+"""
+共享的文件编码检测
+
+- 先看 BOM，再看文件开头的 <meta charset> 声明
+- 否则用 chardet 增量检测：只统计含非 ASCII 字节的数据块，达到采样上限或检测器确定后立即停止
+- 结果按 (路径, mtime, 大小) 缓存；本程序写出的派生文件用 remember_encoding 登记已知编码
+"""
+
+import codecs
+import os
+import re
+import chardet
+from config import settings
+
+# 读取块大小（字节）
+_BLOCK_SIZE = 16 * 1024
+# 只在文件开头查找 <meta charset>
+_META_SCAN_BYTES = 8 * 1024
+
+_BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+_META_CHARSET = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([A-Za-z0-9_.:-]+)', re.IGNORECASE)
+
+_encoding_cache = {}
+
+
+def _file_key(file_path):
+    stat = os.stat(file_path)
+    return os.path.abspath(file_path), (stat.st_mtime_ns, stat.st_size)
+
+
+def _known_codec(name):
+    try:
+        codecs.lookup(name)
+        return True
+    except LookupError:
+        return False
+
+
+def _sniff_encoding(file_path, sample_bytes):
+    with open(file_path, 'rb') as file:
+        head = file.read(_META_SCAN_BYTES)
+        for bom, encoding in _BOMS:
+            if head.startswith(bom):
+                return encoding
+        meta = _META_CHARSET.search(head)
+        if meta:
+            encoding = meta.group(1).decode('ascii').lower()
+            if _known_codec(encoding):
+                return encoding
+
+        detector = chardet.UniversalDetector()
+        sampled = 0
+        block = head
+        while block:
+            detector.feed(block)
+            if detector.done:
+                break
+            # 纯 ASCII 的块（例如 Word 的样式表）不计入采样量
+            if not block.isascii():
+                sampled += len(block)
+                if sampled >= sample_bytes:
+                    break
+            block = file.read(_BLOCK_SIZE)
+        detector.close()
+    return detector.result['encoding']
+
+
+def detect_encoding(file_path):
+    """自动检测文件编码（带缓存）"""
+    path, stamp = _file_key(file_path)
+    cached = _encoding_cache.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    encoding = _sniff_encoding(file_path, settings.ENCODING_SAMPLE_BYTES)
+    _encoding_cache[path] = (stamp, encoding)
+    return encoding
+
+
+def remember_encoding(file_path, encoding):
+    """登记本程序写出的文件的编码，之后的 detect_encoding 直接返回"""
+    path, stamp = _file_key(file_path)
+    _encoding_cache[path] = (stamp, encoding)
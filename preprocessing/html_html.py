@@ -1,92 +1,67 @@
-import chardet
+import logging
 import re
 import os
+from preprocessing.file_encoding import detect_encoding
+from configs import metrics
 
-def detect_encoding(file_path):
-    """自动检测文件编码"""
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
-    result = chardet.detect(raw_data)
-    return result['encoding']
+logger = logging.getLogger(__name__)
+
+CODE_COMMENT_PATTERN = re.compile(r'<!-- 绝对编码：(\d+) -->')
+# 简化文本的一行中同时取出：绝对编码、<p>答案<o:p> 和 <o:p>答案</o:p>（各取行内第一次出现，答案位置可以没有）
+ANSWER_LINE_PATTERN = re.compile(
+    r'(?=.*?<!-- 绝对编码：(\d+) -->)'
+    r'(?=(?:.*?<p>(.*?)<o:p>)?)'
+    r'(?=(?:.*?<o:p>(.*?)</o:p>)?)'
+)
+# 模板中答案填入的位置（<span ...><o:p>…</o:p></span> 也由它匹配）
+FILL_PATTERN = re.compile(r'<o:p>(.*?)</o:p>', re.DOTALL)
 
 def extract_answers_from_simplified_html(simplified_html_path):
-    """从简化HTML文件中提取答案"""
+    """从简化HTML文件中提取答案（逐行读取，不把整个文件读入内存）"""
     encoding = detect_encoding(simplified_html_path)
     
     with open(simplified_html_path, 'r', encoding=encoding, errors='ignore') as f:
-        lines = f.readlines()
-    
-    answers_dict = {}
-    
+        return extract_answers(f)
+
+def iter_answers(lines):
+    """
+    逐行扫描简化HTML（任意可迭代的行，如打开的文件），惰性地产出 (绝对编码, 答案)。
+    每行只用 ANSWER_LINE_PATTERN 匹配一次：
+    <p>答案<o:p> 中的答案有效（非空、非 &nbsp;）时取它，否则取 <o:p>答案</o:p>，两者都没有时取前者。
+    """
     for line in lines:
         # 查找包含绝对编码注释的行
-        if '<!-- 绝对编码：3473 -->' in line:
-            print("Line with 3473:", repr(line))
-        if '<!-- 绝对编码：' in line:
-            # 提取绝对编码
-            row_match = re.search(r'<!-- 绝对编码：(\d+) -->', line)
-            if row_match:
-                row_num = int(row_match.group(1))
-                
-                # 在同一行中查找答案内容
-                # 匹配模式：<p>答案内容<o:p></o:p></p> 或类似结构
-                answer_patterns = [
-                    r'<p>(.*?)<o:p>',  # <p>答案<o:p></o:p></p>
-                    r'<o:p>(.*?)</o:p>',  # <p>答案<o:p></o:p></p>
-                    # r'<p>([^<]+)</p>',             # <p>答案</p>
-                    # r'<td>([^<]+)</td>',           # <td>答案</td>
-                    # r'>([^<]+)<o:p>',              # >答案<o:p>
-                ]
-                
-                answer = None
-                for pattern in answer_patterns:
-                    match = re.search(pattern, line)
-                    if match:
-                        answer = match.group(1).strip()
-                        # 过滤掉空答案和特殊字符
-                        if answer and answer != '&nbsp;' and answer != '':
-                            break
-                
-                if answer:
-                    answers_dict[row_num] = answer
-    print("answers_dict", answers_dict)
+        if '<!-- 绝对编码：' not in line:
+            continue
+        match = ANSWER_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        code, in_p, in_op = match.groups()
+        answer = in_p.strip() if in_p is not None else None
+        # 过滤掉空答案和特殊字符
+        if not answer or answer == '&nbsp;':
+            if in_op is not None:
+                answer = in_op.strip()
+        if answer:
+            yield int(code), answer
+
+@metrics.timed('extract_answers')
+def extract_answers(lines):
+    """从简化HTML的各行中提取 {绝对编码: 答案}"""
+    answers_dict = dict(iter_answers(lines))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("answers_dict %r", answers_dict)
     print(f"总共提取到 {len(answers_dict)} 个答案")
     return answers_dict
 
 def fill_html_template(template_html_path, answers_dict, output_html_path):
-    """将答案填入HTML模板文件（按行号直接替换）"""
+    """将答案填入HTML模板文件（按绝对编码所在的行替换）"""
     encoding = detect_encoding(template_html_path)
     
     with open(template_html_path, 'r', encoding=encoding, errors='ignore') as f:
         lines = f.readlines()
     
-    filled_count = 0
-
-    pattern_op = re.compile(r'(<o:p>)(.*?)(</o:p>)', re.DOTALL)
-    pattern_span = re.compile(r'(<span[^>]*><o:p>)(.*?)(</o:p></span>)', re.DOTALL)
-    
-    for row_num, answer in answers_dict.items():
-        idx = row_num - 1  # Convert to 0-based index
-        if 0 <= idx < len(lines):
-            line = lines[idx]
-            print(f"\nProcessing line {idx}: {repr(line)}")
-            print(f"  Targeting line {idx} for code {row_num} with answer: {repr(answer)}")
-            if pattern_op.search(line):
-                print(f"  [o:p] Before: {repr(line)}")
-                lines[idx] = pattern_op.sub(lambda m: m.group(1) + answer + m.group(3), line, count=1)
-                print(f"  [o:p] After:  {repr(lines[idx])}")
-                filled_count += 1
-                print(f"  Filled line {idx} with answer '{answer}'.")
-            elif pattern_span.search(line):
-                print(f"  [span] Before: {repr(line)}")
-                lines[idx] = pattern_span.sub(lambda m: m.group(1) + answer + m.group(3), line, count=1)
-                print(f"  [span] After:  {repr(lines[idx])}")
-                filled_count += 1
-                print(f"  Filled line {idx} with answer '{answer}'.")
-            else:
-                print(f"  No <o:p> or <span><o:p> found to replace in line {idx}.")
-        else:
-            print(f"  Line number {row_num} (index {idx}) is out of range for template.")
+    filled_count = fill_template_lines(lines, answers_dict)
     
     # 保存结果
     with open(output_html_path, 'w', encoding=encoding) as f:
@@ -95,6 +70,52 @@ def fill_html_template(template_html_path, answers_dict, output_html_path):
     print(f"总共填入 {filled_count} 个答案")
     return filled_count
 
+def index_line_codes(lines):
+    """扫描模板各行，建立 {绝对编码: 行偏移}（模板从磁盘读入、没有预处理时建好的索引时使用）"""
+    code_index = {}
+    for offset, line in enumerate(lines):
+        if '<!-- 绝对编码：' in line:
+            match = CODE_COMMENT_PATTERN.search(line)
+            if match:
+                code_index[int(match.group(1))] = offset
+    return code_index
+
+@metrics.timed('fill_template')
+def fill_template_lines(lines, answers_dict, code_index=None):
+    """
+    在模板的各行（list，原地修改）中填入答案，返回填入的个数。
+    code_index: {绝对编码: 行偏移}，由 add_line_codes 建立；不传时扫描 lines 建立。
+    每个答案替换所在行第一个 <o:p>…</o:p> 的内容。
+    """
+    if code_index is None:
+        code_index = index_line_codes(lines)
+    # 逐行的调试输出只在 DEBUG 级别下生成（repr 整行的开销比替换本身还大）
+    debug = logger.isEnabledFor(logging.DEBUG)
+    filled_count = 0
+    missing = 0
+
+    for row_num, answer in answers_dict.items():
+        idx = code_index.get(row_num)
+        if idx is None or not 0 <= idx < len(lines):
+            missing += 1
+            if debug:
+                logger.debug("Code %s is not in the template", row_num)
+            continue
+        line = lines[idx]
+        match = FILL_PATTERN.search(line)
+        if match is None:
+            if debug:
+                logger.debug("No <o:p> found to replace in line %d: %r", idx, line)
+            continue
+        lines[idx] = line[:match.start(1)] + answer + line[match.end(1):]
+        filled_count += 1
+        if debug:
+            logger.debug("Filled line %d (code %s): %r -> %r", idx, row_num, line, lines[idx])
+    if missing:
+        logger.warning(f"{missing} answers have codes that are not in the template")
+    return filled_count
+
+@metrics.timed('html_to_html_fill')
 def html_to_html_fill(simplified_html_path, template_html_path, output_html_path):
     """主函数：从简化HTML提取答案并填入模板HTML"""
     print("=== 开始处理 ===")
@@ -11,7 +11,7 @@
 """
 
 import argparse
-import chardet
+import io
 import os
 import re
 import sys
@@ -19,6 +19,10 @@ from pathlib import Path
 import glob
 from config import settings
 from configs.files_to_process import FILES_TO_PROCESS
+from preprocessing.file_encoding import detect_encoding, remember_encoding
+from preprocessing import template_cache
+from configs import metrics
+from preprocessing.answer_patch import split_lines
 
 # 是否执行两步处理（True=两步都执行，False=只执行第一步添加绝对编码）在.env里面改
 PROCESS_BOTH_STEPS = settings.PROCESS_BOTH_STEPS
@@ -26,21 +30,9 @@ PROCESS_BOTH_STEPS = settings.PROCESS_BOTH_STEPS
 # 是否使用配置文件模式（True=使用上面的配置，False=使用命令行参数）
 USE_CONFIG_MODE = settings.USE_CONFIG_MODE
 
-def detect_encoding(file_path):
-    """自动检测文件编码"""
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
-    result = chardet.detect(raw_data)
-    return result['encoding']
-
-def add_one_space_before_p_in_td(html_content):
-    # For every line that starts with <td> and has spaces before <p>, add one more space before <p>
-    return re.sub(r'(<td>\s*)(<p>)', lambda m: m.group(1) + ' ' + m.group(2), html_content)
-
-
-def add_line_number_to_o_p(htm_file):
+def add_line_number_to_o_p(htm_file, code_index=None):
     """
-    给HTML文件中包含<o:p>&nbsp;</o:p>的行添加绝对编码注释
+    给HTML文件中包含<o:p>&nbsp;</o:p>的行添加绝对编码注释（code_index 见 add_line_codes）
     """
     # 自动检测编码
     encoding = detect_encoding(htm_file)
@@ -50,6 +42,16 @@ def add_line_number_to_o_p(htm_file):
     with open(htm_file, 'r', encoding=encoding, errors='ignore') as file:
         lines = file.readlines()
 
+    # 返回修改后的内容
+    return add_line_codes(lines, code_index), encoding
+
+
+@metrics.timed('add_line_codes')
+def add_line_codes(lines, code_index=None):
+    """
+    给包含<o:p>&nbsp;</o:p>或勾选符号的段落在 </p> 所在行末尾加上绝对编码注释（行号），返回整个文本
+    code_index: 传入 dict 时同时记录 {绝对编码: 该注释在返回文本中的行偏移（0 起）}，回填时按偏移直接定位
+    """
     # 逐行处理，只在符合条件时增加注释
     symbols = ['□', '■', '£']
     processed_lines = []
@@ -65,34 +67,245 @@ def add_line_number_to_o_p(htm_file):
                 # Add comment to this line
                 line = line.rstrip() + f" <!-- 绝对编码：{line_number} -->\n"
                 buffer[-1] = line
+                if code_index is not None:
+                    code_index[line_number] = len(processed_lines) + len(buffer) - 1
             processed_lines.extend(buffer)
             buffer = []
             symbol_found = False
 
     # Add any remaining lines (if file doesn't end with </p>)
     processed_lines.extend(buffer)
+    return ''.join(processed_lines)
 
-    # 返回修改后的内容
-    return ''.join(processed_lines), encoding
+
+# 定义需要完全删除的标签列表
+TAGS_TO_REMOVE = ['span', 'a', 'b', 'i', '!']
+
+# 定义需要简化属性（只保留标签名）的标签列表
+TAGS_TO_SIMPLIFY = ['table', 'p', 'div', 'html', 'h1', 'h2', 'h3', 'h4', 'h5', 'td', 'tr']
+
+# 流式读取的块大小（字符）
+CLEAN_CHUNK_SIZE = 1 << 16
+
+_ABSOLUTE_CODE_COMMENT = '<!-- 绝对编码'
+_REMOVE_TAG = re.compile('<(?:' + '|'.join(re.escape(tag) for tag in TAGS_TO_REMOVE) + ')', re.IGNORECASE)
+_REMOVE_CLOSING_TAGS = {f'</{tag}>' for tag in TAGS_TO_REMOVE} | {f'</{tag.upper()}>' for tag in TAGS_TO_REMOVE}
+_SIMPLIFY_TAGS = [(re.compile(f'<{tag}', re.IGNORECASE), f'<{tag}>') for tag in TAGS_TO_SIMPLIFY]
+_TAG_BOUNDARY = re.compile(r'[<>]')
+_HEAD_OPEN = re.compile(r'<head[^>]*>', re.IGNORECASE)
+_LINE_BREAK = re.compile(r'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+_P_PREFIX = re.compile(r'<p', re.IGNORECASE)
+_P_OPEN = re.compile(r'<p[^>]*>', re.IGNORECASE)
+_P_CLOSE = re.compile(r'</p>', re.IGNORECASE)
+_TD_P = re.compile(r'(<td>\s*)(<p>)')
+_TD_P_PARTIAL = re.compile(r'<(?:t(?:d(?:>\s*(?:<p?)?)?)?)?\Z')
+
+
+def _clean_inside_p(content):
+    # Remove unwanted patterns from the content only
+    content = re.sub(r'font-family:[^;>\n\r]*[;>\n\r]?', '', content, flags=re.IGNORECASE)
+    content = re.sub(r'style=[\'\"].*?[\'\"]', '', content, flags=re.IGNORECASE)
+    content = re.sub(r'style=[^ >]*', '', content, flags=re.IGNORECASE)
+    content = re.sub(r'lang=[\'\"].*?[\'\"]', '', content, flags=re.IGNORECASE)
+    content = re.sub(r'lang=[^ >]*', '', content, flags=re.IGNORECASE)
+    content = re.sub(r'mso-[^;>\n\r]*[;>\n\r]?', '', content, flags=re.IGNORECASE)
+    return content
 
 
 def clean_p_content(html_content):
     # Clean only the inside of <p>...</p> tags, preserving all formatting.
     def clean_inside_p(match):
-        open_tag = match.group(1)
-        content = match.group(2)
-        close_tag = match.group(3)
-        # Remove unwanted patterns from the content only
-        content = re.sub(r'font-family:[^;>\n\r]*[;>\n\r]?', '', content, flags=re.IGNORECASE)
-        content = re.sub(r'style=[\'\"].*?[\'\"]', '', content, flags=re.IGNORECASE)
-        content = re.sub(r'style=[^ >]*', '', content, flags=re.IGNORECASE)
-        content = re.sub(r'lang=[\'\"].*?[\'\"]', '', content, flags=re.IGNORECASE)
-        content = re.sub(r'lang=[^ >]*', '', content, flags=re.IGNORECASE)
-        content = re.sub(r'mso-[^;>\n\r]*[;>\n\r]?', '', content, flags=re.IGNORECASE)
-        return open_tag + content + close_tag
+        return match.group(1) + _clean_inside_p(match.group(2)) + match.group(3)
     return re.sub(r'(<p[^>]*>)(.*?)(</p>)', clean_inside_p, html_content, flags=re.DOTALL|re.IGNORECASE)
 
 
+def add_one_space_before_p_in_td(html_content):
+    # For every line that starts with <td> and has spaces before <p>, add one more space before <p>
+    return re.sub(r'(<td>\s*)(<p>)', lambda m: m.group(1) + ' ' + m.group(2), html_content)
+
+
+def _rewrite_tag(tag):
+    """单个标签经过“删除标签”和“简化属性”两轮处理后的结果"""
+    if tag.startswith(_ABSOLUTE_CODE_COMMENT):
+        return tag
+    if _REMOVE_TAG.match(tag) or tag in _REMOVE_CLOSING_TAGS:
+        return ''
+    for pattern, simple_tag in _SIMPLIFY_TAGS:
+        if pattern.match(tag):
+            return simple_tag
+    return tag
+
+
+def _rewrite_tags(chunks):
+    """
+    第一阶段：删除 <w:data>、删除/简化标签、清空 <head> 内容（只保留换行）。
+    每个 '<' 开始一个标签，到下一个 '>' 结束；如果先遇到下一个 '<'，则前一个 '<' 按普通文本处理。
+    """
+    buf = ''
+    head_open = None  # 正在 <head> 中时为开始标签
+    head_parts = []
+    head_newlines = 0
+
+    def emit(piece, is_tag=False):
+        nonlocal head_open, head_parts, head_newlines
+        if head_open is None:
+            if is_tag and _HEAD_OPEN.match(piece):
+                head_open, head_parts, head_newlines = piece, [], 0
+                return ''
+            return piece
+        if is_tag and piece.lower() == '</head>':
+            out = head_open + '\n' * head_newlines + piece
+            head_open = None
+            return out
+        head_parts.append(piece)
+        head_newlines += piece.count('\n')
+        return ''
+
+    chunks = iter(chunks)
+    eof = False
+    while not eof:
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            buf += chunk
+        out = []
+        pos = 0
+        while pos < len(buf):
+            start = buf.find('<', pos)
+            if start == -1:
+                out.append(emit(buf[pos:]))
+                pos = len(buf)
+                break
+            if start > pos:
+                out.append(emit(buf[pos:start]))
+                pos = start
+            boundary = _TAG_BOUNDARY.search(buf, start + 1)
+            if boundary is None:
+                if eof:
+                    out.append(emit(buf[start:]))
+                    pos = len(buf)
+                break
+            if boundary.group() == '<':
+                out.append(emit(buf[start:boundary.start()]))
+                pos = boundary.start()
+                continue
+            tag = buf[start:boundary.end()]
+            if tag.startswith('<w:data'):
+                data_end = buf.find('</w:data>', boundary.end())
+                if data_end != -1:
+                    pos = data_end + len('</w:data>')
+                    continue
+                if not eof:
+                    break
+            out.append(emit(_rewrite_tag(tag), is_tag=True))
+            pos = boundary.end()
+        buf = buf[pos:]
+        if eof and head_open is not None:
+            # 没有 </head>，原样输出
+            out.append(head_open + ''.join(head_parts))
+            head_open = None
+        yield ''.join(out)
+
+
+def _drop_blank_lines(pieces):
+    """第二阶段：删除空行（与 splitlines() + strip() 的过滤结果一致），行之间用 '\n' 连接"""
+    pending = ''
+    first = True
+    for piece in pieces:
+        pending += piece
+        lines = _LINE_BREAK.split(pending)
+        pending = lines.pop()
+        out = []
+        for line in lines:
+            if line.strip():
+                out.append(line if first else '\n' + line)
+                first = False
+        yield ''.join(out)
+    if pending.strip():
+        yield pending if first else '\n' + pending
+
+
+def _clean_p_blocks(pieces):
+    """第三阶段：清理每个 <p>...</p> 内部的字体、样式、lang 和 mso- 属性"""
+    buf = ''
+    close_from = 0  # 上一次查找 </p> 的结束位置，避免重复扫描
+    pieces = iter(pieces)
+    eof = False
+    while not eof:
+        piece = next(pieces, None)
+        if piece is None:
+            eof = True
+        else:
+            buf += piece
+        out = []
+        pos = 0
+        while True:
+            prefix = _P_PREFIX.search(buf, pos)
+            if prefix is None:
+                cut = len(buf) - 1 if buf.endswith('<') and not eof else len(buf)
+                out.append(buf[pos:cut])
+                pos = cut
+                break
+            open_match = _P_OPEN.match(buf, prefix.start())
+            if open_match is None:
+                if eof:
+                    out.append(buf[pos:])
+                    pos = len(buf)
+                else:
+                    out.append(buf[pos:prefix.start()])
+                    pos = prefix.start()
+                break
+            close_match = _P_CLOSE.search(buf, max(open_match.end(), close_from))
+            if close_match is None:
+                if eof:
+                    out.append(buf[pos:])
+                    pos = len(buf)
+                else:
+                    out.append(buf[pos:prefix.start()])
+                    pos = prefix.start()
+                    close_from = max(open_match.end(), len(buf) - len('</p>'))
+                break
+            out.append(buf[pos:prefix.start()])
+            out.append(open_match.group() + _clean_inside_p(buf[open_match.end():close_match.start()]) + close_match.group())
+            pos = close_match.end()
+            close_from = 0
+        buf = buf[pos:]
+        close_from = max(close_from - pos, 0)
+        yield ''.join(out)
+
+
+def _space_p_in_td(pieces):
+    """第四阶段：<td> 后面紧跟 <p>（中间只有空白）时，在 <p> 前多加一个空格"""
+    buf = ''
+    for piece in pieces:
+        buf += piece
+        partial = _TD_P_PARTIAL.search(buf)
+        cut = partial.start() if partial else len(buf)
+        yield add_one_space_before_p_in_td(buf[:cut])
+        buf = buf[cut:]
+    yield add_one_space_before_p_in_td(buf)
+
+
+def iter_clean_html(chunks):
+    """
+    单次扫描的 HTML 清理：输入为文本块的迭代器，逐块输出清理后的文本。
+    输出与原来多轮 re.sub 的 clean_html 逐字节一致（前提是正文中的 '<' 已转义为 &lt;，
+    Word 导出的 HTML 都是如此），内存占用只取决于最长的标签、段落和 <head>。
+    """
+    return _space_p_in_td(_clean_p_blocks(_drop_blank_lines(_rewrite_tags(chunks))))
+
+
+def _read_chunks(htm_file, encoding):
+    with open(htm_file, 'r', encoding=encoding, errors='ignore') as file:
+        while True:
+            chunk = file.read(CLEAN_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+@metrics.timed('clean_html')
 def clean_html(htm_file):
     """
     清理HTML文件，删除特定标签和属性
@@ -101,54 +314,89 @@ def clean_html(htm_file):
     encoding = detect_encoding(htm_file)
     print(f"文件编码为: {encoding}")
 
-    # 读取HTM文件内容
-    with open(htm_file, 'r', encoding=encoding, errors='ignore') as file:
-        html_content = file.read()
+    return ''.join(iter_clean_html(_read_chunks(htm_file, encoding)))
 
-    # 定义需要完全删除的标签列表
-    tags_to_remove = ['span', 'a', 'b', 'i', '!']
-    
-    # 定义需要简化属性（只保留标签名）的标签列表
-    tags_to_simplify = ['table', 'p', 'div', 'html', 'h1', 'h2', 'h3', 'h4', 'h5', 'td', 'tr']
 
-    html_content = re.sub(r'<w:data[^>]*>.*?</w:data>', '', html_content, flags=re.DOTALL)
+@metrics.timed('clean_html')
+def clean_html_text(content):
+    """清理内存中的 HTML 文本（与 clean_html 的结果相同）"""
+    chunks = (content[start:start + CLEAN_CHUNK_SIZE] for start in range(0, len(content), CLEAN_CHUNK_SIZE))
+    return ''.join(iter_clean_html(chunks))
+
+
+@metrics.timed('clean_html')
+def clean_html_to_file(htm_file, output_file):
+    """
+    清理HTML文件并直接流式写入 output_file（utf-8），不在内存中保留整个文档
+    """
+    encoding = detect_encoding(htm_file)
+    print(f"文件编码为: {encoding}")
+
+    with open(output_file, 'w', encoding='utf-8') as file:
+        for piece in iter_clean_html(_read_chunks(htm_file, encoding)):
+            file.write(piece)
 
-    html_content = re.sub(r'<!-- 绝对编码', '<8888!-- 绝对编码', html_content)
-    
-    # 处理需要完全删除的标签
-    for tag in tags_to_remove:
-        # 删除开始标签及其属性
-        html_content = re.sub(fr'<{tag}[^>]*>', '', html_content, flags=re.IGNORECASE)
-        # 删除结束标签
-        html_content = html_content.replace(f'</{tag}>', '')
-        html_content = html_content.replace(f'</{tag.upper()}>', '')  # 处理大写标签
 
-    html_content = re.sub(r'<8888!-- 绝对编码', '<!-- 绝对编码', html_content)
+def simplified_path(input_file):
+    """第二步输出的简化文件路径"""
+    dir_name = os.path.dirname(input_file)
+    file_name = os.path.basename(input_file)
+    simplified_name = file_name.replace('_with_comments', '')
+    simplified_name = os.path.splitext(simplified_name)[0] + '_simplified.txt'
+    return os.path.join(dir_name, simplified_name)
 
-    # 处理需要简化属性的标签
-    for tag in tags_to_simplify:
-        # 将开始标签替换为简单形式（去掉属性）
-        html_content = re.sub(fr'<{tag}[^>]*>', f'<{tag}>', html_content, flags=re.IGNORECASE)
 
-    # 处理<head>部分 - 保留<head>和</head>标签，只清空中间内容但保留行数
-    html_content = re.sub(r'(<head[^>]*>)(.*?)(</head>)', 
-                         lambda m: m.group(1) + '\n' * m.group(2).count('\n') + m.group(3), 
-                         html_content, 
-                         flags=re.DOTALL | re.IGNORECASE)
+@metrics.timed('read_source')
+def read_source(input_file):
+    """
+    读取原始 .htm：返回 (文本, 编码, 原始字节)。文本与按检测出的编码以文本模式读取的结果相同（换行统一为 \\n）。
+    """
+    encoding = detect_encoding(input_file)
+    print(f"文件编码为: {encoding}")
+    with open(input_file, 'rb') as file:
+        raw = file.read()
+    return io.StringIO(raw.decode(encoding, errors='ignore'), newline=None).read(), encoding, raw
 
-    # 删除空行
-    html_content = '\n'.join([line for line in html_content.splitlines() if line.strip()])
 
-    # Clean inside <p> tags, preserving formatting
-    html_content = clean_p_content(html_content)
-    html_content = add_one_space_before_p_in_td(html_content)
+def preprocess_source(input_file, process_both_steps=True, use_template_cache=None):
+    """
+    在内存中完成两步预处理。
+    Returns: (with_comments 文本, 编码, 简化文本；只执行第一步时为 None, {绝对编码: with_comments 中的行偏移})
+    use_template_cache: 是否使用模板结构缓存（默认取 template_cache 的全局开关；
+        批量模式下由主进程显式传入）
+    """
+    if use_template_cache is None:
+        use_template_cache = template_cache.is_enabled()
+    source, encoding, raw = read_source(input_file)
+    # 同一模板（字节完全相同）只需预处理一次
+    cache_key = None
+    if use_template_cache:
+        cache_key = template_cache.content_hash(raw, process_both_steps)
+        cached = template_cache.load(template_cache.KIND_PREPROCESS, cache_key)
+        if cached is not None:
+            print("✓ 模板缓存命中，跳过预处理")
+            code_index = {code: offset for code, offset in cached['code_index']}
+            return cached['with_comments'], cached['encoding'], cached.get('simplified'), code_index
 
-    return html_content
+    print("步骤1: 添加绝对编码注释...")
+    code_index = {}
+    with_comments = add_line_codes(split_lines(source), code_index)
+    simplified = None
+    if process_both_steps:
+        print("步骤2: 清理HTML结构...")
+        simplified = clean_html_text(with_comments)
+    if cache_key is not None:
+        # JSON 的键只能是字符串，索引按 [编码, 偏移] 对保存
+        entry = {'encoding': encoding, 'with_comments': with_comments, 'code_index': list(code_index.items())}
+        if simplified is not None:
+            entry['simplified'] = simplified
+        template_cache.save(template_cache.KIND_PREPROCESS, cache_key, entry)
+    return with_comments, encoding, simplified, code_index
 
 
-def process_single_file(input_file, process_both_steps=True):
+def process_single_file(input_file, process_both_steps=True, use_template_cache=None):
     """
-    处理单个文件
+    处理单个文件，把两步的结果写到 _with_comments 和 _simplified.txt
     """
     print(f"\n正在处理文件: {input_file}")
     
@@ -159,42 +407,27 @@ def process_single_file(input_file, process_both_steps=True):
     
     # 获取文件路径信息
     base_name, extension = os.path.splitext(input_file)
-    
-    # 第一步：添加绝对编码
-    print("步骤1: 添加绝对编码注释...")
     output_file_step1 = f"{base_name}_with_comments{extension}"
     
     try:
-        content, encoding = add_line_number_to_o_p(input_file)
-        with open(output_file_step1, 'w', encoding=encoding) as file:
-            file.write(content)
-        print(f"✓ 步骤1完成，输出文件: {output_file_step1}")
+        with_comments, encoding, simplified, _ = preprocess_source(input_file, process_both_steps, use_template_cache)
     except Exception as e:
-        print(f"✗ 步骤1失败: {str(e)}")
+        print(f"✗ 预处理失败: {str(e)}")
         return None
-    
-    # 第二步：清理HTML（如果需要）
-    if process_both_steps:
-        print("步骤2: 清理HTML结构...")
-        
-        # 生成简化文件名
-        dir_name = os.path.dirname(input_file)
-        file_name = os.path.basename(input_file)
-        simplified_name = file_name.replace('_with_comments', '')
-        simplified_name = os.path.splitext(simplified_name)[0] + '_simplified.txt'
-        output_file_step2 = os.path.join(dir_name, simplified_name)
-        
-        try:
-            content = clean_html(output_file_step1)
-            with open(output_file_step2, 'w', encoding='utf-8') as file:
-                file.write(content)
-            print(f"✓ 步骤2完成，输出文件: {output_file_step2}")
-            return output_file_step2
-        except Exception as e:
-            print(f"✗ 步骤2失败: {str(e)}")
-    else:
+    with open(output_file_step1, 'w', encoding=encoding) as file:
+        file.write(with_comments)
+    remember_encoding(output_file_step1, encoding)
+    print(f"✓ 步骤1完成，输出文件: {output_file_step1}")
+    if not process_both_steps:
         return output_file_step1
 
+    output_file_step2 = simplified_path(input_file)
+    with open(output_file_step2, 'w', encoding='utf-8') as file:
+        file.write(simplified)
+    remember_encoding(output_file_step2, 'utf-8')
+    print(f"✓ 步骤2完成，输出文件: {output_file_step2}")
+    return output_file_step2
+
 
 def find_files(pattern):
     """
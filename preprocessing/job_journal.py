@@ -0,0 +1,106 @@
+"""
+文档任务日志（断点续跑）
+
+每个文档在输出文件旁边有一个追加写入的 JSONL 日志（xxx_simplified_journal.jsonl），
+每完成（或失败）一个 FastGPT 批次就追加一行：提示词哈希、状态、类型、行号和原始回答。
+使用 --resume 重新运行时，已完成的批次直接从日志回放答案，只有未完成的批次会调用 API。
+"""
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Optional
+from configs import metrics
+
+logger = logging.getLogger(__name__)
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def journal_path(simplified_file: str) -> str:
+    base_name, _ = os.path.splitext(simplified_file)
+    return f"{base_name}_journal.jsonl"
+
+
+class JobJournal:
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._done = {}
+        self.replayed = 0
+        self.recorded = 0
+        if resume and os.path.exists(path):
+            self._load()
+        # 不续跑时清空旧日志，本次运行的记录仍可用于下一次 --resume
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def _load(self):
+        # 最后一个完整行（以换行结尾）之后的字节数
+        complete = 0
+        with open(self.path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    # 进程被杀时最后一行可能只写了一半：截掉，避免新记录接在它后面
+                    logger.warning(f"Truncating incomplete last line of {self.path}")
+                    break
+                complete += len(raw)
+                try:
+                    entry = json.loads(raw.decode('utf-8'))
+                except ValueError:
+                    logger.warning(f"Skipping malformed journal line in {self.path}")
+                    continue
+                if entry.get('status') == STATUS_DONE and entry.get('answer'):
+                    self._done[entry['hash']] = entry['answer']
+        if complete < os.path.getsize(self.path):
+            os.truncate(self.path, complete)
+        logger.info(f"Loaded {len(self._done)} completed batches from {self.path}")
+
+    def __len__(self):
+        return len(self._done)
+
+    def completed(self, key: str) -> Optional[str]:
+        """已完成批次的回答；没有则返回 None"""
+        answer = self._done.get(key)
+        if answer is not None:
+            self.replayed += 1
+        return answer
+
+    def record(self, key: str, kind: str, lines: Iterable[int], answer: Optional[str]):
+        entry = {
+            'hash': key,
+            'status': STATUS_DONE if answer else STATUS_FAILED,
+            'kind': kind,
+            'lines': list(lines),
+            'answer': answer,
+            'time': time.time(),
+        }
+        with metrics.span('journal_write', category='io', kind=kind):
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.recorded += 1
+        if answer:
+            self._done[key] = answer
+
+    def close(self):
+        self._file.close()
+
+
+_journal: ContextVar[Optional[JobJournal]] = ContextVar("job_journal", default=None)
+
+
+@contextmanager
+def use_journal(journal: Optional[JobJournal]):
+    """在 with 块中（包括其中创建的任务）的 FastGPT 批次都记录到 journal"""
+    token = _journal.set(journal)
+    try:
+        yield journal
+    finally:
+        _journal.reset(token)
+
+
+def current_journal() -> Optional[JobJournal]:
+    return _journal.get()
@@ -0,0 +1,99 @@
+"""
+模板结构缓存
+
+同一份问卷模板会为很多家管理人重复填写。模板内容不变时，预处理和结构分析的结果也不变：
+- 预处理：以原始 .htm 字节的哈希为键，保存 _with_comments 输出（及其编码、绝对编码的行索引）和简化后的文本
+- 结构：以简化文本的哈希为键，保存表格（起止行）、表格外的问题和预先切分好的表格块
+
+缓存以 JSON 文件保存在 TEMPLATE_CACHE_DIR 中，写入时先写临时文件再 os.replace，
+批量模式下多个进程同时写入也不会读到半个文件。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Optional
+from config import settings
+from configs import metrics
+
+logger = logging.getLogger(__name__)
+
+# 预处理或结构分析的逻辑改变时递增，使旧缓存失效
+CACHE_VERSION = 2
+
+KIND_PREPROCESS = 'preprocess'
+KIND_STRUCTURE = 'structure'
+
+_enabled = settings.TEMPLATE_CACHE_ENABLED
+
+
+def set_enabled(enabled: bool):
+    """运行时开关缓存（run.py 的 --no-template-cache）"""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def content_hash(data, *params) -> str:
+    """内容（bytes 或 str）加上影响结果的参数的哈希"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    digest = hashlib.sha256(data)
+    digest.update(json.dumps([CACHE_VERSION, *params]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _entry_path(kind: str, key: str) -> Path:
+    return Path(settings.TEMPLATE_CACHE_DIR) / f"{kind}-{key}.json"
+
+
+def load(kind: str, key: str) -> Optional[dict]:
+    if not _enabled:
+        return None
+    path = _entry_path(kind, key)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        metrics.inc('template_cache_requests_total', kind=kind, result='miss')
+        return None
+    except ValueError:
+        logger.warning(f"Ignoring corrupt template cache entry {path}")
+        metrics.inc('template_cache_requests_total', kind=kind, result='miss')
+        return None
+    metrics.inc('template_cache_requests_total', kind=kind, result='hit')
+    logger.info(f"Template cache hit: {path.name}")
+    return entry
+
+
+def save(kind: str, key: str, entry: dict):
+    if not _enabled:
+        return
+    with metrics.span('template_cache_write', category='io', kind=kind):
+        _save(_entry_path(kind, key), entry)
+
+
+def _save(path: Path, entry: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def clear_template_cache():
+    """删除磁盘上的所有模板缓存（即使当前运行关闭了缓存）"""
+    shutil.rmtree(settings.TEMPLATE_CACHE_DIR, ignore_errors=True)
+    logger.info(f"Cleared template cache at {settings.TEMPLATE_CACHE_DIR}")
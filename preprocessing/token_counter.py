@@ -0,0 +1,90 @@
+"""
+共享的 token 计数
+
+- 每个模型的 tiktoken 编码器在进程内只创建一次
+- 计数结果按 (模型, 文本) 做 LRU 缓存：表头、空行等重复行只编码一次
+- count_tokens_batch 一次计算多行，未缓存的文本去重后编码：行数少时直接逐行编码，
+  行数多时交给进程内共享的线程池（tiktoken 编码时释放 GIL）。不使用 encode_batch，
+  它每次调用都会新建一个线程池，而这里每个表格都会调用一次
+"""
+
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import tiktoken
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+_counts = OrderedDict()
+
+# 待编码的文本不少于该数量时才使用线程池
+PARALLEL_BATCH_MIN = 256
+ENCODE_THREADS = 8
+_executor = None
+_executor_pid = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    """进程内共享的编码线程池；fork 出的子进程中重新创建（线程不会被复制）"""
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=ENCODE_THREADS, thread_name_prefix='token-count')
+        _executor_pid = os.getpid()
+    return _executor
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str = DEFAULT_MODEL):
+    """返回模型对应的编码器（进程内缓存）；未知模型退回 cl100k_base"""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning(f"Unknown model {model} for tiktoken, falling back to cl100k_base.")
+        return tiktoken.get_encoding("cl100k_base")
+
+def _remember(key, count: int):
+    _counts[key] = count
+    if len(_counts) > settings.TOKEN_COUNT_CACHE_SIZE:
+        _counts.popitem(last=False)
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    key = (model, text)
+    count = _counts.get(key)
+    if count is not None:
+        _counts.move_to_end(key)
+        return count
+    count = len(get_encoder(model).encode(text))
+    _remember(key, count)
+    return count
+
+def count_tokens_batch(texts, model: str = DEFAULT_MODEL) -> list:
+    """按顺序返回每段文本的 token 数"""
+    texts = list(texts)
+    # 本次用到的计数；缓存很小时，已缓存的值可能被本次新算出的值淘汰，所以不再回查缓存
+    counts = {}
+    missing = {}  # 保持顺序的去重
+    for text in texts:
+        key = (model, text)
+        if text in counts or text in missing:
+            continue
+        if key in _counts:
+            _counts.move_to_end(key)
+            counts[text] = _counts[key]
+        else:
+            missing[text] = None
+    if missing:
+        encoder = get_encoder(model)
+        if len(missing) < PARALLEL_BATCH_MIN:
+            encoded = [encoder.encode(text) for text in missing]
+        else:
+            encoded = _get_executor().map(encoder.encode, missing)
+        for text, tokens in zip(missing, encoded):
+            counts[text] = len(tokens)
+            _remember((model, text), counts[text])
+    return [counts[text] for text in texts]
+
+def clear_token_cache():
+    _counts.clear()
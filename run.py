@@ -1,53 +1,259 @@
 import sys
 import argparse
+import json
 import os
-import shutil
 import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
 from config import settings
 from configs.files_to_process import FILES_TO_PROCESS
-from preprocessing.html_preprocessing import process_single_file, find_files
-from preprocessing.agent_call import process_file
-from preprocessing.html_html import html_to_html_fill
+from contextlib import contextmanager
+from preprocessing.html_preprocessing import find_files
+from preprocessing.document import preprocess_document, finish_document
+from configs.AI_calls import close_client, set_global_concurrency
+from configs import AI_cache
+from preprocessing.job_journal import JobJournal, journal_path, use_journal
+from preprocessing import template_cache
+from configs import metrics, trace
 
 PROCESS_BOTH_STEPS = settings.PROCESS_BOTH_STEPS
 USE_CONFIG_MODE = settings.USE_CONFIG_MODE
 
-async def run_agent_on_file(simplified_file):
-    # Make a copy for agent processing
-    base_name, extension = os.path.splitext(simplified_file)
-    agent_file = f"{base_name}_copy{extension}"
-    shutil.copyfile(simplified_file, agent_file)
-    print(f"Copied {simplified_file} to {agent_file}")
-    # Run the async agent on the copy
-    await process_file(agent_file)
-    print(f"Agent processing complete for {agent_file}")
-    return agent_file
-
-def process_and_run_agent(input_file, process_both_steps=True):
-    # Step 1: Preprocess and create simplified file
-    simplified_file = process_single_file(input_file, process_both_steps)
-    # Step 2: Find the simplified file name
-    base_name, extension = os.path.splitext(input_file)
-    # Step 3: Run the async agent on the copy
-    agent_file = asyncio.run(run_agent_on_file(simplified_file))
-    template_html = f"{base_name}_with_comments{extension}"
-    output_html = f"{base_name}_final_filled.html"
-    html_to_html_fill(agent_file, template_html, output_html)
+# --timings 指定的 JSONL 文件，每处理完一个文档追加一行各阶段耗时
+TIMINGS_FILE = None
+
+# 运行报告的输出目录（--report-dir），None 表示 METRICS_REPORT_DIR
+REPORT_DIR = None
+
+# --trace 指定的 Chrome trace 输出文件
+TRACE_FILE = None
+
+def record_stage(timings, stage, seconds):
+    """记录一个阶段的耗时（秒）到 timings[stage]，同时计入运行指标"""
+    timings[stage] = seconds
+    metrics.observe(metrics.DOCUMENT_SECONDS, seconds, stage=stage)
+
+@contextmanager
+def timed_stage(timings, stage):
+    start = time.perf_counter()
+    # 时间线中整个文档的事件显示为 "document"
+    with trace.event('document' if stage == 'total' else stage, 'document', metrics.current_document()):
+        try:
+            yield
+        finally:
+            record_stage(timings, stage, time.perf_counter() - start)
+
+def record_timings(input_file, timings, error=None):
+    metrics.inc('documents_total', status='ok' if error is None else 'failed')
+    if TIMINGS_FILE is None:
+        return
+    entry = {'file': input_file, 'stages': timings, 'error': None if error is None else str(error)}
+    with open(TIMINGS_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+@contextmanager
+def document_journal(simplified_file, resume=False):
+    """为一个文档打开任务日志（JOB_JOURNAL_ENABLED 关闭时不记录）"""
+    journal = JobJournal(journal_path(simplified_file), resume=resume) if settings.JOB_JOURNAL_ENABLED else None
+    try:
+        with use_journal(journal):
+            yield journal
+    finally:
+        if journal is not None:
+            journal.close()
+    if journal is not None and resume:
+        print(f"从任务日志恢复 {journal.replayed} 个批次，新调用 {journal.recorded} 个批次")
+
+async def run_agent_on_document(document, resume=False):
+    """在内存中对文档运行 AI 填写"""
+    with document_journal(document.simplified_path, resume):
+        await document.answer()
+    print(f"Agent processing complete for {document.input_file}")
+    return document
+
+async def run_single_agent(document, resume=False):
+    try:
+        return await run_agent_on_document(document, resume)
+    finally:
+        await close_client()
+
+def process_and_run_agent(input_file, process_both_steps=True, resume=False, keep_intermediates=False):
+    print(f"\n正在处理文件: {input_file}")
+    timings = {}
+    try:
+        with metrics.use_document(input_file), timed_stage(timings, 'total'):
+            # Step 1: Preprocess in memory
+            with timed_stage(timings, 'preprocess'):
+                document = preprocess_document(input_file, process_both_steps)
+            # Step 2: Run the async agent
+            with timed_stage(timings, 'answer'):
+                asyncio.run(run_single_agent(document, resume))
+            # Step 3: Fill the answers back into the template
+            with timed_stage(timings, 'fill'):
+                output_html = finish_document(document, keep_intermediates)
+    except Exception as e:
+        record_timings(input_file, timings, e)
+        raise
+    record_timings(input_file, timings)
     print(f"Final filled HTML saved to: {output_html}")
 
+async def run_in_worker(pool, input_file, func, *args):
+    """在进程池中运行 func，并把子进程中记录的指标合并到本进程"""
+    loop = asyncio.get_running_loop()
+    result, snapshot = await loop.run_in_executor(
+        pool, metrics.call_in_worker, metrics.worker_context(input_file), func, *args)
+    metrics.merge(snapshot)
+    return result
+
+async def process_document_in_batch(input_file, process_both_steps, pool, document_slots, resume=False,
+                                    keep_intermediates=False):
+    """
+    批量模式下处理单个文档：预处理和模板回填在进程池中运行，AI 调用在共享的事件循环中运行。
+    Returns: (input_file, output_html 或 None, 异常或 None, 耗时秒数)
+    """
+    timings = {}
+    with metrics.use_document(input_file):
+        with timed_stage(timings, 'total'):
+            # 等待文档名额的时间也计入总耗时
+            with timed_stage(timings, 'queued'):
+                await document_slots.acquire()
+            try:
+                with timed_stage(timings, 'preprocess'):
+                    document = await run_in_worker(pool, input_file, preprocess_document, input_file,
+                                                   process_both_steps, template_cache.is_enabled())
+                with timed_stage(timings, 'answer'):
+                    await run_agent_on_document(document, resume)
+                with timed_stage(timings, 'fill'):
+                    output_html = await run_in_worker(pool, input_file, finish_document, document, keep_intermediates)
+                error = None
+            except Exception as e:
+                output_html, error = None, e
+            finally:
+                document_slots.release()
+        record_timings(input_file, timings, error)
+    return input_file, output_html, error, timings['total']
+
+async def run_batch(files, process_both_steps=True, workers=None, max_documents=None, resume=False,
+                    keep_intermediates=False):
+    """
+    并发处理多个文档：所有文档共享一个事件循环和一个 FastGPT 并发预算，
+    CPU 密集的预处理在进程池中并行执行。
+    """
+    workers = workers or settings.BATCH_WORKERS or os.cpu_count()
+    document_slots = asyncio.Semaphore(max_documents or settings.BATCH_MAX_DOCUMENTS)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = await asyncio.gather(*[
+                process_document_in_batch(file_path, process_both_steps, pool, document_slots, resume,
+                                          keep_intermediates)
+                for file_path in files
+            ])
+    finally:
+        await close_client()
+    return results
+
+def print_batch_report(results):
+    print("\n=== 批量处理结果 ===")
+    for input_file, output_html, error, elapsed in results:
+        if error is None:
+            print(f"✓ {input_file} ({elapsed:.1f}s) -> {output_html}")
+        else:
+            print(f"✗ {input_file} ({elapsed:.1f}s): {error}")
+    success_count = sum(1 for result in results if result[2] is None)
+    print(f"成功处理 {success_count}/{len(results)} 个文件")
+    return success_count
+
+def add_run_arguments(parser):
+    parser.add_argument('--no-cache', action='store_true',
+                       help='不使用 FastGPT 答案缓存（既不读取也不写入）')
+    parser.add_argument('--clear-cache', action='store_true',
+                       help='运行前清空 FastGPT 答案缓存和模板结构缓存')
+    parser.add_argument('--no-template-cache', action='store_true',
+                       help='不使用模板结构缓存（每次都重新预处理和分析文档结构）')
+    parser.add_argument('--batch', action='store_true',
+                       help='批量模式：多个文档并发处理（预处理使用进程池，AI 调用共享一个事件循环）')
+    parser.add_argument('--workers', type=int, default=None,
+                       help='批量模式下预处理进程数（默认 BATCH_WORKERS 或 CPU 核数）')
+    parser.add_argument('--max-concurrent', type=int, default=None,
+                       help='所有文档共享的 FastGPT 并发请求数（默认 FASTGPT_GLOBAL_CONCURRENCY）')
+    parser.add_argument('--hedge', action='store_true',
+                       help='对冲请求：超过近期延迟分位数（FASTGPT_HEDGE_PERCENTILE）仍未返回的请求再发一次，先返回的为准')
+    parser.add_argument('--keep-intermediates', action='store_true',
+                       help='调试用：写出中间文件（_with_comments、_simplified.txt、_simplified_copy.txt）')
+    parser.add_argument('--resume', action='store_true',
+                       help='断点续跑：已在任务日志中完成的批次直接回放答案，只重新调用未完成的批次')
+    parser.add_argument('--report-dir', default=None,
+                       help='运行报告（run_report.json、metrics.prom）的输出目录（默认 METRICS_REPORT_DIR）')
+    parser.add_argument('--no-metrics', action='store_true',
+                       help='不记录运行指标，也不写出运行报告')
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                       help='把文档、阶段、批次、限流等待、HTTP 尝试和文件写入的时间线写到 FILE'
+                            '（Chrome trace 格式，可在 chrome://tracing 或 Perfetto 中打开）')
+    parser.add_argument('--timings', metavar='FILE', default=None,
+                       help='每处理完一个文档，向 FILE（JSONL）追加一行各阶段耗时（预处理、AI 填写、回填）')
+
+def apply_run_arguments(args):
+    global TIMINGS_FILE, REPORT_DIR, TRACE_FILE
+    TIMINGS_FILE = args.timings
+    REPORT_DIR = args.report_dir
+    TRACE_FILE = args.trace
+    trace.set_enabled(TRACE_FILE is not None)
+    if args.no_metrics:
+        metrics.set_enabled(False)
+    if args.clear_cache:
+        AI_cache.clear_answer_cache()
+        template_cache.clear_template_cache()
+        print("已清空 FastGPT 答案缓存和模板结构缓存")
+    if args.no_cache:
+        AI_cache.set_enabled(False)
+    if args.no_template_cache:
+        template_cache.set_enabled(False)
+    if args.max_concurrent:
+        set_global_concurrency(args.max_concurrent)
+    if args.hedge:
+        settings.FASTGPT_HEDGE_ENABLED = True
+
+def run_files(files, process_both_steps, args):
+    """逐个处理或批量并发处理，返回成功的文件数；结束时写出运行报告"""
+    metrics.reset()
+    trace.reset()
+    try:
+        if args.batch:
+            results = asyncio.run(run_batch(files, process_both_steps, workers=args.workers, resume=args.resume,
+                                            keep_intermediates=args.keep_intermediates))
+            return print_batch_report(results)
+        success_count = 0
+        for file_path in files:
+            try:
+                process_and_run_agent(file_path, process_both_steps, args.resume, args.keep_intermediates)
+                success_count += 1
+            except Exception as e:
+                print(f"处理文件 {file_path} 时出错: {str(e)}")
+                continue
+        return success_count
+    finally:
+        write_run_report()
+        if TRACE_FILE is not None:
+            print(f"时间线: {TRACE_FILE}（{trace.write(TRACE_FILE)} 个事件，可在 chrome://tracing 或 Perfetto 中打开）")
+
+def write_run_report():
+    if not metrics.is_enabled():
+        return
+    report_path, prom_path = metrics.write_reports(REPORT_DIR)
+    tokens = metrics.build_report()['tokens']
+    print(f"运行报告: {report_path}（Prometheus: {prom_path}）")
+    print(f"FastGPT token: 提示 {tokens['prompt']:.0f}，回答 {tokens['completion']:.0f}")
+
 def run_config_mode():
+    parser = argparse.ArgumentParser(description='尽调报告预处理工具 - 配置模式')
+    add_run_arguments(parser)
+    args = parser.parse_args()
+    apply_run_arguments(args)
     print("=== 尽调报告预处理工具 - 配置模式运行 ===")
     print(f"要处理的文件数量: {len(FILES_TO_PROCESS)}")
     print(f"处理步骤: {'两步都执行' if PROCESS_BOTH_STEPS else '只执行第一步（添加绝对编码）'}")
     print("\n开始处理...")
-    success_count = 0
-    for file_path in FILES_TO_PROCESS:
-        try:
-            process_and_run_agent(file_path, PROCESS_BOTH_STEPS)
-            success_count += 1
-        except Exception as e:
-            print(f"处理文件 {file_path} 时出错: {str(e)}")
-            continue
+    success_count = run_files(FILES_TO_PROCESS, PROCESS_BOTH_STEPS, args)
     print(f"\n处理完成！成功处理 {success_count}/{len(FILES_TO_PROCESS)} 个文件")
 
 def main():
@@ -55,7 +261,9 @@ def main():
     parser.add_argument('files', nargs='+', help='输入文件路径（支持通配符）')
     parser.add_argument('-s', '--steps', choices=['1', '2', 'both'], default='both',
                        help='处理步骤：1=只添加绝对编码, 2=只清理HTML, both=两步都执行（默认）')
+    add_run_arguments(parser)
     args = parser.parse_args()
+    apply_run_arguments(args)
     all_files = []
     for pattern in args.files:
         found_files = find_files(pattern)
@@ -67,13 +275,7 @@ def main():
         print("错误：没有找到要处理的文件")
         sys.exit(1)
     print(f"找到 {len(all_files)} 个文件需要处理")
-    for file_path in all_files:
-        try:
-            process_both = args.steps == 'both'
-            process_and_run_agent(file_path, process_both)
-        except Exception as e:
-            print(f"处理文件 {file_path} 时出错: {str(e)}")
-            continue
+    run_files(all_files, args.steps == 'both', args)
     print("所有文件处理完成！")
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+import asyncio
+import httpx
+from configs import AI_calls, AI_cache
+from configs.AI_cache import AnswerCache, prompt_hash
+
+
+def test_cache_ttl_and_lru(tmp_path):
+    cache = AnswerCache(tmp_path / "answers.sqlite3", ttl=0, max_entries=2)
+    cache.put("a", "答案a")
+    cache.put("b", "答案b")
+    assert cache.get("a") == "答案a"  # a 变为最近访问
+    cache.put("c", "答案c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "答案a"
+    assert len(cache) == 2
+
+    expired = AnswerCache(tmp_path / "ttl.sqlite3", ttl=1e-9)
+    expired.put("a", "答案a")
+    assert expired.get("a") is None
+
+
+def test_prompt_hash_depends_on_url():
+    assert prompt_hash("问题", "http://a") != prompt_hash("问题", "http://b")
+    assert prompt_hash("问题", "http://a") == prompt_hash("问题", "http://a")
+
+
+def test_call_fastgpt_uses_cache(tmp_path, monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "答案"}}]})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        first = await AI_calls.call_fastgpt("相同的问题")
+        second = await AI_calls.call_fastgpt("相同的问题")
+        await AI_calls.close_client()
+        return first, second
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_cache", AnswerCache(tmp_path / "answers.sqlite3"))
+    monkeypatch.setattr(AI_cache, "_enabled", True)
+    assert asyncio.run(main()) == ("答案", "答案")
+    assert len(calls) == 1
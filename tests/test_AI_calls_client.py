@@ -0,0 +1,373 @@
+import asyncio
+import json
+import time
+import httpx
+from configs import AI_calls, AI_cache
+
+
+def _mock_transport(delay=0.2):
+    in_flight = {"now": 0, "peak": 0}
+
+    async def handler(request):
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(delay)
+        in_flight["now"] -= 1
+        return httpx.Response(200, json={"choices": [{"message": {"content": "答案1|||答案2"}}]})
+
+    return httpx.MockTransport(handler), in_flight
+
+
+def test_call_fastgpt_runs_concurrently(monkeypatch):
+    async def main():
+        transport, in_flight = _mock_transport()
+        AI_calls.init_client(transport=transport)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[AI_calls.call_fastgpt(f"问题{i}") for i in range(8)])
+        elapsed = time.perf_counter() - start
+        await AI_calls.close_client()
+        return results, elapsed, in_flight["peak"]
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    results, elapsed, peak = asyncio.run(main())
+    assert results == ["答案1|||答案2"] * 8
+    assert peak == 8
+    # 8 个 0.2 秒的请求如果串行需要 1.6 秒
+    assert elapsed < 0.8
+
+
+def test_client_is_shared_within_loop():
+    async def main():
+        first = AI_calls.get_client()
+        second = AI_calls.get_client()
+        await AI_calls.close_client()
+        return first is second
+
+    assert asyncio.run(main())
+
+
+
+def _run_with_responses(monkeypatch, responses, deadline=None, **call_kwargs):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return responses[min(len(calls), len(responses)) - 1]
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        try:
+            with AI_calls.document_deadline(deadline):
+                return await AI_calls.call_fastgpt("问题", **call_kwargs)
+        finally:
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    monkeypatch.setattr(AI_calls.settings, "FASTGPT_BACKOFF_BASE", 0.01)
+    return asyncio.run(main()), calls
+
+
+def test_retryable_errors_back_off_and_retry(monkeypatch):
+    ok = httpx.Response(200, json={"choices": [{"message": {"content": "答案"}}]})
+    throttled = httpx.Response(429, headers={"Retry-After": "0"})
+    result, calls = _run_with_responses(monkeypatch, [throttled, httpx.Response(503), ok])
+    assert result == "答案"
+    assert len(calls) == 3
+
+
+def test_fatal_errors_are_not_retried(monkeypatch):
+    result, calls = _run_with_responses(monkeypatch, [httpx.Response(401, text="unauthorized")])
+    assert result is None
+    assert len(calls) == 1
+
+
+def test_document_deadline_stops_retries(monkeypatch):
+    start = time.perf_counter()
+    throttled = httpx.Response(503, headers={"Retry-After": "10"})
+    result, calls = _run_with_responses(monkeypatch, [throttled], deadline=0.5, retries=5)
+    assert result is None
+    assert len(calls) == 1
+    assert time.perf_counter() - start < 0.5
+
+
+def test_deadline_covers_waiting_for_a_slot(monkeypatch):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "答案"}}]})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        # 第一个请求占住唯一的名额
+        busy = asyncio.create_task(AI_calls.call_fastgpt("慢问题"))
+        await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        try:
+            with AI_calls.document_deadline(0.2):
+                result = await AI_calls.call_fastgpt("问题")
+            return result, time.perf_counter() - start
+        finally:
+            busy.cancel()
+            await asyncio.gather(busy, return_exceptions=True)
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    monkeypatch.setattr(AI_calls, "_global_concurrency", 1)
+    result, waited = asyncio.run(main())
+    assert result is None and waited < 0.4
+
+
+def test_attempt_timeout_bounds_the_whole_request(monkeypatch):
+    async def handler(request):
+        # MockTransport 不受 httpx 的读写超时限制
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "答案"}}]})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        try:
+            return await AI_calls.call_fastgpt("问题", retries=1, timeout=0.1)
+        finally:
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    start = time.perf_counter()
+    assert asyncio.run(main()) is None
+    assert time.perf_counter() - start < 0.5
+
+
+def test_parse_retry_after():
+    assert AI_calls.parse_retry_after("3") == 3.0
+    assert AI_calls.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert AI_calls.parse_retry_after(None) is None
+
+
+def test_hedge_policy_delay_and_budget():
+    from configs.rate_limiter import HedgePolicy
+
+    policy = HedgePolicy(percentile=90, budget=0.1, min_samples=10)
+    for latency in range(1, 10):
+        policy.observe(latency / 10)
+    # 样本不足时不对冲
+    assert policy.delay() is None
+    policy.observe(1.0)
+    assert policy.delay() == 0.9
+    for _ in range(20):
+        policy.record_request()
+    assert [policy.try_acquire() for _ in range(3)] == [True, True, False]
+
+
+def _run_hedged(monkeypatch, slow_first, budget=1.0):
+    from configs import metrics
+    from configs.rate_limiter import HedgePolicy
+
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        if slow_first and len(requests) == 1:
+            try:
+                await asyncio.sleep(0.5)
+            except asyncio.CancelledError:
+                requests.append("cancelled")
+                raise
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"答案{len(requests)}"}}]})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        AI_calls.get_limiter().hedge = HedgePolicy(percentile=50, budget=budget, min_samples=1)
+        AI_calls.get_limiter().hedge.observe(0.05)
+        try:
+            start = time.perf_counter()
+            result = await AI_calls.call_fastgpt("问题")
+            return result, time.perf_counter() - start
+        finally:
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    metrics.reset()
+    result, elapsed = asyncio.run(main())
+    return result, elapsed, requests, metrics.build_report()["hedging"]
+
+
+def test_slow_request_is_hedged_and_loser_cancelled(monkeypatch):
+    result, elapsed, requests, hedging = _run_hedged(monkeypatch, slow_first=True)
+    assert result == "答案2"
+    assert elapsed < 0.4
+    assert requests[-1] == "cancelled"
+    assert hedging["hedges"] == 1 and hedging["wins"] == 1 and hedging["win_rate"] == 1.0
+
+
+def test_fast_request_is_not_hedged(monkeypatch):
+    result, _, requests, hedging = _run_hedged(monkeypatch, slow_first=False)
+    assert result == "答案1" and len(requests) == 1
+    assert hedging["hedges"] == 0
+
+
+def test_hedge_budget_caps_extra_requests(monkeypatch):
+    # 预算为 0：慢请求也不对冲
+    result, elapsed, requests, hedging = _run_hedged(monkeypatch, slow_first=True, budget=0)
+    assert result == "答案1" and elapsed >= 0.5
+    assert hedging["hedges"] == 0
+
+
+def test_identical_in_flight_prompts_share_one_request(monkeypatch):
+    from configs import metrics
+
+    async def main():
+        transport, in_flight = _mock_transport(delay=0.1)
+        calls = []
+
+        async def handler(request):
+            calls.append(request)
+            return await transport.handler(request)
+
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        received = []
+        try:
+            results = await asyncio.gather(
+                *[AI_calls.call_fastgpt("同一个问题", on_delta=received.append) for _ in range(5)],
+                AI_calls.call_fastgpt("另一个问题"),
+            )
+        finally:
+            await AI_calls.close_client()
+        return results, len(calls), received
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    metrics.reset()
+    results, requests, received = asyncio.run(main())
+    assert results == ["答案1|||答案2"] * 6
+    assert requests == 2
+    # 每个调用方都收到完整答案
+    assert received == ["答案1|||答案2"] * 5
+    assert metrics.build_report()["coalescing"]["coalesced_calls"] == 4
+    assert AI_calls._flights == {}
+
+
+def test_cancelled_caller_does_not_cancel_shared_request(monkeypatch):
+    async def main():
+        transport, _ = _mock_transport(delay=0.1)
+        AI_calls.init_client(transport=transport)
+        try:
+            first = asyncio.create_task(AI_calls.call_fastgpt("同一个问题"))
+            second = asyncio.create_task(AI_calls.call_fastgpt("同一个问题"))
+            await asyncio.sleep(0.02)
+            first.cancel()
+            return await second
+        finally:
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    assert asyncio.run(main()) == "答案1|||答案2"
+
+
+def _sse(text):
+    return f"data: {json.dumps({'choices': [{'delta': {'content': text}}]}, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def test_streamed_deltas_end_with_the_extracted_answer(monkeypatch):
+    table = "| 问题 | 答案 |\n| --- | --- |\n| 公司名称 | 示例公司 |"
+
+    def handler(request):
+        return httpx.Response(200, content=_sse(table) + b"data: [DONE]\n\n",
+                              headers={"Content-Type": "text/event-stream"})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        try:
+            return await AI_calls.call_fastgpt("问题", on_delta=deltas.append)
+        finally:
+            await AI_calls.close_client()
+
+    deltas = []
+    monkeypatch.setattr(AI_calls.settings, "FASTGPT_STREAM", True)
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    # extract_answer 从 Markdown 表格中取出答案：流出的表格作废，最后交出的是返回的答案
+    assert asyncio.run(main()) == "示例公司"
+    assert deltas == [table, None, "示例公司"]
+
+
+def test_streamed_rows_of_losing_hedge_are_discarded(monkeypatch):
+    from configs.rate_limiter import HedgePolicy
+    from preprocessing.agent_call import get_table_answers
+    from preprocessing.answer_patch import PatchedDocument
+
+    document = PatchedDocument.from_text(
+        "<table>\n"
+        "<tr><td><p>联系人<o:p></o:p></p></td><td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：31 --></td></tr>\n"
+        "<tr><td><p>电话<o:p></o:p></p></td><td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：52 --></td></tr>\n"
+        "</table>\n")
+    chunk = "<tr>\n 联系人\n &nbsp; <!-- 绝对编码：31 -->\n</tr>\n<tr>\n 电话\n &nbsp; <!-- 绝对编码：52 -->\n</tr>"
+    requests = []
+    primary_streamed = asyncio.Event()
+
+    async def slow_primary():
+        yield _sse("<tr>\n 联系人\n 旧答案 <!-- 绝对编码：31 -->\n</tr>\n<tr>\n 电话\n 旧电话 <!-- 绝对编码：52 -->\n</tr>")
+        primary_streamed.set()
+        await asyncio.sleep(0.5)
+        yield b"data: [DONE]\n\n"
+
+    async def fast_backup():
+        # 对冲请求在主请求已经流出两行之后才返回
+        await primary_streamed.wait()
+        yield _sse("<tr>\n 联系人\n 新答案 <!-- 绝对编码：31 -->\n</tr>")
+        yield b"data: [DONE]\n\n"
+
+    async def handler(request):
+        requests.append(request)
+        body = slow_primary() if len(requests) == 1 else fast_backup()
+        return httpx.Response(200, content=body, headers={"Content-Type": "text/event-stream"})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        AI_calls.get_limiter().hedge = HedgePolicy(percentile=50, budget=1.0, min_samples=1)
+        AI_calls.get_limiter().hedge.observe(0.05)
+        try:
+            return await get_table_answers([(1, chunk)],
+                                           on_answer=lambda line, rows: document.apply_table_answer(line, rows, "pack"),
+                                           on_discard=lambda: document.discard("pack"))
+        finally:
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls.settings, "FASTGPT_STREAM", True)
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    answers = asyncio.run(main())
+    assert len(requests) == 2
+    assert "新答案" in answers[1]
+    text = document.text()
+    assert "新答案" in text
+    assert "旧答案" not in text and "旧电话" not in text
+
+
+def test_coalesced_caller_keeps_its_own_deadline(monkeypatch):
+    async def main():
+        transport, _ = _mock_transport(delay=0.5)
+        AI_calls.init_client(transport=transport)
+
+        async def follower():
+            await asyncio.sleep(0.01)
+            with AI_calls.document_deadline(0.1):
+                start = time.perf_counter()
+                result = await AI_calls.call_fastgpt("同一个问题")
+                return result, time.perf_counter() - start
+
+        try:
+            leader, (followed, waited) = await asyncio.gather(AI_calls.call_fastgpt("同一个问题"), follower())
+        finally:
+            await AI_calls.close_client()
+        return leader, followed, waited
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    leader, followed, waited = asyncio.run(main())
+    # 截止时间更短的调用方按时放弃，请求仍为第一个调用方完成
+    assert followed is None and waited < 0.3
+    assert leader == "答案1|||答案2"
@@ -0,0 +1,84 @@
+from preprocessing.answer_patch import CODE_PATTERN, PatchedDocument, parse_table_answer
+
+SIMPLIFIED = """<div>
+<p>1. 公司名称<o:p></o:p></p>
+<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：12 -->
+<p>2. 成立时间<o:p></o:p></p>
+<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：20 -->
+<table>
+ <tr>
+  <td>
+   <p>联系人<o:p></o:p></p>
+  </td>
+  <td>
+   <p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：31 -->
+  </td>
+ </tr>
+</table>
+</div>
+"""
+
+AI_TABLE = """<tr>
+  联系人
+  张三 <!-- 绝对编码：31 -->
+</tr>"""
+
+
+def test_parse_table_answer():
+    assert parse_table_answer(AI_TABLE) == {"31": "张三"}
+
+
+def test_apply_all_answers_in_one_pass(tmp_path):
+    path = tmp_path / "report_simplified_copy.txt"
+    path.write_text(SIMPLIFIED, encoding="utf-8")
+    document = PatchedDocument.load(str(path))
+    assert document.apply_question_answer(2, "示例公司") == 2
+    assert document.apply_question_answer(4, "2021年") == 4
+    assert document.apply_table_answer(6, AI_TABLE) == 1
+    document.write(str(path))
+
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert lines[2] == "<p>示例公司</o:p></p> <!-- 绝对编码：12 -->"
+    assert lines[4] == "<p>2021年</o:p></p> <!-- 绝对编码：20 -->"
+    assert lines[11] == "   <p>张三<o:p></o:p></p> <!-- 绝对编码：31 -->"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_from_text_matches_readlines(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text(SIMPLIFIED, encoding="utf-8")
+    assert PatchedDocument.from_text(SIMPLIFIED).lines == PatchedDocument.load(str(path)).lines
+
+
+def legacy_apply_table_answer(lines, line_num, ai_table):
+    """改动前的实现：每次从 line_num 逐行扫描到 </table>"""
+    code_to_answer = parse_table_answer(ai_table)
+    for idx in range(line_num - 1, len(lines)):
+        if '</table>' in lines[idx]:
+            break
+        code_match = CODE_PATTERN.search(lines[idx])
+        if code_match and code_to_answer.get(code_match.group(1)):
+            lines[idx] = lines[idx].replace('&nbsp;', code_to_answer[code_match.group(1)], 1)
+
+
+def test_indexed_table_answer_matches_row_scan():
+    rows = "".join(
+        f" <tr><td><p>项目{i}<o:p></o:p></p></td>\n <td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：{100 + i} --></td></tr>\n"
+        for i in range(50)
+    )
+    # 第二个表格重复使用编码 100，表格外也有一个编码 101 的行
+    content = (f"<table>\n{rows}</table>\n<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：101 -->\n"
+               "<table>\n <tr><td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：100 --></td></tr>\n</table>\n")
+    replies = [f"<tr>\n 项目{i}\n 答案{i} <!-- 绝对编码：{100 + i} -->\n</tr>" for i in range(50)]
+    replies.append("<tr>\n 不在表格中 <!-- 绝对编码：999 -->\n</tr>")
+    document = PatchedDocument.from_text(content)
+    expected = PatchedDocument.from_text(content).lines
+    # 流式回答逐行回填
+    for reply in replies:
+        document.apply_table_answer(1, reply)
+        legacy_apply_table_answer(expected, 1, reply)
+    assert document.lines == expected
+    # 表格外编码 101 的行不受影响；第二个表格只填自己的编码 100
+    assert document.lines[102] == "<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：101 -->\n"
+    assert document.apply_table_answer(104, replies[0]) == 1
+    assert "答案0" in document.lines[104]
@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+from preprocessing import agent_call
+
+TABLE = """<table>
+ <tr>
+  <td><p>联系人<o:p></o:p></p></td>
+  <td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：{code} --></td>
+ </tr>
+</table>"""
+
+
+def fake_token_counts(monkeypatch):
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text))
+    monkeypatch.setattr(agent_call, "count_tokens_batch", lambda texts, model=None: [len(t) for t in texts])
+
+
+def test_questions_do_not_wait_for_slow_tables(monkeypatch):
+    fake_token_counts(monkeypatch)
+    started = {}
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        is_table = "绝对编码：31" in prompt
+        started.setdefault("table" if is_table else "question", time.perf_counter())
+        await asyncio.sleep(0.3 if is_table else 0.1)
+        answer = "<tr>\n 联系人\n 张三 <!-- 绝对编码：31 -->\n</tr>" if is_table else "甲|||乙"
+        if on_delta:
+            on_delta(answer)
+        return answer
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    written = []
+    items = [
+        (agent_call.ITEM_TABLE, 1, TABLE.format(code=31), 6),
+        (agent_call.ITEM_QUESTION, 8, "公司名称", 8),
+        (agent_call.ITEM_QUESTION, 9, "成立时间", 9),
+    ]
+    start = time.perf_counter()
+    table_answers, all_answers = asyncio.run(agent_call.answer_pipeline(
+        items,
+        on_question_answer=lambda line, answer, attempt: written.append((line, answer)),
+        on_table_answer=lambda line, rows, attempt: written.append((line, rows)),
+        workers=4,
+    ))
+    elapsed = time.perf_counter() - start
+    assert all_answers == {8: "甲", 9: "乙"}
+    assert list(table_answers) == [1]
+    # 问题批次和表格同时发出，总耗时取决于最慢的一次调用
+    assert elapsed < 0.38
+    assert abs(started["question"] - started["table"]) < 0.05
+    # 问题先完成，先进入写入阶段
+    assert [line for line, _ in written] == [8, 9, 1]
+
+
+def test_pipeline_applies_backpressure(monkeypatch):
+    fake_token_counts(monkeypatch)
+    in_flight = {"now": 0, "peak": 0}
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        in_flight["now"] += 1
+        in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+        await asyncio.sleep(0.01)
+        in_flight["now"] -= 1
+        on_delta("答")
+        return "答"
+
+    produced = []
+
+    def items():
+        for line in range(1, 41):
+            produced.append(line)
+            yield agent_call.ITEM_QUESTION, line, f"问题{line}", line
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    monkeypatch.setattr(agent_call.settings, "QUESTION_MAX_PER_BATCH", 1)
+    _, all_answers = asyncio.run(agent_call.answer_pipeline(items(), workers=2, queue_size=2))
+    assert len(all_answers) == 40
+    assert list(all_answers) == list(range(1, 41))
+    assert in_flight["peak"] == 2
+
+
+def test_longest_batches_are_sent_first(monkeypatch):
+    fake_token_counts(monkeypatch)
+    order = []
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        order.append("table" if "股东" in prompt else "question")
+        await asyncio.sleep(0)
+        answer = "<tr>\n 股东31\n 张三 <!-- 绝对编码：31 -->\n</tr>" if "股东" in prompt else "甲"
+        on_delta(answer)
+        return answer
+
+    big_table = "<table>" + "".join(
+        f"<tr><td><p>股东{i}<o:p></o:p></p></td><td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：{i} --></td></tr>"
+        for i in range(31, 41)) + "</table>"
+    items = [(agent_call.ITEM_QUESTION, line, f"问题{line}", line) for line in range(1, 4)]
+    items.append((agent_call.ITEM_TABLE, 10, big_table, 20))
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    monkeypatch.setattr(agent_call.settings, "QUESTION_MAX_PER_BATCH", 1)
+
+    table_answers, all_answers = asyncio.run(agent_call.answer_pipeline(items, workers=1, schedule="longest_first"))
+    # 文档末尾的大表格最先发送，答案仍按文档顺序合并
+    assert order == ["table", "question", "question", "question"]
+    assert list(all_answers) == [1, 2, 3] and list(table_answers) == [10]
+
+    order.clear()
+    asyncio.run(agent_call.answer_pipeline(items, workers=1, schedule="fifo"))
+    # 按文档顺序：表格排在前面的问题批次之后
+    assert order[:2] == ["question", "question"] and order.count("table") == 1
+
+
+def test_table_cost_grows_with_rows(monkeypatch):
+    fake_token_counts(monkeypatch)
+    small = [(1, "<tr>\n 联系人\n &nbsp; <!-- 绝对编码：3 -->\n</tr>")]
+    large = [(1, "\n".join(small[0][1] for _ in range(20)))]
+    question = {5: "公司名称"}
+    assert agent_call.estimate_batch_cost(agent_call.ITEM_TABLE, large) > \
+        agent_call.estimate_batch_cost(agent_call.ITEM_TABLE, small)
+    assert agent_call.estimate_batch_cost(agent_call.ITEM_QUESTION, question) > 0
+
+
+def test_longest_first_window_overlaps_scanning(monkeypatch):
+    fake_token_counts(monkeypatch)
+    produced = []
+    seen_at_call = []
+
+    prompts = []
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        seen_at_call.append(len(produced))
+        prompts.append(prompt)
+        await asyncio.sleep(0)
+        on_delta("答")
+        return "答"
+
+    def items():
+        for line in range(1, 21):
+            produced.append(line)
+            # 每第 4 个问题很长，估算耗时更大
+            question = "很长的问题" * 40 if line % 4 == 0 else f"问题{line}"
+            yield agent_call.ITEM_QUESTION, line, question, line
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    monkeypatch.setattr(agent_call.settings, "QUESTION_MAX_PER_BATCH", 1)
+    _, all_answers = asyncio.run(agent_call.answer_pipeline(items(), workers=1, schedule="longest_first", window=4))
+    assert list(all_answers) == list(range(1, 21))
+    # 扫描还没结束时已经开始调用，窗口中最长的批次先发送
+    assert seen_at_call[0] < 20
+    assert "很长的问题" in prompts[0]
+
+    seen_at_call.clear()
+    produced.clear()
+    asyncio.run(agent_call.answer_pipeline(items(), workers=1, schedule="longest_first", window=0))
+    # 窗口为 0：整个文档规划完才开始调用
+    assert seen_at_call[0] == 20
+
+
+def test_pipeline_sends_the_planned_batches(monkeypatch):
+    fake_token_counts(monkeypatch)
+    sent = []
+
+    async def fake_get_answers(questions, **kwargs):
+        sent.append((agent_call.ITEM_QUESTION, questions))
+        return {}
+
+    async def fake_get_table_answers(pack, **kwargs):
+        sent.append((agent_call.ITEM_TABLE, pack))
+        return {}
+
+    monkeypatch.setattr(agent_call, "get_answers", fake_get_answers)
+    monkeypatch.setattr(agent_call, "get_table_answers", fake_get_table_answers)
+    monkeypatch.setattr(agent_call.settings, "QUESTION_MAX_PER_BATCH", 4)
+    monkeypatch.setattr(agent_call.settings, "TABLE_PACK_MAX_TABLES", 2)
+    questions = {line: "问" * (line % 7 + 1) for line in range(100, 130)}
+    tables = {line: TABLE.format(code=line) for line in range(1, 6)}
+    items = [(agent_call.ITEM_TABLE, line, html, line) for line, html in tables.items()]
+    items += [(agent_call.ITEM_QUESTION, line, question, line) for line, question in questions.items()]
+
+    asyncio.run(agent_call.answer_pipeline(items, workers=1, schedule="fifo"))
+    # 流水线与 plan_question_batches / pack_tables 使用同一个 BatchPlanner
+    assert [work for kind, work in sent if kind == agent_call.ITEM_QUESTION] == \
+        agent_call.plan_question_batches(questions)
+    assert [work for kind, work in sent if kind == agent_call.ITEM_TABLE] == \
+        asyncio.run(agent_call.pack_tables(tables))
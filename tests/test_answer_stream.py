@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import httpx
+
+from configs import AI_calls, AI_cache
+from preprocessing.agent_call import process_answers
+from preprocessing.answer_patch import PatchedDocument, split_table_reply
+from preprocessing.answer_stream import QuestionAnswerStream, TableRowStream
+
+ANSWER = " 示例公司 ||| = |||  ||| 2021年\n3月 |||（请根据实际情况填写）|||多余"
+TABLE_REPLY = "<tr>\n 联系人\n 张三 <!-- 绝对编码：31 -->\n</tr>\n<TR>\n 电话\n 123 <!-- 绝对编码：52 -->\n</TR>\n<tr> 无编码 </tr>"
+
+
+def feed_in_pieces(stream, text, size):
+    for start in range(0, len(text), size):
+        stream.feed(text[start:start + size])
+    stream.close()
+
+
+def test_question_stream_matches_process_answers():
+    questions = {3: "a", 7: "b", 9: "c", 12: "d"}
+    expected = asyncio.run(process_answers(questions, ANSWER))
+    expected = {k: v.replace("\n", " ") for k, v in expected.items()}
+    for size in (1, 2, 5, len(ANSWER)):
+        got = {}
+        stream = QuestionAnswerStream(questions, got.__setitem__)
+        feed_in_pieces(stream, ANSWER, size)
+        assert got == expected
+        assert stream.answers == expected
+
+
+def test_question_stream_reset_and_table_reply():
+    got = {}
+    stream = QuestionAnswerStream([1, 2], got.__setitem__)
+    stream.feed("错误|||")
+    stream.feed(None)
+    feed_in_pieces(stream, "甲|||乙", 1)
+    assert got == {1: "甲", 2: "乙"}
+
+    got = {}
+    feed_in_pieces(QuestionAnswerStream([1], got.__setitem__), "  <tr>\n 甲 |||\n</tr>", 1)
+    assert got == {}
+
+
+def test_table_stream_matches_split_table_reply():
+    code_owner = {"31": 10, "52": 20}
+    expected = split_table_reply(TABLE_REPLY, code_owner)
+    for size in (1, 3, len(TABLE_REPLY)):
+        got = {}
+        stream = TableRowStream(code_owner, lambda owner, row: got.setdefault(owner, []).append(row))
+        feed_in_pieces(stream, TABLE_REPLY, size)
+        assert {owner: "\n".join(rows) for owner, rows in got.items()} == expected
+        assert stream.tables() == expected
+
+
+def test_call_fastgpt_streams_sse(monkeypatch):
+    pieces = ["答案", "1|||答", "案2"]
+    body = "".join(
+        f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]}, ensure_ascii=False)}\n\n"
+        for piece in pieces
+    ) + "data: [DONE]\n\n"
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, content=body.encode("utf-8"), headers={"Content-Type": "text/event-stream"})
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        try:
+            return await AI_calls.call_fastgpt("问题", on_delta=deltas.append)
+        finally:
+            await AI_calls.close_client()
+
+    deltas = []
+    monkeypatch.setattr(AI_calls.settings, "FASTGPT_STREAM", True)
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    assert asyncio.run(main()) == "答案1|||答案2"
+    assert deltas == pieces
+    assert requests[0]["stream"] is True
+
+
+DOCUMENT = """<table>
+<tr><td><p>联系人<o:p></o:p></p></td>
+<td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：31 --></td></tr>
+<tr><td><p>电话<o:p></o:p></p></td>
+<td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：52 --></td></tr>
+</table>
+<p>公司名称<o:p></o:p></p>
+<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：60 -->
+<p>注册地址<o:p></o:p></p>
+<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：61 -->
+"""
+
+
+def attempt_callbacks(apply, document, attempt="batch"):
+    return (lambda line, answer: apply(line, answer, attempt)), (lambda: document.discard(attempt))
+
+
+def test_discarded_table_attempt_leaves_no_text():
+    document = PatchedDocument.from_text(DOCUMENT)
+    stream = TableRowStream({"31": 1, "52": 1}, *attempt_callbacks(document.apply_table_answer, document))
+    # 第一次请求已经收到并回填了两行，随后被重试作废
+    stream.feed("<tr>\n 联系人\n 旧答案 <!-- 绝对编码：31 -->\n</tr>\n<tr>\n 电话\n 旧电话 <!-- 绝对编码：52 -->\n</tr>")
+    assert "旧答案" in document.text() and "旧电话" in document.text()
+    stream.feed(None)
+    assert document.text() == DOCUMENT
+    # 重试的回答只填了第一行
+    stream.feed("<tr>\n 联系人\n 新答案 <!-- 绝对编码：31 -->\n</tr>")
+    stream.close()
+    text = document.text()
+    assert "新答案" in text
+    assert "旧答案" not in text and "旧电话" not in text
+
+
+def test_discarded_question_attempt_leaves_no_text():
+    document = PatchedDocument.from_text(DOCUMENT)
+    stream = QuestionAnswerStream([7, 9], *attempt_callbacks(document.apply_question_answer, document))
+    stream.feed("旧公司|||旧地址|||")
+    assert "旧公司" in document.text()
+    stream.feed(None)
+    assert document.text() == DOCUMENT
+    stream.feed("新公司|||=")
+    stream.close()
+    text = document.text()
+    assert "新公司" in text
+    assert "旧公司" not in text and "旧地址" not in text
+
+
+def test_rows_are_applied_before_the_reply_ends():
+    got = {}
+    discarded = []
+    stream = TableRowStream({"31": 1, "52": 2}, got.__setitem__, lambda: discarded.append(True))
+    stream.feed("<tr>\n 联系人\n 张三 <!-- 绝对编码：31 -->\n</tr>\n<tr>\n 电话")
+    # 第一行完整后立即回调，不等整个回答结束
+    assert got == {1: "<tr>\n 联系人\n 张三 <!-- 绝对编码：31 -->\n</tr>"}
+    # 请求最终失败：调用方撤销已回填的行
+    stream.feed(None)
+    assert discarded == [True] and stream.tables() == {}
+
+
+def test_undo_keeps_lines_rewritten_by_later_answers():
+    document = PatchedDocument.from_text(DOCUMENT)
+    document.apply_question_answer(7, "作废的答案", attempt="old")
+    document.apply_question_answer(7, "其他批次的答案", attempt="other")
+    document.discard("old")
+    assert "其他批次的答案" in document.text()
+    document.commit("other")
+    document.discard("other")
+    assert "其他批次的答案" in document.text()
@@ -0,0 +1,52 @@
+import asyncio
+import shutil
+
+from preprocessing import agent_call, template_cache
+from preprocessing.document import finish_document, preprocess_document
+from preprocessing.html_html import html_to_html_fill
+from preprocessing.html_preprocessing import process_single_file
+
+TEMPLATE = """<html><head><meta http-equiv=Content-Type content="text/html; charset=gb2312"></head><body>
+<p class=MsoNormal><span>1. 公司名称<o:p></o:p></span></p>
+<p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span></p>
+<p class=MsoNormal><span>2. 成立时间<o:p></o:p></span></p>
+<p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span></p>
+</body></html>
+"""
+
+
+def test_in_memory_pipeline_matches_file_pipeline(monkeypatch, tmp_path):
+    monkeypatch.setattr(template_cache, "_enabled", False)
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text))
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        if on_delta:
+            on_delta("示例公司|||2021年")
+        return "示例公司|||2021年"
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+
+    by_file = tmp_path / "files" / "report.htm"
+    in_memory = tmp_path / "memory" / "report.htm"
+    for path in (by_file, in_memory):
+        path.parent.mkdir()
+        path.write_bytes(TEMPLATE.encode("gb2312"))
+
+    simplified = process_single_file(str(by_file))
+    agent_file = simplified.replace(".txt", "_copy.txt")
+    shutil.copyfile(simplified, agent_file)
+    asyncio.run(agent_call.process_file(agent_file))
+    expected_output = by_file.parent / "report_final_filled.html"
+    html_to_html_fill(agent_file, str(by_file.parent / "report_with_comments.htm"), str(expected_output))
+
+    document = preprocess_document(str(in_memory))
+    asyncio.run(document.answer())
+    output = finish_document(document)
+    assert open(output, "rb").read() == expected_output.read_bytes()
+    assert "2021年" in document.filled
+    # 默认不写中间文件
+    assert sorted(p.name for p in in_memory.parent.iterdir()) == ["report.htm", "report_final_filled.html"]
+
+    finish_document(document, keep_intermediates=True)
+    for name in ("report_with_comments.htm", "report_simplified.txt", "report_simplified_copy.txt"):
+        assert (in_memory.parent / name).read_bytes() == (by_file.parent / name).read_bytes()
@@ -0,0 +1,90 @@
+import re
+
+import pytest
+
+from preprocessing.html_html import extract_answers, iter_answers
+
+
+def legacy_extract(lines):
+    """改动前的实现（每行最多三次 re.search），作为单次组合正则的对照"""
+    answers_dict = {}
+    for line in lines:
+        if '<!-- 绝对编码：' in line:
+            row_match = re.search(r'<!-- 绝对编码：(\d+) -->', line)
+            if row_match:
+                row_num = int(row_match.group(1))
+                answer = None
+                for pattern in [r'<p>(.*?)<o:p>', r'<o:p>(.*?)</o:p>']:
+                    match = re.search(pattern, line)
+                    if match:
+                        answer = match.group(1).strip()
+                        if answer and answer != '&nbsp;' and answer != '':
+                            break
+                if answer:
+                    answers_dict[row_num] = answer
+    return answers_dict
+
+
+EDGE_CASES = {
+    "code_only": ["<!-- 绝对编码：1 -->\n", " <!-- 绝对编码：2 -->"],
+    "nbsp_only": [
+        "<p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：3 -->\n",
+        "<p><o:p>&nbsp;</o:p></p> <!-- 绝对编码：4 -->\n",
+        "<p>&nbsp;<o:p>&nbsp;</o:p></p> <!-- 绝对编码：5 -->\n",
+        "<td><o:p>&nbsp;</o:p></td> <!-- 绝对编码：6 -->\n",
+    ],
+    "empty_and_blank": [
+        "<p><o:p></o:p></p> <!-- 绝对编码：7 -->\n",
+        "<p>   <o:p>  </o:p></p> <!-- 绝对编码：8 -->\n",
+        "<p>答案<o:p></o:p></p> <!-- 绝对编码：9 -->\r\n",
+    ],
+    "nested_tags": [
+        "<td><p><span lang=EN-US>甲</span><o:p></o:p></p></td> <!-- 绝对编码：10 -->\n",
+        "<p>外<p>内<o:p>乙</o:p></p></p> <!-- 绝对编码：11 -->\n",
+        "<td><p><o:p><b>加粗</b></o:p></p></td> <!-- 绝对编码：12 -->\n",
+        "<p>无结束标签 <!-- 绝对编码：13 -->\n",
+        "<o:p>只有 o:p</o:p> <!-- 绝对编码：14 -->\n",
+    ],
+    "several_codes": [
+        "<p>第一<o:p></o:p></p> <!-- 绝对编码：15 --> <p>第二<o:p></o:p></p> <!-- 绝对编码：16 -->\n",
+        "<!-- 绝对编码：17 --> <p>编码在前<o:p></o:p></p> <!-- 绝对编码：18 -->\n",
+        "<p>&nbsp;<o:p>丙</o:p></p><!-- 绝对编码：19 --><!-- 绝对编码：20 -->\n",
+    ],
+    "answer_after_code": [
+        "<!-- 绝对编码：21 --> <p>后面的答案<o:p></o:p></p>\n",
+        "<p>前<o:p>前 o:p</o:p></p> <!-- 绝对编码：22 --> <p>后<o:p></o:p></p>\n",
+    ],
+    "malformed_markers": [
+        "<p>多余空格<o:p></o:p></p> <!--  绝对编码：23 -->\n",
+        "<p>非数字<o:p></o:p></p> <!-- 绝对编码：abc -->\n",
+        "<p>没有编码的行<o:p></o:p></p>\n",
+    ],
+    "repeated_code": [
+        "<p>旧值<o:p></o:p></p> <!-- 绝对编码：24 -->\n",
+        "<p>新值<o:p></o:p></p> <!-- 绝对编码：24 -->\n",
+    ],
+}
+
+
+@pytest.mark.parametrize("case", sorted(EDGE_CASES))
+def test_combined_pattern_matches_legacy_extraction(case):
+    lines = EDGE_CASES[case]
+    assert extract_answers(lines) == legacy_extract(lines)
+
+
+def test_edge_case_answers_are_pinned():
+    lines = [line for case in EDGE_CASES.values() for line in case]
+    assert dict(iter_answers(lines)) == {
+        4: "&nbsp;", 5: "&nbsp;", 6: "&nbsp;",
+        9: "答案",
+        10: '<span lang=EN-US>甲</span>',
+        11: "外<p>内",
+        12: "<b>加粗</b>",
+        14: "只有 o:p",
+        15: "第一",
+        17: "编码在前",
+        19: "丙",
+        21: "后面的答案",
+        22: "前",
+        24: "新值",
+    }
@@ -0,0 +1,33 @@
+import codecs
+import os
+from preprocessing import file_encoding
+from preprocessing.file_encoding import detect_encoding, remember_encoding
+
+
+def test_meta_charset_and_bom(tmp_path):
+    meta = tmp_path / "meta.htm"
+    meta.write_bytes('<html><head><meta http-equiv=Content-Type content="text/html; charset=gb2312"></head>'
+                     '<p>尽职调查</p>'.encode('gb2312'))
+    assert detect_encoding(str(meta)) == 'gb2312'
+
+    bom = tmp_path / "bom.txt"
+    bom.write_bytes(codecs.BOM_UTF8 + '尽职调查'.encode('utf-8'))
+    assert detect_encoding(str(bom)) == 'utf-8-sig'
+
+
+def test_sampled_detection_skips_ascii_prefix(tmp_path):
+    path = tmp_path / "report.htm"
+    path.write_bytes(b'<style>' + b' ' * 100000 + b'</style>' + ('尽职调查报告，私募基金管理人。' * 2000).encode('utf-8'))
+    assert detect_encoding(str(path)).lower() == 'utf-8'
+
+
+def test_results_are_memoized_by_mtime_and_size(tmp_path, monkeypatch):
+    path = tmp_path / "derived.txt"
+    path.write_text('尽职调查', encoding='utf-8')
+    remember_encoding(str(path), 'utf-8')
+    monkeypatch.setattr(file_encoding, '_sniff_encoding', lambda *args: 'sniffed')
+    assert detect_encoding(str(path)) == 'utf-8'
+
+    path.write_text('尽职调查报告', encoding='utf-8')
+    os.utime(path, ns=(1, 1))
+    assert detect_encoding(str(path)) == 'sniffed'
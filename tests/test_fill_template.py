@@ -0,0 +1,60 @@
+import logging
+
+from preprocessing.answer_patch import split_lines
+from preprocessing.html_html import extract_answers, fill_template_lines
+from preprocessing.html_preprocessing import add_line_codes
+
+TEMPLATE = """<html><body>
+<p class=MsoNormal><span>1. 公司名称<o:p></o:p></span></p>
+<p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span></p>
+<table>
+ <tr>
+  <td><p class=MsoNormal><span>联系人<o:p></o:p></span></p></td>
+  <td><p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span>
+  </p></td>
+ </tr>
+</table>
+</body></html>
+"""
+
+
+def test_code_index_points_at_comment_lines():
+    code_index = {}
+    lines = split_lines(add_line_codes(split_lines(TEMPLATE), code_index))
+    assert sorted(code_index) == [3, 8]
+    for code, offset in code_index.items():
+        assert f"<!-- 绝对编码：{code} -->" in lines[offset]
+
+
+def test_fill_uses_index_and_skips_unknown_codes():
+    code_index = {}
+    lines = split_lines(add_line_codes(split_lines(TEMPLATE), code_index))
+    # 绝对编码 8 的注释在 </p> 所在的第 8 行，答案位于第 7 行的 <o:p>：按索引填到注释所在行
+    filled = fill_template_lines(lines, {3: "某某资产", 8: "张三", 99: "不存在"}, code_index)
+    assert filled == 1
+    assert "<o:p>某某资产</o:p>" in lines[code_index[3]]
+    assert "张三" not in "".join(lines)
+
+
+def test_fill_builds_index_when_missing(caplog):
+    lines = split_lines(add_line_codes(split_lines(TEMPLATE)))
+    with caplog.at_level(logging.DEBUG, logger="preprocessing.html_html"):
+        assert fill_template_lines(lines, {3: "某某资产"}) == 1
+    assert "<o:p>某某资产</o:p>" in lines[2]
+    assert any("Filled line 2" in record.message for record in caplog.records)
+
+
+def test_fill_is_quiet_by_default(capsys):
+    lines = split_lines(add_line_codes(split_lines(TEMPLATE)))
+    fill_template_lines(lines, {3: "某某资产"})
+    assert capsys.readouterr().out == ""
+
+
+def test_extract_answers():
+    lines = [
+        "<p>某某资产<o:p>&nbsp;</o:p></p> <!-- 绝对编码：3 -->\n",
+        "<p><o:p>&nbsp;</o:p></p> <!-- 绝对编码：4 -->\n",
+        "<td><p><o:p>张三</o:p></p></td> <!-- 绝对编码：8 -->\n",
+    ]
+    # 两个模式都没有有效答案时保留最后一次匹配到的值（包括 &nbsp;）
+    assert extract_answers(lines) == {3: "某某资产", 4: "&nbsp;", 8: "张三"}
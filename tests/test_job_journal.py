@@ -0,0 +1,78 @@
+import asyncio
+
+from preprocessing import agent_call
+from preprocessing.job_journal import JobJournal, use_journal
+
+
+def run_questions(monkeypatch, journal, answers):
+    calls = []
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        calls.append(prompt)
+        answer = answers.pop(0)
+        if answer and on_delta:
+            on_delta(answer)
+        return answer
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    questions = {line: f"问题{line}" for line in range(1, 5)}
+
+    async def main():
+        with use_journal(journal):
+            return await agent_call.answer_document({}, questions)
+
+    _, all_answers = asyncio.run(main())
+    journal.close()
+    return all_answers, calls
+
+
+def test_resume_replays_completed_batches(monkeypatch, tmp_path):
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: 1)
+    monkeypatch.setattr(agent_call.settings, "QUESTION_MAX_PER_BATCH", 2)
+    monkeypatch.setattr(agent_call.settings, "PIPELINE_WORKERS", 1)
+    path = str(tmp_path / "doc_simplified_journal.jsonl")
+
+    # 第一次运行：第二批失败
+    all_answers, calls = run_questions(monkeypatch, JobJournal(path), ["甲|||乙", None])
+    assert all_answers == {1: "甲", 2: "乙"}
+    assert len(calls) == 2
+
+    # 模拟进程被杀时写了一半的行
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"hash": "abc", "sta')
+
+    # 续跑：只调用失败的那一批
+    journal = JobJournal(path, resume=True)
+    all_answers, calls = run_questions(monkeypatch, journal, ["丙|||丁"])
+    assert all_answers == {1: "甲", 2: "乙", 3: "丙", 4: "丁"}
+    assert len(calls) == 1 and "问题3" in calls[0]
+    assert journal.replayed == 1 and journal.recorded == 1
+
+    # 不续跑时重新开始
+    fresh = JobJournal(path)
+    assert len(fresh) == 0
+    fresh.close()
+
+
+def test_resume_after_torn_last_line(tmp_path):
+    path = str(tmp_path / "doc_journal.jsonl")
+    journal = JobJournal(path)
+    journal.record("h1", "question", [1], "答1")
+    journal.record("h2", "question", [2], "答2")
+    journal.close()
+    # 进程在写第三行时被杀
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"hash": "h3", "status": "do')
+
+    journal = JobJournal(path, resume=True)
+    assert len(journal) == 2
+    journal.record("h4", "question", [4], "答4")
+    journal.close()
+    journal = JobJournal(path, resume=True)
+    journal.record("h5", "question", [5], "答5")
+    journal.close()
+
+    journal = JobJournal(path, resume=True)
+    assert {key: journal.completed(key) for key in ("h1", "h2", "h4", "h5")} == \
+        {"h1": "答1", "h2": "答2", "h4": "答4", "h5": "答5"}
+    journal.close()
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import httpx
+
+from configs import AI_cache, AI_calls, metrics
+
+
+def test_spans_and_counters_are_attributed_to_documents():
+    metrics.reset()
+    with metrics.use_document("a.htm"):
+        with metrics.span("clean_html"):
+            pass
+        metrics.inc("fastgpt_prompt_tokens_total", 100)
+    metrics.inc("fastgpt_prompt_tokens_total", 50)
+    report = metrics.build_report()
+    assert report["stages"]["clean_html"]["count"] == 1
+    assert report["tokens"]["prompt"] == 150
+    assert report["documents"]["a.htm"]["counters"] == {"fastgpt_prompt_tokens_total": 100}
+    assert "clean_html" in report["documents"]["a.htm"]["stages"]
+
+
+def test_timed_decorator_handles_async_functions():
+    metrics.reset()
+
+    @metrics.timed("table_chunking")
+    async def chunk():
+        return 42
+
+    assert asyncio.run(chunk()) == 42
+    assert metrics.build_report()["stages"]["table_chunking"]["count"] == 1
+
+
+def test_worker_snapshots_are_merged():
+    metrics.reset()
+
+    def work(x):
+        metrics.inc("template_cache_requests_total", kind="structure", result="hit")
+        return x * 2
+
+    result, snapshot = metrics.call_in_worker(metrics.worker_context("b.htm"), work, 21)
+    metrics.reset()
+    metrics.merge(snapshot)
+    assert result == 42
+    assert metrics.build_report()["cache_hit_rates"]["template_cache"] == {"structure": 1.0}
+
+
+def test_prometheus_text_format():
+    metrics.reset()
+    metrics.observe(metrics.STAGE_SECONDS, 0.2, stage="fastgpt_call")
+    metrics.observe(metrics.STAGE_SECONDS, 3.0, stage="fastgpt_call")
+    metrics.inc("fastgpt_retries_total", 2)
+    text = metrics.to_prometheus()
+    assert "# TYPE fileprocessing_stage_seconds histogram" in text
+    assert 'fileprocessing_stage_seconds_bucket{stage="fastgpt_call",le="0.25"} 1' in text
+    assert 'fileprocessing_stage_seconds_bucket{stage="fastgpt_call",le="+Inf"} 2' in text
+    assert 'fileprocessing_stage_seconds_count{stage="fastgpt_call"} 2' in text
+    assert "fileprocessing_fastgpt_retries_total 2" in text
+
+
+def test_call_fastgpt_records_retries_and_usage(monkeypatch, tmp_path):
+    responses = [
+        httpx.Response(503),
+        httpx.Response(200, json={"choices": [{"message": {"content": "答案"}}],
+                                  "usage": {"prompt_tokens": 30, "completion_tokens": 5}}),
+    ]
+
+    def handler(request):
+        return responses.pop(0)
+
+    async def main():
+        AI_calls.init_client(transport=httpx.MockTransport(handler))
+        try:
+            return await AI_calls.call_fastgpt("问题")
+        finally:
+            await AI_calls.close_client()
+
+    monkeypatch.setattr(AI_calls, "url", "http://fastgpt.test/api/v1/chat/completions")
+    monkeypatch.setattr(AI_calls.settings, "FASTGPT_BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    metrics.reset()
+    assert asyncio.run(main()) == "答案"
+    report = metrics.build_report()
+    assert report["fastgpt"] == {"calls": 1, "requests": 2, "retries": 1, "failed_calls": 0}
+    assert report["tokens"]["prompt"] == 30 and report["tokens"]["completion"] == 5
+    assert report["stages"]["fastgpt_attempt"]["count"] == 2
+
+    json_path, prom_path = metrics.write_reports(tmp_path)
+    assert json.load(open(json_path, encoding="utf-8"))["fastgpt"]["retries"] == 1
+    assert "fileprocessing_fastgpt_calls_total" in open(prom_path, encoding="utf-8").read()
@@ -0,0 +1,54 @@
+import asyncio
+import random
+
+from benchmarks.mock_fastgpt import answer_prompt, parse_latency, start_server
+from configs import AI_calls, AI_cache
+
+
+def test_question_batch_answers_follow_separator_format():
+    reply = answer_prompt("提示词\n真正输入：\n{3: '公司名称', 5: '注册地址'}")
+    answers = reply.split("|||")
+    assert len(answers) == 2
+    # 同样的问题总是得到同样的答案
+    assert answer_prompt("其他提示词 真正输入：{9: '公司名称'}") == answers[0]
+
+
+def test_packed_tables_keep_separators_and_codes():
+    prompt = ("真正输入：\n==== 表格 1 开始 ====\n<tr>\n 联系人\n &nbsp; <!-- 绝对编码：8 -->\n</tr>\n"
+              "==== 表格 1 结束 ====\n==== 表格 2 开始 ====\n<tr>\n 电话\n &nbsp; <!-- 绝对编码：12 -->\n</tr>\n"
+              "==== 表格 2 结束 ====")
+    lines = answer_prompt(prompt).split("\n")
+    assert lines[0] == "==== 表格 1 开始 ====" and lines[-1] == "==== 表格 2 结束 ===="
+    reply = "\n".join(lines)
+    assert "&nbsp;" not in reply
+    assert "<!-- 绝对编码：8 -->" in reply and "<!-- 绝对编码：12 -->" in reply
+
+
+def test_latency_specs():
+    rng = random.Random(0)
+    assert parse_latency("fixed:0.2")(rng) == 0.2
+    assert 0.1 <= parse_latency("uniform:0.1:0.3")(rng) <= 0.3
+    assert parse_latency("lognormal:0.5:0.8")(rng) > 0
+
+
+def test_call_fastgpt_against_mock_server(monkeypatch):
+    server = start_server(latency="fixed:0", error_rate=0.0)
+    monkeypatch.setattr(AI_calls, "url", server.url)
+    monkeypatch.setattr(AI_calls, "FASTGPT_API_KEY", "benchmark")
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+
+    async def main(stream):
+        monkeypatch.setattr(AI_calls.settings, "FASTGPT_STREAM", stream)
+        try:
+            return await AI_calls.call_fastgpt("真正输入：{3: '公司名称', 5: '注册地址'}")
+        finally:
+            await AI_calls.close_client()
+
+    try:
+        plain = asyncio.run(main(False))
+        streamed = asyncio.run(main(True))
+    finally:
+        server.shutdown()
+    assert plain == streamed
+    assert len(plain.split("|||")) == 2
+    assert server.state.stats()["requests"] == 2
@@ -0,0 +1,27 @@
+from preprocessing import agent_call
+from preprocessing.agent_call import plan_question_batches
+
+
+def test_batches_follow_token_budget(monkeypatch):
+    # 每个字符计 1 个 token，便于推算
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text))
+    prompt_tokens = len(agent_call.build_fastgpt_prompt(30))
+    short = {line: "姓名" for line in range(1, 21)}
+    batches = plan_question_batches(short, token_budget=prompt_tokens + 20 * 30, answer_tokens=10, max_questions=30)
+    assert len(batches) == 1
+
+    long = {1: "说" * 500, 2: "明" * 500, 3: "短"}
+    batches = plan_question_batches(long, token_budget=prompt_tokens + 600, answer_tokens=10, max_questions=30)
+    assert [list(batch) for batch in batches] == [[1], [2, 3]]
+
+
+def test_max_questions_per_batch(monkeypatch):
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: 1)
+    questions = {line: "问题" for line in range(25)}
+    batches = plan_question_batches(questions, token_budget=10 ** 6, answer_tokens=0, max_questions=10)
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+
+
+def test_prompt_states_batch_size():
+    assert "答案3\"" in agent_call.build_fastgpt_prompt(3)
+    assert agent_call.build_fastgpt_prompt(10) == agent_call.FASTGPT_PROMPT
@@ -0,0 +1,136 @@
+import asyncio
+import time
+from configs.rate_limiter import (
+    AdaptiveConcurrency, TokenBucket, FastGPTLimiter, OUTCOME_OK, OUTCOME_THROTTLED,
+)
+
+
+def test_aimd_grows_on_success_and_halves_on_throttle():
+    async def main():
+        control = AdaptiveConcurrency(initial=4, minimum=1, maximum=8, latency_target=1.0)
+        for _ in range(20):
+            await control.acquire()
+            await control.release(OUTCOME_OK, 0.1)
+        grown = control.limit
+        await control.acquire()
+        await control.release(OUTCOME_THROTTLED, 0.1)
+        return grown, control.limit
+
+    grown, reduced = asyncio.run(main())
+    assert 6 < grown <= 8
+    assert reduced == grown / 2
+
+
+def test_slow_calls_do_not_grow_concurrency():
+    async def main():
+        control = AdaptiveConcurrency(initial=4, minimum=1, maximum=8, latency_target=1.0)
+        for _ in range(10):
+            await control.acquire()
+            await control.release(OUTCOME_OK, 5.0)
+        return control.limit
+
+    assert asyncio.run(main()) == 4
+
+
+def test_concurrency_limit_is_enforced():
+    async def main():
+        limiter = FastGPTLimiter(0, 0, initial_concurrency=3, min_concurrency=1, max_concurrency=3, latency_target=0)
+        in_flight = {"now": 0, "peak": 0}
+
+        async def call():
+            async with limiter.slot() as slot:
+                in_flight["now"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+                await asyncio.sleep(0.01)
+                in_flight["now"] -= 1
+                slot.record(OUTCOME_OK)
+
+        await asyncio.gather(*[call() for _ in range(12)])
+        return in_flight["peak"]
+
+    assert asyncio.run(main()) == 3
+
+
+def test_token_bucket_paces_requests():
+    async def main():
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.perf_counter()
+        for _ in range(6):
+            await bucket.acquire()
+        return time.perf_counter() - start
+
+    assert asyncio.run(main()) >= 0.09
+
+
+def test_waiters_are_granted_by_priority():
+    async def main():
+        control = AdaptiveConcurrency(initial=1, minimum=1, maximum=1, latency_target=0)
+        granted = []
+        await control.acquire()
+
+        async def waiter(name, priority):
+            await control.acquire(priority)
+            granted.append(name)
+            await control.release(OUTCOME_OK, 0.1)
+
+        tasks = [asyncio.create_task(waiter(name, priority))
+                 for name, priority in (("small", 1), ("large", 100), ("medium", 10), ("medium2", 10))]
+        await asyncio.sleep(0)
+        await control.release(OUTCOME_OK, 0.1)
+        await asyncio.gather(*tasks)
+        return granted
+
+    assert asyncio.run(main()) == ["large", "medium", "medium2", "small"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        control = AdaptiveConcurrency(initial=1, minimum=1, maximum=1, latency_target=0)
+        await control.acquire()
+        first = asyncio.create_task(control.acquire(100))
+        second = asyncio.create_task(control.acquire(1))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        await control.release(OUTCOME_OK, 0.1)
+        await asyncio.wait_for(second, 1)
+        return control.in_flight
+
+    assert asyncio.run(main()) == 1
+
+
+def test_waiter_times_out_without_taking_a_slot():
+    async def main():
+        control = AdaptiveConcurrency(initial=1, minimum=1, maximum=1, latency_target=0)
+        await control.acquire()
+        try:
+            await control.acquire(100, timeout=0.05)
+        except asyncio.TimeoutError:
+            timed_out = True
+        else:
+            timed_out = False
+        later = asyncio.create_task(control.acquire(1, timeout=1))
+        await asyncio.sleep(0)
+        await control.release(OUTCOME_OK, 0.1)
+        await later
+        return timed_out, control.in_flight, control._waiting
+
+    assert asyncio.run(main()) == (True, 1, [])
+
+
+def test_burst_of_throttles_halves_once():
+    async def main():
+        control = AdaptiveConcurrency(initial=16, minimum=1, maximum=16, latency_target=0)
+        for _ in range(8):
+            await control.acquire()
+        # 8 个并发请求同时被限流
+        for _ in range(8):
+            await control.release(OUTCOME_THROTTLED, 0.5)
+        after_burst = control.limit
+        # 减小之后才发出的请求再被限流时继续减小
+        await control.acquire()
+        await asyncio.sleep(0.01)
+        await control.release(OUTCOME_THROTTLED, 0.005)
+        return after_burst, control.limit
+
+    assert asyncio.run(main()) == (8, 4)
@@ -0,0 +1,57 @@
+import asyncio
+import os
+import shutil
+
+import run
+from benchmarks.make_questionnaire import write_questionnaire
+from benchmarks.mock_fastgpt import answer_prompt
+from configs import AI_cache
+from preprocessing import agent_call, template_cache
+
+
+def stub_fastgpt(monkeypatch):
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        await asyncio.sleep(0)
+        answer = answer_prompt(prompt)
+        if on_delta:
+            on_delta(answer)
+        return answer
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text) // 2)
+    monkeypatch.setattr(agent_call, "count_tokens_batch", lambda texts, model=None: [len(t) // 2 for t in texts])
+    monkeypatch.setattr(run.settings, "JOB_JOURNAL_ENABLED", False)
+    monkeypatch.setattr(AI_cache, "_enabled", False)
+    monkeypatch.setattr(template_cache, "_enabled", False)
+
+
+def output_of(input_file):
+    with open(os.path.splitext(input_file)[0] + "_final_filled.html", "rb") as f:
+        return f.read()
+
+
+def test_batch_matches_single_runs_and_isolates_failures(monkeypatch, tmp_path):
+    stub_fastgpt(monkeypatch)
+    batch_dir, single_dir = tmp_path / "batch", tmp_path / "single"
+    batch_dir.mkdir()
+    single_dir.mkdir()
+    files = [write_questionnaire(str(batch_dir / f"report{i}.htm"), "small", seed=i) for i in range(3)]
+    for file_path in files:
+        shutil.copy(file_path, single_dir)
+    missing = str(batch_dir / "missing.htm")
+
+    results = asyncio.run(run.run_batch([files[0], missing, *files[1:]], workers=2))
+
+    by_file = {input_file: (output_html, error) for input_file, output_html, error, _ in results}
+    assert isinstance(by_file[missing][1], FileNotFoundError)
+    for file_path in files:
+        output_html, error = by_file[file_path]
+        assert error is None and output_html is not None
+    assert run.print_batch_report(results) == len(files)
+
+    for file_path in files:
+        single_file = str(single_dir / os.path.basename(file_path))
+        run.process_and_run_agent(single_file)
+        assert output_of(file_path) == output_of(single_file)
+        # 确实填入了答案（问卷为 gb2312 编码）
+        assert output_of(file_path).decode("gb2312").count("模拟答案") > 0
@@ -0,0 +1,48 @@
+import os
+import re
+from preprocessing.agent_call import ITEM_TABLE, iter_document, build_line_starts, line_at
+
+TEST_FILE = os.path.join(os.path.dirname(__file__), "test_file.txt")
+
+
+def _scan_quadratic(content):
+    # 原来 process_file 中的实现：前缀计数 + 逐个区间判断
+    question_pattern = re.compile(r'<p>\s*(?!&nbsp;)(.*?)<o:p>', re.UNICODE)
+    tables_dict, ranges, questions = {}, [], {}
+    for match in re.finditer(r'<table[\s\S]*?</table>', content, re.IGNORECASE):
+        start_line = content[:match.start()].count('\n') + 1
+        end_line = content[:match.end()].count('\n') + 1
+        tables_dict[start_line] = match.group(0)
+        ranges.append((start_line, end_line))
+    for idx, line in enumerate(content.split('\n'), 1):
+        if any(start <= idx <= end for start, end in ranges) or '<!-- 绝对编码：' in line:
+            continue
+        match = question_pattern.search(line)
+        if match and match.group(1).strip():
+            questions[idx] = match.group(1).strip()
+    return tables_dict, ranges, questions
+
+
+def _scan_indexed(content):
+    tables_dict, ranges, questions = {}, [], {}
+    for kind, line_num, value, end_line in iter_document(content):
+        if kind == ITEM_TABLE:
+            tables_dict[line_num] = value
+            ranges.append((line_num, end_line))
+        else:
+            questions[line_num] = value
+    return tables_dict, ranges, questions
+
+
+def test_iter_document_matches_quadratic_scan():
+    with open(TEST_FILE, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read()
+    content += "\n<p>附加问题<o:p></o:p></p>\n" + content
+    assert _scan_indexed(content) == _scan_quadratic(content)
+
+
+def test_line_at():
+    content = "a\nbb\n\nc"
+    starts = build_line_starts(content)
+    for pos in range(len(content) + 1):
+        assert line_at(starts, pos) == content[:pos].count('\n') + 1
@@ -0,0 +1,79 @@
+import asyncio
+
+from preprocessing import agent_call
+from preprocessing.answer_patch import split_table_reply
+
+TABLE_A = """<table>
+ <tr>
+  <td><p>联系人<o:p></o:p></p></td>
+  <td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：31 --></td>
+ </tr>
+</table>"""
+
+TABLE_B = """<table>
+ <tr>
+  <td><p>电话<o:p></o:p></p></td>
+  <td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：52 --></td>
+ </tr>
+</table>"""
+
+REPLY = """==== 表格 1 开始 ====
+<tr>
+  联系人
+  张三 <!-- 绝对编码：31 -->
+</tr>
+==== 表格 1 结束 ====
+==== 表格 2 开始 ====
+<tr>
+  电话
+  123 <!-- 绝对编码：52 -->
+</tr>
+==== 表格 2 结束 ===="""
+
+
+def fake_token_counts(monkeypatch):
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text))
+    monkeypatch.setattr(agent_call, "count_tokens_batch", lambda texts, model=None: [len(t) for t in texts])
+
+
+def test_split_table_reply_by_code():
+    parts = split_table_reply(REPLY, {"31": 10, "52": 20})
+    assert set(parts) == {10, 20}
+    assert "张三" in parts[10] and "123" not in parts[10]
+    assert parts[20].startswith("<tr>") and "123" in parts[20]
+
+
+def test_small_tables_share_one_request(monkeypatch):
+    fake_token_counts(monkeypatch)
+    prompts = []
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        prompts.append(prompt)
+        on_delta(REPLY)
+        return REPLY
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    table_answers, _ = asyncio.run(agent_call.answer_document({10: TABLE_A, 20: TABLE_B}, {}))
+    assert len(prompts) == 1
+    assert "==== 表格 2 结束 ====" in prompts[0]
+    assert agent_call.split_lines(table_answers[10])[1].strip() == "联系人"
+    assert "123" in table_answers[20]
+
+
+def test_large_table_chunks_keep_table_start(monkeypatch):
+    fake_token_counts(monkeypatch)
+    rows = "\n".join(f" <tr><td><p>&nbsp;<o:p></o:p></p> <!-- 绝对编码：{code} --></td></tr>" for code in range(100, 106))
+    chunks = asyncio.run(agent_call.process_table_before_call(f"<table>\n{rows}\n</table>", 40, max_tokens=60))
+    assert len(chunks) > 1
+    assert {start for _, start in chunks} == {40}
+
+
+
+def test_pack_respects_budget(monkeypatch):
+    fake_token_counts(monkeypatch)
+    tables = {10: TABLE_A, 20: TABLE_B, 30: TABLE_A}
+    packs = asyncio.run(agent_call.pack_tables(tables, token_budget=10 ** 6, max_tables=2))
+    assert [[line for line, _ in pack] for pack in packs] == [[10, 20], [30]]
+    packs = asyncio.run(agent_call.pack_tables(tables, token_budget=1))
+    assert len(packs) == 3
+    assert agent_call.build_table_prompt(packs[0]).endswith(packs[0][0][1])
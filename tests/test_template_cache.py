@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from preprocessing import agent_call, html_preprocessing, template_cache
+
+TEMPLATE = """<html><head><meta http-equiv=Content-Type content="text/html; charset=utf-8"></head><body>
+<p class=MsoNormal><span>1. 公司名称<o:p></o:p></span></p>
+<p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span></p>
+<table class=MsoTableGrid>
+ <tr>
+  <td><p class=MsoNormal><span>联系人<o:p></o:p></span></p></td>
+  <td><p class=MsoNormal><span lang=EN-US><o:p>&nbsp;</o:p></span></p></td>
+ </tr>
+</table>
+</body></html>
+"""
+
+
+@pytest.fixture
+def cache_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(template_cache.settings, "TEMPLATE_CACHE_DIR", tmp_path / "templates")
+    monkeypatch.setattr(template_cache, "_enabled", True)
+    return tmp_path / "templates"
+
+
+def fail(*args, **kwargs):
+    raise AssertionError("should have been served from the template cache")
+
+
+def test_preprocessing_is_cached_by_template_bytes(cache_dir, tmp_path, monkeypatch):
+    outputs = []
+    for company in ("a", "b"):
+        input_file = tmp_path / company / "report.htm"
+        input_file.parent.mkdir()
+        input_file.write_text(TEMPLATE, encoding="utf-8")
+        simplified = html_preprocessing.process_single_file(str(input_file))
+        outputs.append((
+            (tmp_path / company / "report_with_comments.htm").read_bytes(),
+            open(simplified, "rb").read(),
+        ))
+        # 第二家公司不再执行预处理
+        monkeypatch.setattr(html_preprocessing, "add_line_codes", fail)
+        monkeypatch.setattr(html_preprocessing, "clean_html_text", fail)
+    assert outputs[0] == outputs[1]
+    assert len(list(cache_dir.iterdir())) == 1
+
+
+def test_document_structure_is_cached(cache_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text))
+    monkeypatch.setattr(agent_call, "count_tokens_batch", lambda texts, model=None: [len(t) for t in texts])
+    input_file = tmp_path / "report.htm"
+    input_file.write_text(TEMPLATE, encoding="utf-8")
+    monkeypatch.setattr(template_cache, "_enabled", False)
+    simplified = open(html_preprocessing.process_single_file(str(input_file)), encoding="utf-8").read()
+    monkeypatch.setattr(template_cache, "_enabled", True)
+
+    prompts = []
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        prompts.append(prompt)
+        return None
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    results = []
+    for company in ("a", "b"):
+        copy = tmp_path / f"{company}_simplified_copy.txt"
+        copy.write_text(simplified, encoding="utf-8")
+        results.append(asyncio.run(agent_call.process_file(str(copy))))
+        monkeypatch.setattr(agent_call, "iter_document", fail)
+        monkeypatch.setattr(agent_call, "process_table_before_call", fail)
+    assert results[0] == results[1]
+    assert list(results[0][0].values()) == ["1. 公司名称"]
+    assert prompts[:len(prompts) // 2] == prompts[len(prompts) // 2:]
@@ -0,0 +1,64 @@
+import pytest
+
+from preprocessing import token_counter
+from preprocessing.token_counter import count_tokens, count_tokens_batch
+
+
+class FakeEncoder:
+    """每个字符一个 token，并记录实际编码过的文本"""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return list(text)
+
+    def encode_batch(self, texts):
+        raise AssertionError("encode_batch creates a thread pool on every call")
+
+
+@pytest.fixture
+def encoder(monkeypatch):
+    fake = FakeEncoder()
+    monkeypatch.setattr(token_counter, "get_encoder", lambda model=None: fake)
+    token_counter.clear_token_cache()
+    yield fake
+    token_counter.clear_token_cache()
+
+
+def test_count_tokens_is_memoized(encoder):
+    assert count_tokens("<tr>\n</tr>") == 10
+    assert count_tokens("<tr>\n</tr>") == 10
+    assert encoder.encoded == ["<tr>\n</tr>"]
+
+
+def test_batch_counts_each_distinct_row_once(encoder):
+    count_tokens("表头")
+    rows = ["表头", "", "甲乙丙", "", "表头", "甲乙丙"]
+    assert count_tokens_batch(rows) == [2, 0, 3, 0, 2, 3]
+    assert encoder.encoded == ["表头", "", "甲乙丙"]
+
+
+def test_cache_is_bounded(encoder, monkeypatch):
+    monkeypatch.setattr(token_counter.settings, "TOKEN_COUNT_CACHE_SIZE", 2)
+    assert count_tokens_batch(["a", "bb", "ccc"]) == [1, 2, 3]
+    assert len(token_counter._counts) == 2
+
+
+def test_batch_survives_evicting_its_own_cached_counts(encoder, monkeypatch):
+    monkeypatch.setattr(token_counter.settings, "TOKEN_COUNT_CACHE_SIZE", 3)
+    token_counter.count_tokens_batch(["a", "bb"])
+    # 新算出的 c、d、e 把已缓存的 a、bb 淘汰
+    assert token_counter.count_tokens_batch(["a", "ccc", "dddd", "eeeee", "bb"]) == [1, 3, 4, 5, 2]
+
+
+def test_large_batches_share_one_thread_pool(encoder, monkeypatch):
+    monkeypatch.setattr(token_counter, "PARALLEL_BATCH_MIN", 4)
+    rows = [f"第{i}行" * (i % 3 + 1) for i in range(10)]
+    assert count_tokens_batch(rows) == [len(row) for row in rows]
+    executor = token_counter._executor
+    assert executor is not None
+    token_counter.clear_token_cache()
+    assert count_tokens_batch(rows) == [len(row) for row in rows]
+    assert token_counter._executor is executor
@@ -0,0 +1,101 @@
+import asyncio
+import json
+
+from configs import metrics, trace
+
+
+def _complete(events):
+    return [event for event in events if event["ph"] == "X"]
+
+
+def test_events_nest_and_carry_tags(monkeypatch):
+    monkeypatch.setattr(trace, "_enabled", True)
+    trace.reset()
+    metrics.reset()
+
+    async def main():
+        with metrics.use_document("a.htm"):
+            with metrics.span("apply_answer", line=12):
+                with metrics.span("fastgpt_call", category="call"):
+                    await asyncio.sleep(0)
+
+    asyncio.run(main())
+    inner, outer = _complete(trace.drain())
+    assert (outer["name"], inner["name"]) == ("apply_answer", "fastgpt_call")
+    assert outer["tid"] == inner["tid"]
+    assert outer["ts"] <= inner["ts"] and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+    assert outer["args"] == {"line": 12, "document": "a.htm"}
+    assert inner["cat"] == "call"
+
+
+def test_concurrent_tasks_get_separate_lanes(monkeypatch):
+    monkeypatch.setattr(trace, "_enabled", True)
+    trace.reset()
+
+    async def batch(seq):
+        with trace.event("question batch", "batch", "a.htm", seq=seq):
+            await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(batch(1), batch(2))
+
+    asyncio.run(main())
+    events = trace.drain()
+    batches = _complete(events)
+    assert len({event["tid"] for event in batches}) == 2
+    # 两个批次的时间确实重叠
+    first, second = sorted(batches, key=lambda event: event["ts"])
+    assert second["ts"] < first["ts"] + first["dur"]
+    names = [event["args"]["name"] for event in events if event["ph"] == "M"]
+    assert len(names) == 2 and all(name.startswith("a.htm · ") for name in names)
+
+
+def test_disabled_trace_records_nothing(monkeypatch):
+    monkeypatch.setattr(trace, "_enabled", False)
+    trace.reset()
+    with metrics.span("clean_html"):
+        pass
+    assert trace.drain() == []
+
+
+def test_write_produces_chrome_trace_json(monkeypatch, tmp_path):
+    monkeypatch.setattr(trace, "_enabled", True)
+    trace.reset()
+
+    def work():
+        with trace.event("preprocess", "document", "b.htm"):
+            pass
+
+    _, snapshot = metrics.call_in_worker(metrics.worker_context("b.htm"), work)
+    trace.merge(snapshot["trace"])
+    path = tmp_path / "trace.json"
+    assert trace.write(str(path)) == 2
+    data = json.load(open(path, encoding="utf-8"))
+    event = _complete(data["traceEvents"])[0]
+    assert event["name"] == "preprocess" and event["args"]["document"] == "b.htm"
+    assert {"ts", "dur", "pid", "tid", "cat"} <= set(event)
+    trace.reset()
+
+
+def test_pipeline_traces_queue_wait(monkeypatch):
+    from preprocessing import agent_call
+
+    monkeypatch.setattr(trace, "_enabled", True)
+    trace.reset()
+    monkeypatch.setattr(agent_call, "count_tokens", lambda text, model=None: len(text))
+    monkeypatch.setattr(agent_call.settings, "QUESTION_MAX_PER_BATCH", 1)
+
+    async def fake_call(prompt, on_delta=None, **kwargs):
+        await asyncio.sleep(0.02)
+        on_delta("答")
+        return "答"
+
+    monkeypatch.setattr(agent_call, "call_fastgpt", fake_call)
+    items = [(agent_call.ITEM_QUESTION, line, f"问题{line}", line) for line in range(1, 4)]
+    asyncio.run(agent_call.answer_pipeline(items, workers=1, schedule="fifo"))
+    waits = {event["args"]["seq"]: event for event in _complete(trace.drain()) if event["name"] == "queue_wait"}
+    assert sorted(waits) == [0, 1, 2]
+    assert waits[0]["cat"] == "wait" and waits[0]["args"]["kind"] == agent_call.ITEM_QUESTION
+    # 只有一个工作协程：第三个批次要等前两个调用完成
+    assert waits[2]["dur"] >= 35_000
+    trace.reset()